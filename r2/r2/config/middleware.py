@@ -22,12 +22,15 @@
 
 """Pylons middleware initialization"""
 import importlib
+import os
+import random
 import re
 import urllib
 import tempfile
 import urlparse
 from threading import Lock
 import itertools
+from collections import Counter
 import simplejson
 
 from paste.cascade import Cascade
@@ -45,8 +48,17 @@ from routes.middleware import RoutesMiddleware
 from r2.config import hooks
 from r2.config.environment import load_environment
 from r2.config.extensions import extension_mapping, set_extension
-from r2.lib.utils import is_subdomain, is_language_subdomain
+from r2.lib.utils import (
+    constant_time_compare,
+    is_subdomain,
+    is_language_subdomain,
+)
 from r2.lib import csrf, filters
+from r2.lib.profiler import (
+    SamplingProfiler,
+    collapse_samples,
+    sample_category,
+)
 
 
 # patch in WebOb support for HTTP 429 "Too Many Requests"
@@ -162,6 +174,67 @@ class ProfilingMiddleware(object):
             tmpfile.close()
 
 
+class SamplingProfilerMiddleware(object):
+    """Sample the stacks of some requests and write them out for flamegraphs.
+
+    A `profile_sample_rate` fraction of requests are profiled, as are
+    requests with an X-Reddit-Profile header matching the
+    `request_profiling` secret. Their samples are appended to a file per
+    process in the directory in collapsed stack format, under the request's
+    controller and action.
+
+    """
+
+    HEADER = "HTTP_X_REDDIT_PROFILE"
+
+    def __init__(self, app, directory, interval, g):
+        self.app = app
+        self.g = g
+        self.profiler = SamplingProfiler(interval=interval)
+        self.path = os.path.join(directory, "samples.%d.collapsed" % os.getpid())
+        self.lock = Lock()
+
+    def should_profile(self, environ):
+        header = environ.get(self.HEADER)
+        secret = self.g.secrets.get("request_profiling")
+        if header and secret and constant_time_compare(header, secret):
+            return True
+
+        sample_rate = self.g.live_config["profile_sample_rate"]
+        return sample_rate > 0 and random.random() < sample_rate
+
+    def __call__(self, environ, start_response):
+        if not self.should_profile(environ):
+            return self.app(environ, start_response)
+
+        self.profiler.start()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            samples = self.profiler.stop()
+            self.record(environ, samples)
+
+    def record(self, environ, samples):
+        if not samples:
+            return
+
+        routes_dict = environ.get("pylons.routes_dict") or {}
+        route = "%s.%s" % (routes_dict.get("controller"),
+                           routes_dict.get("action"))
+        lines = collapse_samples(samples, root=route)
+
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+
+        samples_by_category = Counter()
+        for stack, count in samples.iteritems():
+            samples_by_category[sample_category(stack)] += count
+        for category, count in samples_by_category.iteritems():
+            self.g.stats.simple_event(
+                "request_profile.%s" % category, delta=count)
+
+
 class DomainMiddleware(object):
 
     def __init__(self, app, config):
@@ -533,6 +606,15 @@ def make_app(global_conf, full_stack=True, **app_conf):
     if profile_directory:
         app = ProfilingMiddleware(app, profile_directory)
 
+    samples_directory = g.config.get('profile_samples_directory')
+    if samples_directory:
+        app = SamplingProfilerMiddleware(
+            app,
+            samples_directory,
+            interval=g.profile_sample_interval_ms / 1000.,
+            g=g,
+        )
+
     app = DomainListingMiddleware(app)
     app = SubredditMiddleware(app)
     app = ExtensionMiddleware(app)
@@ -39,7 +39,7 @@ from r2.lib.menus import TimeMenu, CommentsTimeMenu, SortMenu, RecSortMenu, Prof
 from r2.lib.menus import ControversyTimeMenu, ProfileOverviewTimeMenu, menu, QueryButton
 from r2.lib.rising import get_rising, normalized_rising
 from r2.lib.wrapped import Wrapped
-from r2.lib.normalized_hot import normalized_hot
+from r2.lib.normalized_hot import NormalizedHotListing
 from r2.lib.db.thing import Query, Merge, Relations
 from r2.lib.db import queries
 from r2.lib.strings import Score
@@ -92,6 +92,10 @@ class ListingController(RedditController):
     # to figure it out based on the query type
     builder_cls = None
 
+    # whether the builder can skip items by their keep_unwrapped. must be
+    # turned off if keep_fn keeps items that keep_item wouldn't
+    prefilter = True
+
     # page title
     title_text = ''
 
@@ -205,6 +209,8 @@ class ListingController(RedditController):
             builder_cls = IDBuilder
         elif isinstance(self.query_obj, (CachedQuery, MergedCachedQuery)):
             builder_cls = IDBuilder
+        elif isinstance(self.query_obj, NormalizedHotListing):
+            builder_cls = IDBuilder
 
         builder = builder_cls(
             self.query_obj,
@@ -217,6 +223,7 @@ class ListingController(RedditController):
             sr_detail=self.sr_detail,
             wrap=self.builder_wrapper,
             prewrap_fn=self.prewrap_fn(),
+            prefilter=self.prefilter,
         )
         return builder
 
@@ -524,10 +531,11 @@ class HotController(ListingWithPromos):
     def query(self):
         if isinstance(c.site, DefaultSR):
             sr_ids = Subreddit.user_subreddits(c.user)
-            return normalized_hot(sr_ids)
+            return NormalizedHotListing(sr_ids)
         elif isinstance(c.site, MultiReddit):
-            return normalized_hot(c.site.kept_sr_ids, obey_age_limit=False,
-                                  ageweight=c.site.ageweight)
+            return NormalizedHotListing(c.site.kept_sr_ids,
+                                        obey_age_limit=False,
+                                        ageweight=c.site.ageweight)
         else:
             sticky_fullnames = c.site.get_sticky_fullnames()
             if sticky_fullnames:
@@ -717,6 +725,8 @@ class AdsController(SubredditListingController):
     where = 'ads'
     builder_cls = CampaignBuilder
     title_text = _('promoted links')
+    # keep_fn doesn't hide spam from logged out users like keep_item does
+    prefilter = False
 
     @property
     def infotext(self):
@@ -802,6 +812,8 @@ class UserController(ListingController):
     render_cls = ProfilePage
     show_nums = False
     skip = True
+    # keep_fn doesn't check keep_item, so e.g. deleted promoted links stay
+    prefilter = False
 
     @property
     def menus(self):
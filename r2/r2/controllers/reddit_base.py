@@ -651,7 +651,8 @@ def ratelimit_agent(agent, limit=10, slice_size=10):
 
     slice_size = min(slice_size, 60)
     time_slice = ratelimit.get_timeslice(slice_size)
-    usage = ratelimit.record_usage("rl-agent-" + hashed_agent, time_slice)
+    usage = ratelimit.record_usage(
+        "rl-agent-" + hashed_agent, time_slice, exact=False)
     if usage > limit:
         request.environ['retry_after'] = time_slice.remaining
         abort(429)
@@ -945,7 +946,7 @@ class MinimalController(BaseController):
         time_slice = ratelimit.get_timeslice(period)
 
         try:
-            recent_reqs = ratelimit.record_usage(key, time_slice)
+            recent_reqs = ratelimit.record_usage(key, time_slice, exact=False)
         except ratelimit.RatelimitError as e:
             # Ratelimiting is non-critical; if the system is
             # having issues, just skip adding the headers
@@ -993,6 +994,7 @@ class MinimalController(BaseController):
         baseplate_integration.start_root_span(span_name=key)
 
         c.response_wrapper = None
+        c.wrap_contexts = None
         c.start_time = datetime.now(g.tz)
         c.request_timer.start()
         g.reset_caches()
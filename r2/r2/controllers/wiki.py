@@ -435,6 +435,12 @@ class WikiApiController(WikiController):
                 except ContentLengthError as e:
                     self.handle_error(403, 'CONTENT_LENGTH_ERROR', max_length=e.max_length)
 
+                # warm the AutoModerator cache with the compiled rules, unless
+                # the edit was merged into something other than what we parsed
+                if (page.name == "config/automoderator" and
+                        page.content == content):
+                    rules.cache(page)
+
                 # continue storing the special pages as data attributes on the subreddit
                 # object. TODO: change this to minimize subreddit get sizes.
                 if page.special and page.name in ATTRIBUTE_BY_PAGE:
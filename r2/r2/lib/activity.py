@@ -0,0 +1,189 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Send visitor activity to the activity service off the request path.
+
+Page views record activity into an in-process buffer that's sent on to the
+service from a background thread, and the counts shown on pages are cached
+in-process for a few seconds.
+
+"""
+
+import atexit
+import os
+import threading
+import time
+
+from thrift.protocol.TProtocol import TProtocolException
+from thrift.Thrift import TApplicationException
+from thrift.transport.TTransport import TTransportException
+
+from r2.lib.contrib.activity_thrift import ActivityService
+
+
+THRIFT_EXCEPTIONS = (
+    TApplicationException,
+    TProtocolException,
+    TTransportException,
+)
+
+# how often buffered activity is sent on to the service
+ACTIVITY_FLUSH_INTERVAL = 1.
+
+# a visitor is only sent once per context in this many seconds. the service
+# counts visitors for much longer than this so they stay counted
+ACTIVITY_DEDUPE_WINDOW = 60
+
+# activity recorded while this many visitors are already waiting is dropped
+MAX_PENDING_ACTIVITY = 10000
+
+# how long activity counts are reused for
+ACTIVITY_COUNT_TTL = 10
+MAX_CACHED_COUNTS = 10000
+
+
+class ActivityBuffer(object):
+    def __init__(self, pool, stats, log):
+        self.pool = pool
+        self.stats = stats
+        self.log = log
+        self.lock = threading.Lock()
+        self.pending = set()
+        # (context_id, visitor_id) -> when it was last sent
+        self.recently_sent = {}
+        self.flusher = None
+        self.flusher_pid = None
+        atexit.register(self.flush)
+
+    def _ensure_flusher(self):
+        # threads don't survive forking so each process starts its own
+        if self.flusher_pid == os.getpid():
+            return
+
+        self.flusher_pid = os.getpid()
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(ACTIVITY_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception("failed to flush visitor activity")
+
+    def record(self, context_id, visitor_id):
+        """Save a visit to be sent to the activity service."""
+        self._ensure_flusher()
+
+        visit = (context_id, visitor_id)
+        cutoff = time.time() - ACTIVITY_DEDUPE_WINDOW
+        with self.lock:
+            if (visit in self.pending or
+                    self.recently_sent.get(visit, 0) > cutoff):
+                self.stats.simple_event("activity.deduplicated")
+                return
+
+            if len(self.pending) >= MAX_PENDING_ACTIVITY:
+                self.stats.simple_event("activity.dropped")
+                return
+
+            self.pending.add(visit)
+
+    def flush(self):
+        """Send everything recorded since the last flush."""
+        with self.lock:
+            pending, self.pending = self.pending, set()
+
+        # there's no gauge type, so record the buffer depth as a timing
+        # to get its distribution
+        self.stats.simple_timing("activity.buffer_depth", len(pending))
+        if not pending:
+            return
+
+        try:
+            with self.pool.connection() as prot:
+                # record_activity is oneway so this doesn't wait on replies
+                client = ActivityService.Client(prot)
+                for context_id, visitor_id in pending:
+                    client.record_activity(context_id, visitor_id)
+        except THRIFT_EXCEPTIONS as e:
+            self.log.warning("failed to send visitor activity: %r", e)
+            self.stats.simple_event("activity.dropped", delta=len(pending))
+            return
+
+        self.stats.simple_event("activity.sent", delta=len(pending))
+
+        now = time.time()
+        cutoff = now - ACTIVITY_DEDUPE_WINDOW
+        with self.lock:
+            self.recently_sent = {visit: sent
+                                  for visit, sent
+                                  in self.recently_sent.iteritems()
+                                  if sent > cutoff}
+            self.recently_sent.update(dict.fromkeys(pending, now))
+
+
+class ActivityCountCache(object):
+    """Reuse activity counts for a few seconds within the process."""
+
+    def __init__(self):
+        # context_id -> (expiration, ActivityInfo)
+        self.counts = {}
+
+    def get(self, context_ids, count_multi):
+        """Return context_id -> activity, calling count_multi for the misses.
+
+        count_multi takes a list of context ids and returns activity for
+        them the same way the service's count_activity_multi does.
+
+        """
+
+        now = time.time()
+        activity_by_id = {}
+        missing = []
+        for context_id in context_ids:
+            cached = self.counts.get(context_id)
+            if cached and cached[0] > now:
+                activity_by_id[context_id] = cached[1]
+            else:
+                missing.append(context_id)
+
+        if missing:
+            fetched = count_multi(missing)
+            activity_by_id.update(fetched)
+
+            if len(self.counts) >= MAX_CACHED_COUNTS:
+                self.counts = {context_id: cached
+                               for context_id, cached
+                               in self.counts.items()
+                               if cached[0] > now}
+                if len(self.counts) >= MAX_CACHED_COUNTS:
+                    self.counts = {}
+
+            expiration = now + ACTIVITY_COUNT_TTL
+            for context_id in missing:
+                self.counts[context_id] = (expiration, fetched.get(context_id))
+
+        return {context_id: activity
+                for context_id, activity in activity_by_id.iteritems()
+                if activity is not None}
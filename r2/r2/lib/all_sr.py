@@ -21,14 +21,37 @@
 ###############################################################################
 
 from collections import Counter
+import heapq
+import itertools
 
 from pylons import app_globals as g
 
+from r2.lib.bucketed_set import BucketedSet
+from r2.lib.db import packed_listing
 from r2.lib.db.operators import not_
+from r2.lib.utils import in_chunks, UniqueIterator
 
 CACHE_KEY = "all:hot"
 NUM_LINKS = 10000
 
+# the listing is stored in chunks so that each run only rewrites the chunks
+# that changed since the last one
+CHUNK_SIZE = 1000
+NUM_CHUNKS = NUM_LINKS // CHUNK_SIZE
+CHUNK_PREFIX = CACHE_KEY + ":"
+SR_IDS_KEY = CACHE_KEY + ":srids"
+
+# subreddits that had links submitted recently are recorded in hourly buckets
+# so new communities are considered even before they're popular
+ACTIVE_BUCKET_SECONDS = 60 * 60
+ACTIVE_BUCKETS = 24
+ACTIVE_SHARDS = 4
+active_srs = BucketedSet("all:active:", ACTIVE_BUCKET_SECONDS, ACTIVE_BUCKETS,
+                         num_shards=ACTIVE_SHARDS)
+
+# how many subreddits' hot listings to fetch from the permacache at once
+FETCH_CHUNK_SIZE = 500
+
 
 def get_all_query(sort, time):
     """ Return a Query for r/all links sorted by anything other than Hot, which
@@ -55,35 +78,133 @@ def get_all_hot_ids():
     """ Return a list of Link fullnames sorted by Hot and reshuffled for
     diversity."""
     # this is populated by write_all_hot_cache below from a separate job
-    link_ids = g.gencache.get(CACHE_KEY, [], stale=True)
-    return link_ids
+    chunks = g.gencache.get_multi(
+        range(NUM_CHUNKS), prefix=CHUNK_PREFIX, stale=True)
 
+    if 0 not in chunks:
+        # written by the builder before it stored the listing in chunks
+        return g.gencache.get(CACHE_KEY, [], stale=True)
 
-def write_all_hot_cache():
-    from r2.models.link import Link
-    from r2.lib.db import queries
+    link_ids = []
+    for i in xrange(NUM_CHUNKS):
+        if i not in chunks:
+            break
+        link_ids.extend(chunks[i])
 
-    q = Link._query(
-        sort=queries.db_sort('hot'),
-        limit=NUM_LINKS,
-    )
+    # the chunks aren't written atomically so a link that just moved from
+    # one to another can briefly show up in both
+    return list(UniqueIterator(link_ids))
+
+
+def mark_active(sr_id):
+    """Record that a link was just submitted to the subreddit."""
+    active_srs.add([sr_id])
+
+
+def get_active_sr_ids():
+    # if some were missed they'll still be considered once they're popular,
+    # so there's nothing better to fall back to
+    bucket = active_srs.bucket()
+    sr_ids, complete = active_srs.get(bucket - ACTIVE_BUCKETS, bucket)
+    return {int(sr_id) for sr_id in sr_ids}
+
+
+def get_candidate_sr_ids():
+    """Return the ids of subreddits that could have links in r/all hot.
+
+    That's the popular subreddits, the ones that had links in the last run,
+    and any that had links submitted recently.
+
+    """
+
+    from r2.models import NamedGlobals
+
+    sr_ids = get_active_sr_ids()
+    sr_ids.update(g.gencache.get(SR_IDS_KEY, allow_local=False) or [])
+    sr_ids.update(NamedGlobals.get("popular_sr_ids", []))
+    sr_ids.update(NamedGlobals.get("popular_over_18_sr_ids", []))
+    return sr_ids
+
+
+def _iter_hot_tuples(listing, sr_id):
+    # heapq.merge sorts from smallest to largest so hot is negated
+    fullnames, (hots, timestamps) = packed_listing.columns(
+        listing, limit=NUM_LINKS)
+    for fullname, hot in itertools.izip(fullnames, hots):
+        yield (-hot, sr_id, fullname)
+
+
+def get_hot_tuples(sr_ids):
+    """Return the hottest (-hot, sr_id, fullname) tuples of the subreddits.
+
+    The tuples come from the subreddits' precomputed hot listings, fetched
+    FETCH_CHUNK_SIZE subreddits at a time. At most NUM_LINKS are returned.
+
+    """
+
+    from r2.lib.db.queries import _get_links, CachedResults
+
+    top = []
+    for chunk in in_chunks(sorted(sr_ids), FETCH_CHUNK_SIZE):
+        queries_by_sr_id = {sr_id: _get_links(sr_id, sort='hot', time='all')
+                            for sr_id in chunk}
+        CachedResults.fetch_multi(queries_by_sr_id.values(), stale=True)
+
+        iterators = [_iter_hot_tuples(q.data, sr_id)
+                     for sr_id, q in queries_by_sr_id.iteritems() if q.data]
+        merged = heapq.merge(top, *iterators)
+        top = list(itertools.islice(merged, NUM_LINKS))
+
+    return top
+
+
+def write_chunks(link_ids):
+    """Store link_ids in CACHE_KEY's chunks, skipping unchanged ones."""
+    chunks = {i: link_ids[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE]
+              for i in xrange(NUM_CHUNKS)}
+    old_chunks = g.gencache.get_multi(
+        chunks.keys(), prefix=CHUNK_PREFIX, allow_local=False)
+
+    changed = {i: chunk for i, chunk in chunks.iteritems()
+               if chunk and old_chunks.get(i) != chunk}
+    removed = [CHUNK_PREFIX + str(i) for i, chunk in chunks.iteritems()
+               if not chunk and i in old_chunks]
+
+    if changed:
+        g.gencache.set_multi(changed, prefix=CHUNK_PREFIX)
+    if removed:
+        g.gencache.delete_multi(removed)
+
+    g.stats.simple_event("all_hot.chunks.written", delta=len(changed))
+    g.stats.simple_event(
+        "all_hot.chunks.unchanged", delta=NUM_CHUNKS - len(changed))
+
+
+def write_all_hot_cache():
+    """Rebuild the r/all hot listing from the subreddits' hot listings."""
+    sr_ids = get_candidate_sr_ids()
+    hot_tuples = [(-neg_hot, sr_id, fullname)
+                  for neg_hot, sr_id, fullname in get_hot_tuples(sr_ids)]
 
-    top_links = resort_links(list(q))
-    link_ids = [link._fullname for link in top_links]
+    top_links = resort_links(hot_tuples)
+    link_ids = [fullname for hot, sr_id, fullname in top_links]
 
-    g.gencache.set(CACHE_KEY, link_ids)
+    write_chunks(link_ids)
+    g.gencache.set(SR_IDS_KEY, sorted({sr_id for hot, sr_id, fullname
+                                       in hot_tuples}))
 
     return link_ids
 
 
 def resort_links(top_links):
-    """ Reshuffle links based on the number of appearances of each community.
-    Each time a post from a community appears, the hotness of the next post
-    will be lowered slightly. target_penalty is the approximate number of
-    places to push a following post down the list. """
+    """ Reshuffle (hot, sr_id, fullname) tuples based on the number of
+    appearances of each community. Each time a post from a community appears,
+    the hotness of the next post will be lowered slightly. target_penalty is
+    the approximate number of places to push a following post down the list.
+    """
 
     sr_counts = Counter()
-    new_hotness = {}
+    new_hotness = []
 
     target_penalty = g.live_config['r_all_penalty']
 
@@ -97,12 +218,12 @@ def resort_links(top_links):
 
     # take the hotness between the first post, called base, and a post
     # target_penalty places later, called target
-    base = top_links[0]._hot
-    target = top_links[target_penalty]._hot
+    base = top_links[0][0]
+    target = top_links[target_penalty][0]
 
-    for link in top_links:
-        count = sr_counts[link.sr_id]
-        sr_counts[link.sr_id] += 1
+    for hot, sr_id, fullname in top_links:
+        count = sr_counts[sr_id]
+        sr_counts[sr_id] += 1
 
         # m: the algebra that led to the final line
         # m: pf = (target / base) / (target / base - 1)
@@ -116,9 +237,9 @@ def resort_links(top_links):
         penalty = target / (target - (target - base) * count)
 
         # apply the penalty
-        new_hotness[link._id] = link._hot * penalty
+        new_hotness.append(hot * penalty)
 
-    new_links = sorted(top_links,
-                       key=lambda link: new_hotness[link._id],
-                       reverse=True)
-    return list(new_links)
+    order = sorted(xrange(len(top_links)),
+                   key=lambda i: new_hotness[i],
+                   reverse=True)
+    return [top_links[i] for i in order]
@@ -26,6 +26,7 @@ There are three main ways of interacting with this module:
 add_item: Adds a single item to a queue*
 handle_items: For processing multiple items from a queue
 consume_items: For processing a queue one item at a time
+consume_batches: For processing batches from a queue on a pool of threads
 
 
 * _add_item (the internal function for adding items to amqp that are
@@ -33,15 +34,17 @@ consume_items: For processing a queue one item at a time
   while trying to get a connection to amqp.
 
 """
-from Queue import Queue
+from Queue import Empty, Queue
 from threading import local, Thread
 from datetime import datetime
 import os
+import select
 import sys
 import time
 import errno
 import socket
 import itertools
+import copy
 import cPickle as pickle
 
 from amqplib import client_0_8 as amqp
@@ -354,6 +357,281 @@ def handle_items(queue, callback, ack=True, limit=1, min_size=0,
             raise
 
 
+def _get_thread_objects():
+    """Return the pylons objects registered for the current thread.
+
+    Worker threads need these registered before they can run code that uses
+    `g`, `c` and friends.
+
+    """
+
+    import pylons
+    from pylons.util import AttribSafeContextObj
+
+    proxies = (
+        pylons.app_globals,
+        pylons.config,
+        pylons.request,
+        pylons.translator,
+        pylons.url,
+    )
+
+    objects = []
+    for proxy in proxies:
+        try:
+            objects.append((proxy, proxy._current_obj()))
+        except TypeError:
+            # nothing registered, the worker won't have it either
+            continue
+
+    try:
+        context = pylons.tmpl_context._current_obj()
+    except TypeError:
+        context = AttribSafeContextObj()
+    objects.append((pylons.tmpl_context, context))
+
+    return objects
+
+
+class _BatchWorker(Thread):
+    """A thread that processes batches of messages for consume_batches.
+
+    Messages are read from `items` in the order they were delivered, and as
+    many as are already waiting (up to `batch_size`) are handed to the
+    callback together. The outcome for each message is put onto `finished`
+    as (msg, success) so the consuming thread can ack or reject it.
+
+    """
+
+    def __init__(self, queue, callback, batch_size, finished, thread_objects,
+                 verbose):
+        Thread.__init__(self, name="%s-worker" % queue)
+        self.setDaemon(True)
+        self.queue = queue
+        self.callback = callback
+        self.batch_size = batch_size
+        self.finished = finished
+        self.thread_objects = thread_objects
+        self.verbose = verbose
+        self.items = Queue()
+
+    def run(self):
+        import pylons
+
+        for proxy, obj in self.thread_objects:
+            if proxy is pylons.tmpl_context:
+                # each worker gets its own copy of `c` so per-batch state
+                # like use_write_db isn't shared between threads
+                obj = copy.copy(obj)
+            proxy._push_object(obj)
+
+        running = True
+        while running:
+            batch = [self.items.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.items.get_nowait())
+                except Empty:
+                    break
+
+            if None in batch:
+                # we've been told to stop, finish what came before that
+                batch = batch[:batch.index(None)]
+                running = False
+
+            if batch:
+                self._process(batch)
+
+    def _call(self, msgs):
+        from pylons import tmpl_context as c
+
+        cfg.reset_caches()
+        c.use_write_db = {}
+        self.callback(msgs)
+
+    def _process(self, batch):
+        start = time.time()
+        for msg in batch:
+            cfg.stats.transact("amqp.%s.local_wait" % self.queue,
+                               msg.received_time, start)
+
+        if self.verbose:
+            print "%s: %d items" % (self.queue, len(batch))
+
+        try:
+            self._call(batch)
+        except Exception:
+            if len(batch) == 1:
+                cfg.log.exception("%s: failed to process message", self.queue)
+                self.finished.put((batch[0], False))
+                return
+        else:
+            for msg in batch:
+                self.finished.put((msg, True))
+            sys.stdout.flush()
+            return
+
+        # something in the batch is bad. retry the messages one at a time
+        # so only the ones that actually fail get rejected.
+        for msg in batch:
+            try:
+                self._call([msg])
+            except Exception:
+                cfg.log.exception("%s: failed to process message", self.queue)
+                self.finished.put((msg, False))
+            else:
+                self.finished.put((msg, True))
+        sys.stdout.flush()
+
+
+def _wait_for_delivery(chan, timeout):
+    """Return whether chan.wait() has something to read within timeout."""
+    # amqplib may have already read the next frame off the socket
+    transport = chan.connection.transport
+    if chan.method_queue or getattr(transport, "_read_buffer", None):
+        return True
+
+    readable, _, _ = select.select([transport.sock], [], [], timeout)
+    return bool(readable)
+
+
+class _BatchConsumer(object):
+    # how long to wait for a delivery before acking what the workers finished
+    SETTLE_INTERVAL = 0.1
+
+    def __init__(self, queue, callback, key_fn, prefetch_count, workers,
+                 batch_size, requeue_failed, verbose):
+        self.queue = queue
+        self.key_fn = key_fn
+        self.prefetch_count = prefetch_count
+        self.requeue_failed = requeue_failed
+        self.event_name = "amqp.%s" % queue
+        self.in_flight = 0
+        self.finished = Queue()
+
+        thread_objects = _get_thread_objects()
+        self.workers = [
+            _BatchWorker(queue, callback, batch_size, self.finished,
+                         thread_objects, verbose)
+            for i in xrange(workers)
+        ]
+        self.next_worker = itertools.cycle(self.workers)
+
+    def _dispatch(self, msg):
+        key = self.key_fn(msg) if self.key_fn else None
+        if key is None:
+            worker = next(self.next_worker)
+        else:
+            # messages with the same key always go to the same worker, which
+            # handles them in the order they were delivered
+            worker = self.workers[hash(key) % len(self.workers)]
+
+        msg.received_time = time.time()
+        self.in_flight += 1
+        worker.items.put(msg)
+
+    def _settle(self, chan, block=False):
+        """Ack or reject messages the workers have finished with."""
+        while self.in_flight:
+            try:
+                # time out periodically so KeyboardInterrupt gets through
+                msg, success = self.finished.get(block=block, timeout=1)
+            except Empty:
+                if block:
+                    continue
+                return
+
+            self.in_flight -= 1
+            block = False
+
+            if success:
+                chan.basic_ack(msg.delivery_tag)
+                cfg.stats.event_count(self.event_name, "ack")
+                continue
+
+            # only requeue a message once so one that always fails can't be
+            # retried forever
+            requeue = (self.requeue_failed and
+                       not msg.delivery_info.get("redelivered"))
+            chan.basic_reject(msg.delivery_tag, requeue=requeue)
+            if requeue:
+                cfg.stats.event_count(self.event_name, "requeue")
+            else:
+                cfg.log.warning("%s: dropping failed message %r",
+                                self.queue, msg.body[:1000])
+                cfg.stats.event_count(self.event_name, "reject")
+
+    def run(self):
+        chan = connection_manager.get_channel()
+        chan.basic_qos(
+            prefetch_size=0,
+            prefetch_count=self.prefetch_count,
+            a_global=False,
+        )
+
+        for batch_worker in self.workers:
+            batch_worker.start()
+
+        chan.basic_consume(queue=self.queue, callback=self._dispatch)
+
+        try:
+            while chan.callbacks:
+                try:
+                    self._settle(chan)
+
+                    # the broker won't send anything more until we ack, so
+                    # wait for the workers instead of the channel
+                    if self.in_flight >= self.prefetch_count:
+                        self._settle(chan, block=True)
+                    elif not self.in_flight:
+                        chan.wait()
+                    elif _wait_for_delivery(chan, self.SETTLE_INTERVAL):
+                        chan.wait()
+                except KeyboardInterrupt:
+                    break
+        finally:
+            for batch_worker in self.workers:
+                batch_worker.items.put(None)
+
+            if chan.is_open:
+                while self.in_flight:
+                    self._settle(chan, block=True)
+
+            worker.join()
+            if chan.is_open:
+                chan.close()
+
+
+def consume_batches(queue, callback, key_fn=None, prefetch_count=100,
+                    workers=4, batch_size=10, requeue_failed=False,
+                    verbose=True):
+    """Process messages from a queue on a pool of worker threads.
+
+    Messages are received with basic.consume, with up to `prefetch_count` of
+    them unacknowledged at once. They are spread over `workers` threads, each
+    of which calls `callback` with a list of up to `batch_size` messages.
+    Unlike handle_items the callback isn't given the channel: only the
+    consuming thread may talk to it.
+
+    If `key_fn` is given it is called with each message and messages that
+    get the same (non-None) key are always processed in delivery order by
+    the same thread. Messages are acked or rejected one at a time once
+    they've been processed. If a batch fails its messages are retried one
+    at a time and only the ones that fail again are rejected. Rejected
+    messages are logged and dropped, unless `requeue_failed` is set, in
+    which case they're requeued once before being dropped.
+
+    Callbacks should be decorated with g.stats.amqp_processor to record
+    their service time. Acks, rejects and the time messages spend waiting
+    for a worker are recorded here.
+
+    """
+
+    consumer = _BatchConsumer(queue, callback, key_fn, prefetch_count,
+                              workers, batch_size, requeue_failed, verbose)
+    consumer.run()
+
+
 def empty_queue(queue):
     """debug function to completely erase the contents of a queue"""
     chan = connection_manager.get_channel()
@@ -49,6 +49,7 @@ from r2.config import queues
 import r2.lib.amqp
 from r2.lib.baseplate_integration import R2BaseplateObserver
 from r2.lib.cache import (
+    BoundedLocalCache,
     CacheChain,
     CL_ONE,
     CL_QUORUM,
@@ -56,13 +57,14 @@ from r2.lib.cache import (
     HardCache,
     HardcacheChain,
     LocalCache,
+    LRUCache,
     Mcrouter,
     MemcacheChain,
     Permacache,
-    SelfEmptyingCache,
     StaleCacheChain,
     TransitionalCache,
 )
+from r2.lib.activity import ActivityBuffer, ActivityCountCache
 from r2.lib.configparse import ConfigValue, ConfigValueParser
 from r2.lib.contrib import ipaddress
 from r2.lib.contrib.activity_thrift import ActivityService
@@ -74,6 +76,7 @@ from r2.lib.plugin import PluginLoader
 from r2.lib.providers import select_provider
 from r2.lib.stats import (
     CacheStats,
+    LRUCacheStats,
     StaleCacheStats,
     Stats,
     StatsCollectingConnectionPool,
@@ -183,6 +186,8 @@ class Globals(object):
             'MIN_RATE_LIMIT_KARMA',
             'MIN_RATE_LIMIT_COMMENT_KARMA',
             'HOT_PAGE_AGE',
+            'rising_links_per_subreddit',
+            'voted_filter_max_votes',
             'ADMIN_COOKIE_TTL',
             'ADMIN_COOKIE_MAX_IDLE',
             'OTP_COOKIE_TTL',
@@ -231,6 +236,16 @@ class Globals(object):
             'promo_sr_id',
             'default_access_token_ttl',
             'target_display_max',
+            'amqp_consumer_workers',
+            'vote_batch_size',
+            'ratelimit_flush_interval_ms',
+            'ratelimit_local_overshoot',
+            'inprocess_cache_size',
+            'inprocess_cache_max_mb',
+            'inprocess_cache_time',
+            'comment_tree_index_cache_size',
+            'comment_tree_index_cache_max_mb',
+            'profile_sample_interval_ms',
         ],
 
         ConfigValue.float: [
@@ -264,6 +279,7 @@ class Globals(object):
             'trust_local_proxies',
             'shard_link_vote_queues',
             'shard_commentstree_queues',
+            'comment_tree_deltas',
             'authnet_validate',
             'ENFORCE_RATELIMIT',
             'RL_SITEWIDE_ENABLED',
@@ -390,6 +406,8 @@ class Globals(object):
             'mobile_gild_first_login',
             'precomputed_comment_suggested_sort',
             'robin_heavy_load',
+            'packed_listings',
+            'voted_filter',
         ],
         ConfigValue.int: [
             'captcha_exempt_comment_karma',
@@ -416,6 +434,7 @@ class Globals(object):
             'spotlight_interest_nosub_p',
             'gold_revenue_goal',
             'invalid_key_sample_rate',
+            'profile_sample_rate',
             'events_collector_vote_sample_rate',
             'events_collector_loid_sample_rate',
             'events_collector_poison_sample_rate',
@@ -804,6 +823,35 @@ class Globals(object):
         else:
             stalecaches = None
 
+        # stale reads can also be answered from memory shared by all of this
+        # process's requests, in front of the stalecache if there is one.
+        if self.inprocess_cache_size:
+            self.inprocess_cache = LRUCache(
+                max_size=self.inprocess_cache_size,
+                max_bytes=self.inprocess_cache_max_mb * 1024 * 1024,
+                max_time=self.inprocess_cache_time,
+            )
+            self.inprocess_cache.stats = LRUCacheStats(self.stats, "inprocess")
+
+            if stalecaches:
+                stalecaches = CacheChain((self.inprocess_cache, stalecaches))
+            else:
+                stalecaches = self.inprocess_cache
+        else:
+            self.inprocess_cache = None
+
+        # flattened comment trees, see CommentTreeIndex
+        if self.comment_tree_index_cache_size:
+            self.comment_tree_index_cache = LRUCache(
+                max_size=self.comment_tree_index_cache_size,
+                max_bytes=self.comment_tree_index_cache_max_mb * 1024 * 1024,
+                pickle_values=False,
+            )
+            self.comment_tree_index_cache.stats = LRUCacheStats(
+                self.stats, "comment_tree_index")
+        else:
+            self.comment_tree_index_cache = None
+
         # hardcache memcache pool
         hardcache_memcaches = CMemcache(
             "hardcache",
@@ -825,6 +873,8 @@ class Globals(object):
 
         ################# THRIFT-BASED SERVICES
         activity_endpoint = self.config.get("activity_endpoint")
+        self.activity_buffer = None
+        self.activity_counts = ActivityCountCache()
         if activity_endpoint:
             # make ActivityInfo objects rendercache-key friendly
             # TODO: figure out a more general solution for this if
@@ -834,6 +884,8 @@ class Globals(object):
             activity_pool = ThriftConnectionPool(activity_endpoint, timeout=0.1)
             self.baseplate.add_to_context("activity_service",
                 ThriftContextFactory(activity_pool, ActivityService.Client))
+            self.activity_buffer = ActivityBuffer(
+                activity_pool, self.stats, self.log)
 
         self.startup_timer.intermediate("thrift")
 
@@ -869,7 +921,7 @@ class Globals(object):
         # to cache_chains (closed around by reset_caches) so that they
         # can properly reset their local components
         cache_chains = {}
-        localcache_cls = (SelfEmptyingCache if self.running_as_script
+        localcache_cls = (BoundedLocalCache if self.running_as_script
                           else LocalCache)
 
         if stalecaches:
@@ -1009,7 +1061,7 @@ class Globals(object):
         # Initialize the amqp module globals, start the worker, etc.
         r2.lib.amqp.initialize(self)
 
-        self.events = EventQueue()
+        self.events = EventQueue(self.stats, self.log)
 
         self.startup_timer.intermediate("revisions")
 
@@ -37,10 +37,11 @@ support exists for up to two additional RuleTargets, one for the item's
 author, and another for the parent link (if the original item was a comment).
 """
 
-from collections import namedtuple
+from collections import deque, namedtuple
 from datetime import datetime
 from hashlib import md5
 import re
+import time
 import traceback
 import yaml
 import json
@@ -48,7 +49,7 @@ import json
 from pylons import app_globals as g
 
 from r2.lib import amqp
-from r2.lib.db import queries
+from r2.lib.db import queries, tdb_cassandra
 from r2.lib.errors import RedditError
 from r2.lib.filters import _force_unicode
 from r2.lib.menus import CommentSortMenu
@@ -91,6 +92,11 @@ DISCLAIMER = "*I am a bot, and this action was performed automatically. Please [
 
 rules_by_subreddit = {}
 
+# parsed Rulesets are shared between processes through the cache, bump this
+# whenever a change to the classes here would make old pickles invalid
+RULESET_CACHE_VERSION = 1
+RULESET_CACHE_TIME = 24 * 60 * 60
+
 unnumbered_placeholders_regex = re.compile(r"\{\{(match(?:-[^\d-]+?)?)\}\}")
 match_placeholders_regex = re.compile(r"\{\{match-(?:([^}]+?)-)?(\d+)\}\}")
 def replace_placeholders(string, data, matches):
@@ -191,15 +197,183 @@ class AutoModeratorRuleTypeError(AutoModeratorSyntaxError):
 RuleDefinition = namedtuple("RuleDefinition", ["yaml", "values"])
 
 
+class LiteralIndex(object):
+    """An Aho-Corasick automaton that finds which of many literals occur.
+
+    Each literal added is given an integer id, and after build() has been
+    called, search() finds the ids of all the literals occurring anywhere in
+    a string with a single pass over it.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.transitions = [{}]
+        self.fallbacks = [0]
+        self.outputs = [set()]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, literal):
+        """Add a literal to the index and return its id."""
+        if literal in self.ids:
+            return self.ids[literal]
+
+        literal_id = len(self.ids)
+        self.ids[literal] = literal_id
+
+        state = 0
+        for char in literal:
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions.append({})
+                self.fallbacks.append(0)
+                self.outputs.append(set())
+                self.transitions[state][char] = next_state
+            state = next_state
+        self.outputs[state].add(literal_id)
+
+        return literal_id
+
+    def build(self):
+        """Link every state to the longest proper suffix also in the trie."""
+        queue = deque(self.transitions[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].iteritems():
+                queue.append(next_state)
+
+                fallback = self.fallbacks[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fallbacks[fallback]
+                fallback = self.transitions[fallback].get(char, 0)
+
+                self.fallbacks[next_state] = fallback
+                self.outputs[next_state] |= self.outputs[fallback]
+
+    def search(self, text):
+        """Return the set of ids of the literals that occur in text."""
+        found = set()
+        transitions = self.transitions
+        fallbacks = self.fallbacks
+        outputs = self.outputs
+
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = fallbacks[state]
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found |= outputs[state]
+
+        return found
+
+
+class RulePrefilter(object):
+    """Discards rules whose required literals don't occur in an item.
+
+    Every non-regex search check must find one of its values in one of its
+    fields for a rule to be satisfied, so all of those values are added to a
+    pair of LiteralIndexes (one case-sensitive, one not) shared by the whole
+    Ruleset. Each field is then only scanned once per item, and any rule with
+    a check where none of the values occur can be skipped without running
+    its regexes.
+    """
+    def __init__(self, rules):
+        self.indexes = {
+            True: LiteralIndex(),
+            False: LiteralIndex(),
+        }
+        self.requirements = {}
+
+        for rule in rules:
+            requirements = []
+            for target_key, target in rule.targets.iteritems():
+                for fields, case_sensitive, values in (
+                        target.required_literals):
+                    index = self.indexes[case_sensitive]
+                    if not case_sensitive:
+                        values = [value.lower() for value in values]
+                    literal_ids = frozenset(
+                        index.add(value) for value in values)
+                    requirements.append((target_key, target, fields,
+                        case_sensitive, literal_ids))
+
+            if requirements:
+                self.requirements[rule] = requirements
+
+        for index in self.indexes.itervalues():
+            index.build()
+
+    def __len__(self):
+        return len(self.requirements)
+
+    def search_field(self, target, item, data, field, case_sensitive):
+        """Return the ids of literals found in the field, or None if unknown."""
+        try:
+            value = target.get_field_value_from_item(item, data, field)
+        except Exception:
+            # leave it to the rule itself to deal with unusual items, its
+            # other checks may mean it never looks at this field at all
+            return None
+
+        if not isinstance(value, unicode):
+            # the regexes match bytestrings byte by byte, so only ascii ones
+            # can be safely compared against the unicode literals
+            try:
+                value = str(value).decode("ascii")
+            except UnicodeError:
+                return None
+
+        if not case_sensitive:
+            value = value.lower()
+
+        return self.indexes[case_sensitive].search(value)
+
+    def can_match(self, rule, item, data, found):
+        """Return whether all the rule's required literals could be found.
+
+        found is a dict for caching search results between the rules being
+        checked against the same item.
+        """
+        for target_key, target, fields, case_sensitive, literal_ids in (
+                self.requirements.get(rule, ())):
+            target_item = rule.get_target_item(item, data, target_key)
+
+            for field in fields:
+                # ignore_blockquotes is the only setting that affects the
+                # value of a field, so targets can otherwise share results
+                key = (target_key, field, target.ignore_blockquotes,
+                    case_sensitive)
+                if key not in found:
+                    found[key] = self.search_field(
+                        target, target_item, data, field, case_sensitive)
+
+                if found[key] is None or found[key] & literal_ids:
+                    break
+            else:
+                return False
+
+        return True
+
+
 class Ruleset(object):
     """A subreddit's collection of Rules."""
-    def __init__(self, yaml_text="", timer=None):
-        """Create a collection of Rules from YAML documents."""
+    def __init__(self, yaml_text="", timer=None, standards_wp=None):
+        """Create a collection of Rules from YAML documents.
+
+        `standards_wp` is the already loaded wiki page of standard rules, it's
+        fetched here if needed and not passed in.
+
+        """
         if timer is None:
             timer = SimpleSillyStub()
 
         self.init_time = datetime.now(g.tz)
         self.rules = []
+        # whether rules were left out because the standards didn't load
+        self.missing_standards = False
+        self.prefilter = RulePrefilter(self.rules)
 
         if not yaml_text:
             return
@@ -231,8 +405,10 @@ class Ruleset(object):
             # load standard rules from wiki page
             standard_rules = {}
             try:
-                wp = WikiPage.get(Frontpage, "automoderator_standards")
-                standard_defs = yaml.safe_load_all(wp.content)
+                if standards_wp is None:
+                    standards_wp = WikiPage.get(
+                        Frontpage, "automoderator_standards")
+                standard_defs = yaml.safe_load_all(standards_wp.content)
                 for standard_def in standard_defs:
                     name = standard_def.pop("standard")
                     standard_rules[name] = standard_def
@@ -248,6 +424,7 @@ class Ruleset(object):
             if standard_name:
                 # error while loading the standards, skip this rule
                 if standard_rules is None:
+                    self.missing_standards = True
                     continue
 
                 standard_values = None
@@ -292,6 +469,61 @@ class Ruleset(object):
 
         self.rules.sort(key=lambda r: r.priority, reverse=True)
 
+        self.prefilter = RulePrefilter(self.rules)
+        timer.intermediate("init_prefilter")
+
+    @classmethod
+    def _cache_key(cls, wp, standards_wp):
+        standards_revision = getattr(standards_wp, "revision", None)
+        return "automoderator_ruleset-%s-%s-%s-%s" % (
+            RULESET_CACHE_VERSION, wp._id, wp.revision, standards_revision)
+
+    @classmethod
+    def from_wiki_page(cls, wp, timer=None):
+        """Return the Ruleset for the current revision of a wiki page.
+
+        Rulesets are cached by the revisions of the page and of the standard
+        rules, so the YAML only needs to be parsed, the standard rules loaded
+        and the prefilter built once per edit rather than once per process.
+        The regexes aren't saved by this: compiled patterns are pickled as
+        their source and compiled again when loaded.
+        """
+        if timer is None:
+            timer = SimpleSillyStub()
+
+        if not getattr(wp, "revision", None):
+            return cls(wp.content, timer)
+
+        try:
+            standards_wp = WikiPage.get(Frontpage, "automoderator_standards")
+        except tdb_cassandra.NotFound:
+            standards_wp = None
+        timer.intermediate("get_standards_page")
+
+        rules = g.gencache.get(cls._cache_key(wp, standards_wp))
+        if rules is not None:
+            g.stats.simple_event("automoderator.ruleset_cache.hit")
+            timer.intermediate("get_cached_ruleset")
+            return rules
+
+        g.stats.simple_event("automoderator.ruleset_cache.miss")
+        rules = cls(wp.content, timer, standards_wp)
+        rules.cache(wp, standards_wp)
+        return rules
+
+    def cache(self, wp, standards_wp):
+        """Store the Ruleset as the parsed version of the wiki pages.
+
+        Rulesets that are missing rules because the standards couldn't be
+        loaded aren't stored, so they're built again once they can be.
+
+        """
+        if self.missing_standards:
+            return
+
+        g.gencache.set(self._cache_key(wp, standards_wp), self,
+                       time=RULESET_CACHE_TIME)
+
     def __iter__(self):
         """Iterate over the rules in the collection."""
         for rule in self.rules:
@@ -328,8 +560,28 @@ class Ruleset(object):
         if check_reason == "new_report":
             rules = [rule for rule in rules if rule.is_for_reported]
 
+        rules = [rule for rule in rules if rule.item_is_correct_type(item)]
+
         return rules
 
+    def check_rule(self, rule, item, data, found):
+        """Return whether the item satisfies the rule, timing the check."""
+        if not self.prefilter.can_match(rule, item, data, found):
+            g.stats.simple_event("automoderator.prefiltered_rule")
+            return False
+
+        start = time.time()
+        try:
+            return rule.check_item(item, data)
+        finally:
+            rule.record_check_time(time.time() - start)
+
+    def slowest_rules(self, count=3):
+        """Return the rules that have spent the most time being checked."""
+        rules = [rule for rule in self if rule.check_count]
+        rules.sort(key=lambda r: r.check_time, reverse=True)
+        return rules[:count]
+
     def apply_to_item(self, item, check_reason):
         # fetch supplemental data to use throughout
         data = {}
@@ -356,15 +608,18 @@ class Ruleset(object):
         nonremoval_rules = self.filter_rules(
             self.nonremoval_rules, item, check_reason)
 
+        # search results for the prefilter, shared by all the rules
+        found = {}
+
         # stop checking removal rules as soon as one triggers
         for rule in removal_rules:
-            if rule.check_item(item, data):
+            if self.check_rule(rule, item, data, found):
                 rule.perform_actions(item, data)
                 break
 
         # check all other rules, regardless of how many trigger
         for rule in nonremoval_rules:
-            if rule.check_item(item, data):
+            if self.check_rule(rule, item, data, found):
                 rule.perform_actions(item, data)
 
 
@@ -616,6 +871,7 @@ class RuleTarget(object):
         self.set_values(values)
 
         # determine patterns that will be matched against fields
+        self.required_literals = []
         self.match_patterns = self.get_match_patterns(values)
         self.matches = {}
 
@@ -752,6 +1008,15 @@ class RuleTarget(object):
             # cast all values to strings in case any numbers were included
             match_values = [unicode(val) for val in match_values]
 
+            # every match modifier requires one of the values to occur
+            # somewhere in the field, so unless this is a regex or a negated
+            # check the values can be used by the Ruleset's prefilter
+            if ("regex" not in parsed_key["modifiers"] and
+                    parsed_key["match_success"] and all(match_values)):
+                case_sensitive = "case-sensitive" in parsed_key["modifiers"]
+                self.required_literals.append(
+                    (parsed_key["fields"], case_sensitive, match_values))
+
             # escape regex special chars unless this is a regex
             if "regex" not in parsed_key["modifiers"]:
                 match_values = [re.escape(val) for val in match_values]
@@ -1232,6 +1497,10 @@ class Rule(object):
 
         self.unique_id = md5(self.yaml.encode("utf-8")).hexdigest()
 
+        # total time spent checking items against the rule
+        self.check_count = 0
+        self.check_time = 0.
+
         self.checks = set()
         self.actions = set()
 
@@ -1438,6 +1707,12 @@ class Rule(object):
 
         return True
 
+    def record_check_time(self, elapsed):
+        """Record how long (in seconds) checking an item took."""
+        self.check_count += 1
+        self.check_time += elapsed
+        g.stats.simple_timing("automoderator.check_rule", elapsed * 1000)
+
     def perform_actions(self, item, data):
         """Execute all the rule's actions against the item."""
         for key, target in self.targets.iteritems():
@@ -1577,15 +1852,20 @@ def run():
                 timer = g.stats.get_timer("automoderator.init_ruleset")
                 timer.start()
 
+                # a cached Ruleset may have been built long ago, so note
+                # the time before fetching the page to compare edits against
+                init_time = datetime.now(g.tz)
+
                 wp = WikiPage.get(subreddit, "config/automoderator")
                 timer.intermediate("get_wiki_page")
 
                 try:
-                    rules = Ruleset(wp.content, timer)
+                    rules = Ruleset.from_wiki_page(wp, timer)
                 except (AutoModeratorSyntaxError, AutoModeratorRuleTypeError):
                     print "ERROR: Invalid config in /r/%s" % subreddit.name
                     return
 
+                rules.init_time = init_time
                 rules_by_subreddit[subreddit._id] = rules
 
                 timer.stop()
@@ -1598,6 +1878,9 @@ def run():
                 print "Checked %s from /r/%s" % (item, subreddit.name)
             except TimeoutFunctionException:
                 print "Timed out on %s from /r/%s" % (item, subreddit.name)
+                for rule in rules.slowest_rules():
+                    print "  rule %s: %d checks in %.3fs" % (
+                        rule.unique_id, rule.check_count, rule.check_time)
             except KeyboardInterrupt:
                 raise
             except:
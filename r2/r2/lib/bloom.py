@@ -0,0 +1,75 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""A compact, serializable bloom filter for set membership tests.
+
+A bloom filter can say a key is definitely not in the set or that it might
+be, with a false positive rate that depends on how full it is. It's sized for
+a capacity up front and gets less accurate as it's filled past that.
+
+"""
+
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    def __init__(self, num_bits, num_hashes, capacity, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.capacity = capacity
+        self.bits = bytearray(bits or (num_bits + 7) // 8)
+        self.count = count
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """Return an empty filter sized to hold capacity keys."""
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(int(round(num_bits / float(capacity) * math.log(2))), 1)
+        return cls(num_bits, num_hashes, capacity)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def to_tuple(self):
+        return (self.num_bits, self.num_hashes, self.capacity, str(self.bits),
+                self.count)
+
+    @classmethod
+    def from_tuple(cls, data):
+        num_bits, num_hashes, capacity, bits, count = data
+        return cls(num_bits, num_hashes, capacity, bits=bits, count=count)
@@ -0,0 +1,129 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+"""Sets of recently marked values, kept in the cache in time buckets.
+
+Writers append to the current bucket and periodic jobs read back the
+buckets they haven't seen yet. Each bucket is split over several shards so
+that a busy one doesn't run into memcached's item size limit.
+
+"""
+
+import time
+from zlib import crc32
+
+from pylons import app_globals as g
+
+from r2.lib.cache import MemcachedError
+
+
+class BucketedSet(object):
+    """A set of strings added to over time and read back by time range.
+
+    Each process only appends a member once per bucket. If an append fails
+    the bucket is marked as incomplete, so readers know to fall back to
+    something that doesn't depend on it.
+
+    """
+
+    def __init__(self, prefix, bucket_seconds, num_buckets, num_shards=1):
+        self.prefix = prefix
+        self.bucket_seconds = bucket_seconds
+        self.num_shards = num_shards
+        self.ttl = bucket_seconds * (num_buckets + 1)
+
+        # members this process has already appended to the current bucket
+        self.added_bucket = None
+        self.added = set()
+
+    def bucket(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        return int(timestamp) // self.bucket_seconds
+
+    def _key(self, bucket, shard):
+        return "%s%d:%d" % (self.prefix, bucket, shard)
+
+    def _incomplete_key(self, bucket):
+        return "%s%d:incomplete" % (self.prefix, bucket)
+
+    def add(self, members):
+        bucket = self.bucket()
+        if bucket != self.added_bucket:
+            self.added_bucket = bucket
+            self.added = set()
+        added = self.added
+
+        members_by_shard = {}
+        for member in members:
+            member = str(member)
+            if member in added:
+                continue
+            shard = crc32(member) % self.num_shards
+            members_by_shard.setdefault(shard, set()).add(member)
+
+        for shard, shard_members in members_by_shard.iteritems():
+            key = self._key(bucket, shard)
+            value = "".join(member + "," for member in shard_members)
+            try:
+                g.gencache.add(key, "", time=self.ttl)
+                # memcached refuses the append if the value would be too big
+                # or the key was evicted since the add
+                appended = g.gencache.append(key, value)
+            except MemcachedError:
+                appended = False
+
+            if appended is False:
+                self._mark_incomplete(bucket)
+            else:
+                added.update(shard_members)
+
+    def _mark_incomplete(self, bucket):
+        g.stats.simple_event("bucketed_set.append_failed")
+        try:
+            g.gencache.set(self._incomplete_key(bucket), True, time=self.ttl)
+        except MemcachedError:
+            g.log.warning("Couldn't mark %s%d as incomplete",
+                          self.prefix, bucket)
+
+    def get(self, first_bucket, last_bucket):
+        """Return (members, complete) for the buckets in the range.
+
+        `complete` is False if some of the members may be missing.
+
+        """
+
+        buckets = range(first_bucket, last_bucket + 1)
+        keys = [self._key(bucket, shard)
+                for bucket in buckets for shard in xrange(self.num_shards)]
+        incomplete_keys = [self._incomplete_key(bucket) for bucket in buckets]
+        values = g.gencache.get_multi(keys + incomplete_keys,
+                                      allow_local=False)
+
+        members = set()
+        for key in keys:
+            value = values.get(key)
+            if value:
+                members.update(member for member in value.split(",")
+                               if member)
+
+        complete = not any(key in values for key in incomplete_keys)
+        return members, complete
@@ -20,13 +20,15 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from threading import local
+from collections import OrderedDict
+from threading import local, Lock
 from hashlib import md5
 import cPickle as pickle
 from copy import copy
 from curses.ascii import isgraph
 import logging
-from time import sleep
+import sys
+from time import sleep, time as current_time
 import zlib
 import snappy
 import simplejson as json
@@ -1025,6 +1027,11 @@ class Permacache(object):
         self._backend_set(key, value, format=format)
         self.cache_chain.delete(key)
 
+    def pessimistically_set_multi(self, keys, format=None):
+        """Like pessimistically_set, but for many keys in one batch."""
+        self._backend_set_multi(keys, format=format)
+        self.cache_chain.delete_multi(keys.keys())
+
     def get_multi(self, keys, prefix='', allow_local=True, stale=False):
         call_fn = lambda k: self.simple_get_multi(k, allow_local=allow_local,
                                                   stale=stale)
@@ -1135,23 +1142,211 @@ def test_multi(cache):
     for thread in threads:
         thread.join()
 
-# a cache that occasionally dumps itself to be used for long-running
-# processes
-class SelfEmptyingCache(LocalCache):
+class BoundedLocalCache(OrderedDict, LocalCache):
+    """A LocalCache that evicts its least recently used keys past max_size.
+
+    Scripts don't reset their local caches between requests, so this keeps
+    them from growing forever without throwing the whole working set away
+    at once.
+
+    """
+
     def __init__(self, max_size=10*1000):
         self.max_size = max_size
+        OrderedDict.__init__(self)
+
+    def __setitem__(self, key, value):
+        # re-inserting moves the key to the most recently used end
+        if key in self:
+            OrderedDict.__delitem__(self, key)
+        OrderedDict.__setitem__(self, key, value)
+
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+    def get(self, key, default=None):
+        r = dict.get(self, key)
+        if r is None:
+            return default
+        self[key] = r
+        return r
+
+    def simple_get_multi(self, keys):
+        out = LocalCache.simple_get_multi(self, keys)
+        for k, v in out.iteritems():
+            self[k] = v
+        return out
+
+    def __repr__(self):
+        return "<BoundedLocalCache(%d)>" % (len(self),)
+
+
+class LRUCache(CacheUtils):
+    """A size-bounded in-process cache that lives across requests.
+
+    Entries expire after the `time` they were set with, but never later than
+    `max_time` seconds if that's set, and the least recently used ones are
+    evicted once there are more than `max_size` of them or, if `max_bytes` is
+    set, once their values add up to more than that. Values are stored
+    pickled so every reader gets its own copy, which makes it safe to share
+    between request threads.
+
+    With `pickle_values` off the values themselves are stored and handed to
+    every reader, so they must never be modified once they're cached. Their
+    size is what sys.getsizeof says, so values that own more memory than
+    that should define __sizeof__.
+
+    Anything that would modify an entry in place just drops it instead.
+
+    """
+
+    def __init__(self, max_size=10*1000, max_bytes=None, max_time=0,
+                 pickle_values=True):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self.pickle_values = pickle_values
+        self.stats = None
+        self.lock = Lock()
+        # key -> (expiration timestamp or 0, size, stored value)
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size_bytes -= entry[1]
+        return entry
+
+    def _get(self, key, now):
+        entry = self._pop(key)
+        if not entry:
+            return None
+
+        expiration, size, data = entry
+        if expiration and expiration <= now:
+            return None
 
-    def maybe_reset(self):
-        if len(self) > self.max_size:
-            self.clear()
+        # put it back at the most recently used end
+        self.entries[key] = entry
+        self.size_bytes += size
+        return data
+
+    def _store(self, key, entry):
+        self._pop(key)
+        self.entries[key] = entry
+        self.size_bytes += entry[1]
+
+    def _evict(self):
+        evicted = 0
+        while self.entries and (len(self.entries) > self.max_size or
+                (self.max_bytes and self.size_bytes > self.max_bytes)):
+            key, entry = self.entries.popitem(last=False)
+            self.size_bytes -= entry[1]
+            evicted += 1
+        return evicted
+
+    def _expiration(self, time):
+        if self.max_time:
+            time = min(time or self.max_time, self.max_time)
+        return current_time() + time if time else 0
+
+    def _entry(self, val, expiration):
+        if self.pickle_values:
+            data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+            return (expiration, len(data), data)
+        return (expiration, sys.getsizeof(val), val)
+
+    def _load(self, data):
+        if self.pickle_values:
+            return pickle.loads(data)
+        return data
+
+    def get(self, key, default=None):
+        return self.simple_get_multi([key]).get(key, default)
+
+    def simple_get_multi(self, keys):
+        keys = list(keys)
+        now = current_time()
+        found = {}
+        with self.lock:
+            for key in keys:
+                data = self._get(key, now)
+                if data is not None:
+                    found[key] = data
+
+        if self.stats:
+            self.stats.cache_hit(len(found))
+            self.stats.cache_miss(len(keys) - len(found))
+
+        return {key: self._load(data) for key, data in found.iteritems()}
 
     def set(self, key, val, time=0):
-        self.maybe_reset()
-        return LocalCache.set(self,key,val,time)
+        self.set_multi({key: val}, time=time)
+
+    def set_multi(self, keys, prefix='', time=0):
+        expiration = self._expiration(time)
+        entries = {prefix + str(key): self._entry(val, expiration)
+                   for key, val in keys.iteritems()}
+
+        with self.lock:
+            for key, entry in entries.iteritems():
+                self._store(key, entry)
+            evicted = self._evict()
+
+        if evicted and self.stats:
+            self.stats.cache_eviction(evicted)
 
     def add(self, key, val, time=0):
-        self.maybe_reset()
-        return LocalCache.add(self, key, val)
+        entry = self._entry(val, self._expiration(time))
+
+        with self.lock:
+            if self._get(key, current_time()) is not None:
+                return False
+            self._store(key, entry)
+            evicted = self._evict()
+
+        if evicted and self.stats:
+            self.stats.cache_eviction(evicted)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def delete_multi(self, keys):
+        with self.lock:
+            for key in keys:
+                self._pop(key)
+
+    def incr(self, key, delta=1, time=0):
+        self.delete(key)
+
+    def decr(self, key, amt=1):
+        self.delete(key)
+
+    def append(self, key, val, time=0):
+        self.delete(key)
+
+    def prepend(self, key, val, time=0):
+        self.delete(key)
+
+    def replace(self, key, val, time=0):
+        self.delete(key)
+
+    def flush_all(self):
+        with self.lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def reset(self):
+        self.flush_all()
+
+    def __repr__(self):
+        return "<LRUCache(%d)>" % (len(self),)
 
 
 def _make_hashable(s):
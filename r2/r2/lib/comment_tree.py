@@ -20,12 +20,18 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from array import array
 from collections import defaultdict
-from itertools import chain
+from itertools import chain, izip
 
 from pylons import tmpl_context as c
 from pylons import app_globals as g
 
+from r2.lib.db.sorts import (
+    confidence_batch,
+    controversy_batch,
+    score_batch,
+)
 from r2.lib.sgm import sgm
 from r2.lib.utils import tup
 from r2.models.comment_tree import CommentTree
@@ -54,15 +60,16 @@ def add_comments(comments):
 
         # write scores before CommentTree because the scores must exist for all
         # comments in the tree
-        for sort in ("_controversy", "_confidence", "_score"):
-            scores_by_comment = {
-                comment._id36: getattr(comment, sort)
-                for comment in link_comments
-            }
-            CommentScoresByLink.set_scores(link, sort, scores_by_comment)
-
-        scores_by_comment = _get_qa_comment_scores(link, link_comments)
-        CommentScoresByLink.set_scores(link, "_qa", scores_by_comment)
+        id36s = [comment._id36 for comment in link_comments]
+        ups = array("l", [comment._ups for comment in link_comments])
+        downs = array("l", [comment._downs for comment in link_comments])
+        scores_by_sort = {
+            "_controversy": dict(izip(id36s, controversy_batch(ups, downs))),
+            "_confidence": dict(izip(id36s, confidence_batch(ups, downs))),
+            "_score": dict(izip(id36s, score_batch(ups, downs))),
+        }
+        scores_by_sort["_qa"] = _get_qa_comment_scores(link, link_comments)
+        CommentScoresByLink.set_scores_multi(link, scores_by_sort)
         timer.intermediate('scores')
 
         CommentTree.add_comments(link, link_comments)
@@ -102,14 +109,14 @@ def _get_qa_comment_scores(link, comments):
             all_child_cids.extend(child_cids)
     all_child_comments = Comment._byID(all_child_cids, data=True)
 
-    comment_sorter = {}
-    for comment in comments:
-        child_cids = cid_tree.get(comment._id, ())
-        child_comments = (all_child_comments[cid] for cid in child_cids)
-        sort_value = comment._qa(child_comments, responder_ids)
-        comment_sorter[comment._id36] = sort_value
-
-    return comment_sorter
+    children_lists = [
+        [all_child_comments[cid] for cid in cid_tree.get(comment._id, ())]
+        for comment in comments
+    ]
+    scores = Comment._qa_multi(comments, children_lists, responder_ids)
+    return {
+        comment._id36: score for comment, score in izip(comments, scores)
+    }
 
 
 def get_comment_scores(link, sort, comment_ids, timer):
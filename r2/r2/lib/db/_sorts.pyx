@@ -24,10 +24,16 @@ import math
 from datetime import datetime, timedelta
 from pylons import app_globals as g
 
+from cpython cimport array
+import array
+
 
 cdef extern from "math.h":
     double log10(double)
     double sqrt(double)
+    double floor(double)
+    double fabs(double)
+    double copysign(double, double)
 
 epoch = datetime(1970, 1, 1, tzinfo = g.tz)
 
@@ -44,10 +50,41 @@ cpdef long score(long ups, long downs):
 cpdef double hot(long ups, long downs, date):
     return _hot(ups, downs, epoch_seconds(date))
 
+cdef inline double _round7(double x):
+    """Return round(x, 7) without calling into Python in the common case.
+
+    Python rounds the exact value of x to 7 decimal places (halfway cases away
+    from zero) and converts the result back to the nearest double. Dividing
+    the correctly rounded integer by 1e7 gives the same double. x * 1e7 is
+    only accurate to about 1e-4 at the magnitudes allowed here, so values
+    close to a halfway case are left to Python.
+
+    """
+
+    cdef double y = x * 1e7
+    cdef double whole, frac
+
+    if not fabs(y) < 1e12:
+        # too large to be accurate, or inf/nan
+        return round(x, 7)
+
+    whole = floor(y)
+    frac = y - whole
+    if fabs(frac - 0.5) < 1e-3:
+        return round(x, 7)
+    elif frac > 0.5:
+        whole += 1
+
+    if whole == 0:
+        # keep the sign of zero like round() does
+        return copysign(0.0, x)
+    return whole / 1e7
+
 cpdef double _hot(long ups, long downs, double date):
     """The hot formula. Should match the equivalent function in postgres."""
-    s = score(ups, downs)
-    order = log10(max(abs(s), 1))
+    cdef long s = score(ups, downs)
+    cdef double order = log10(max(abs(s), 1))
+    cdef double sign, seconds
     if s > 0:
         sign = 1
     elif s < 0:
@@ -55,7 +92,7 @@ cpdef double _hot(long ups, long downs, double date):
     else:
         sign = 0
     seconds = date - 1134028003
-    return round(sign * order + seconds / 45000, 7)
+    return _round7(sign * order + seconds / 45000)
 
 cpdef double controversy(long ups, long downs):
     """The controversy sort."""
@@ -86,18 +123,22 @@ cpdef double _confidence(int ups, int downs):
 
 cdef int up_range = 400
 cdef int down_range = 100
-cdef list _confidences = []
+cdef double _confidences[400 * 100]
 for ups in xrange(up_range):
     for downs in xrange(down_range):
-        _confidences.append(_confidence(ups, downs))
-def confidence(int ups, int downs):
+        _confidences[downs + ups * down_range] = _confidence(ups, downs)
+
+cdef inline double _cached_confidence(int ups, int downs):
     if ups + downs == 0:
         return 0
-    elif ups < up_range and downs < down_range:
+    elif 0 <= ups < up_range and 0 <= downs < down_range:
         return _confidences[downs + ups * down_range]
     else:
         return _confidence(ups, downs)
 
+def confidence(int ups, int downs):
+    return _cached_confidence(ups, downs)
+
 cpdef double qa(int question_ups, int question_downs, int question_length,
                 op_children):
     """The Q&A-type sort.
@@ -130,3 +171,81 @@ cpdef double _qa(double question_score, int question_length,
     # Add together the weighting from the scores and lengths, but emphasize
     # score more.
     return score_modifier + (length_modifier / 5)
+
+
+# Batch versions of the sorts. These take equal length arrays (anything
+# supporting the buffer protocol: array.array, numpy arrays, ...) with C longs
+# for vote counts and doubles for epoch seconds/scores, and return an
+# array.array("d") of results. They use the same code as the scalar versions
+# so results are identical, but avoid a Python call per item.
+
+cdef array.array _double_template = array.array("d")
+cdef array.array _long_template = array.array("l")
+
+
+cdef _check_lengths(Py_ssize_t n, lengths):
+    for length in lengths:
+        if length != n:
+            raise ValueError("batch inputs must all be the same length")
+
+
+def score_batch(long[:] ups, long[:] downs):
+    cdef Py_ssize_t i, n = ups.shape[0]
+    _check_lengths(n, (downs.shape[0],))
+    cdef array.array ret = array.clone(_long_template, n, zero=False)
+    cdef long[:] out = ret
+    for i in range(n):
+        out[i] = score(ups[i], downs[i])
+    return ret
+
+
+def hot_batch(long[:] ups, long[:] downs, double[:] dates):
+    """The hot sort for many items. dates are in epoch seconds."""
+    cdef Py_ssize_t i, n = ups.shape[0]
+    _check_lengths(n, (downs.shape[0], dates.shape[0]))
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+    for i in range(n):
+        out[i] = _hot(ups[i], downs[i], dates[i])
+    return ret
+
+
+def controversy_batch(long[:] ups, long[:] downs):
+    cdef Py_ssize_t i, n = ups.shape[0]
+    _check_lengths(n, (downs.shape[0],))
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+    for i in range(n):
+        out[i] = controversy(ups[i], downs[i])
+    return ret
+
+
+def confidence_batch(long[:] ups, long[:] downs):
+    cdef Py_ssize_t i, n = ups.shape[0]
+    _check_lengths(n, (downs.shape[0],))
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+    for i in range(n):
+        out[i] = _cached_confidence(ups[i], downs[i])
+    return ret
+
+
+def qa_batch(double[:] question_scores, long[:] question_lengths,
+             double[:] answer_scores, long[:] answer_lengths):
+    """The Q&A sort for many items.
+
+    Takes the confidence scores and body lengths of each question and its best
+    OP answer (see `qa`). Questions without an answer should have an answer
+    score of 0 and an answer length of 1.
+
+    """
+
+    cdef Py_ssize_t i, n = question_scores.shape[0]
+    _check_lengths(n, (question_lengths.shape[0], answer_scores.shape[0],
+                       answer_lengths.shape[0]))
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+    for i in range(n):
+        out[i] = _qa(question_scores[i], question_lengths[i],
+                     answer_scores[i], answer_lengths[i])
+    return ret
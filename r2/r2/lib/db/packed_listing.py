@@ -0,0 +1,531 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+"""Compact storage format for precomputed listings.
+
+CachedResults used to store each listing as a pickled list of
+``(fullname, sortval1[, sortval2, ...])`` tuples. Unpickling that list and
+rebuilding it on every mutation is expensive for busy listings, so listings
+are now stored as parallel arrays (packed thing ids plus one column of doubles
+per sort value) that are only decoded when accessed.
+
+Layout of a version 1 listing (all values little-endian):
+
+    header    "RLS", uint8 version, uint32 count, uint8 ncols, uint8 nprefixes
+    coltypes  ncols bytes, "i" for integer columns and "d" for float columns
+    prefixes  nprefixes * (uint8 length, prefix) e.g. "t3"
+    kinds     count uint8 indexes into prefixes, omitted if nprefixes == 1
+    ids       count uint64 thing ids
+    columns   ncols * count float64 sort values, stored column by column
+
+Legacy lists of tuples are still understood everywhere a listing is read.
+
+"""
+
+import struct
+import sys
+from array import array
+
+from r2.lib.utils import to36
+
+
+MAGIC = "RLS"
+VERSION = 1
+_HEADER = struct.Struct("<3sBIBB")
+_BIG_ENDIAN = sys.byteorder == "big"
+# the largest integer that survives a round trip through a double
+_MAX_EXACT_INT = 2 ** 53
+_MAX_PREFIXES = 255
+
+
+def is_packed(value):
+    return isinstance(value, str) and value[:len(MAGIC)] == MAGIC
+
+
+def load(value):
+    """Return a readable listing for a value stored in the permacache.
+
+    The result is either a PackedListing or a legacy list of tuples; both
+    support len(), indexing and iteration over row tuples.
+
+    """
+
+    if not value:
+        return []
+    elif isinstance(value, PackedListing):
+        return value
+    elif is_packed(value):
+        return PackedListing.from_string(value)
+    return value
+
+
+def dump(rows):
+    """Serialize rows for the permacache.
+
+    Rows that can't be represented in the packed format (non-numeric sort
+    values, unusual fullnames) are stored as a legacy list of tuples.
+
+    """
+
+    if isinstance(rows, PackedListing):
+        return rows.to_string()
+
+    rows = list(rows)
+    try:
+        return PackedListing.from_rows(rows).to_string()
+    except ValueError:
+        return rows
+
+
+def columns(listing, limit=None):
+    """Return (fullnames, [column, ...]) for the first `limit` rows.
+
+    Works with either storage format but only avoids building row tuples for
+    packed listings.
+
+    """
+
+    if isinstance(listing, PackedListing):
+        return listing.fullnames(limit), listing.columns(limit)
+
+    rows = listing[:limit] if limit is not None else listing
+    if not rows:
+        return [], []
+    transposed = zip(*rows)
+    return list(transposed[0]), [list(col) for col in transposed[1:]]
+
+
+def _split_fullname(fullname):
+    prefix, sep, id36 = str(fullname).partition("_")
+    if not sep or not prefix or not id36:
+        raise ValueError("can't pack fullname %r" % (fullname,))
+
+    try:
+        thing_id = int(id36, 36)
+    except ValueError:
+        raise ValueError("can't pack fullname %r" % (fullname,))
+
+    # make sure we'll produce the exact same fullname when unpacking
+    if to36(thing_id) != id36:
+        raise ValueError("can't pack fullname %r" % (fullname,))
+
+    return prefix, thing_id
+
+
+def _check_value(value):
+    if isinstance(value, float):
+        return "d"
+    elif isinstance(value, (int, long)):
+        if abs(value) > _MAX_EXACT_INT:
+            raise ValueError("can't pack sort value %r" % (value,))
+        return "i"
+    raise ValueError("can't pack sort value %r" % (value,))
+
+
+class PackedListing(object):
+    """A listing of (fullname, sortval...) rows stored as parallel arrays.
+
+    Rows are kept sorted in descending order of their sort values, the same
+    order CachedResults has always stored them in. The object behaves like the
+    legacy list of tuples for existing readers; hot paths should use
+    `fullnames` and `columns` which don't build a tuple per row.
+
+    """
+
+    def __init__(self, ncols=None):
+        self._raw = None
+        self._count = 0
+        self._ncols = ncols
+        self._coltypes = ["i"] * (ncols or 0)
+        self._prefixes = []
+        self._kinds = bytearray()
+        self._ids = []
+        self._columns = [array("d") for i in xrange(ncols or 0)]
+        self._names = None
+
+    @classmethod
+    def from_string(cls, raw):
+        magic, version, count, ncols, nprefixes = _HEADER.unpack_from(raw)
+        if magic != MAGIC:
+            raise ValueError("not a packed listing")
+        if version != VERSION:
+            raise ValueError("unknown packed listing version %d" % version)
+
+        listing = cls()
+        listing._raw = raw
+        listing._count = count
+        # an empty listing doesn't know its shape until rows are inserted
+        listing._ncols = ncols or None
+
+        offset = _HEADER.size
+        listing._coltypes = list(raw[offset:offset + ncols])
+        offset += ncols
+
+        prefixes = []
+        for i in xrange(nprefixes):
+            length = ord(raw[offset])
+            prefixes.append(raw[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        listing._prefixes = prefixes
+
+        # the remaining sections are decoded on demand
+        listing._kinds_offset = offset
+        if nprefixes > 1:
+            offset += count
+        listing._ids_offset = offset
+        offset += 8 * count
+        listing._columns_offset = offset
+        listing._kinds = None
+        listing._ids = None
+        listing._columns = [None] * ncols
+        return listing
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a listing from already sorted row tuples."""
+        rows = list(rows)
+        ncols = len(rows[0]) - 1 if rows else None
+        listing = cls(ncols=ncols)
+        for kind, thing_id, values in listing._parse_rows(rows):
+            listing._kinds.append(kind)
+            listing._ids.append(thing_id)
+            for col, value in zip(listing._columns, values):
+                col.append(value)
+        listing._count = len(listing._ids)
+        return listing
+
+    def _parse_rows(self, rows):
+        """Validate rows and convert them to (kind, id, values) triples.
+
+        This must be done before any mutation so that a row we can't pack
+        doesn't leave the listing half modified.
+
+        """
+
+        prefixes = list(self._prefixes)
+        coltypes = list(self._coltypes)
+        ncols = self._ncols
+        parsed = []
+
+        for row in rows:
+            if ncols is None:
+                ncols = len(row) - 1
+                coltypes = ["i"] * ncols
+            if len(row) - 1 != ncols or not ncols:
+                raise ValueError("can't pack row %r" % (row,))
+
+            prefix, thing_id = _split_fullname(row[0])
+            try:
+                kind = prefixes.index(prefix)
+            except ValueError:
+                if len(prefixes) >= _MAX_PREFIXES:
+                    raise ValueError("too many fullname prefixes")
+                kind = len(prefixes)
+                prefixes.append(prefix)
+
+            values = row[1:]
+            for i, value in enumerate(values):
+                if _check_value(value) == "d":
+                    coltypes[i] = "d"
+            parsed.append((kind, thing_id, tuple(float(v) for v in values)))
+
+        if self._ncols is None and ncols is not None:
+            self._ncols = ncols
+            self._columns = [array("d") for i in xrange(ncols)]
+        self._prefixes = prefixes
+        self._coltypes = coltypes
+        return parsed
+
+    def _get_kinds(self):
+        if self._kinds is None:
+            if len(self._prefixes) > 1:
+                start = self._kinds_offset
+                self._kinds = bytearray(self._raw[start:start + self._count])
+            else:
+                self._kinds = bytearray(self._count)
+        return self._kinds
+
+    def _get_ids(self):
+        if self._ids is None:
+            fmt = "<%dQ" % self._count
+            self._ids = list(struct.unpack_from(fmt, self._raw,
+                                                self._ids_offset))
+        return self._ids
+
+    def _get_column(self, i):
+        col = self._columns[i]
+        if col is None:
+            start = self._columns_offset + 8 * self._count * i
+            col = array("d")
+            col.fromstring(self._raw[start:start + 8 * self._count])
+            if _BIG_ENDIAN:
+                col.byteswap()
+            self._columns[i] = col
+        return col
+
+    def _load_all(self):
+        self._get_kinds()
+        self._get_ids()
+        for i in xrange(len(self._columns)):
+            self._get_column(i)
+        # once we start mutating, the raw string no longer describes us
+        self._raw = None
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def __iter__(self):
+        # build rows as they're needed, readers often stop early
+        for i in xrange(self._count):
+            yield self._row(i)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._row(i) for i in xrange(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("listing index out of range")
+        return self._row(index)
+
+    def __eq__(self, other):
+        if isinstance(other, PackedListing):
+            return self.to_string() == other.to_string()
+        return NotImplemented
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<PackedListing %d rows>" % self._count
+
+    def _row(self, i):
+        row = [self.fullname(i)]
+        for col_index, coltype in enumerate(self._coltypes):
+            value = self._get_column(col_index)[i]
+            row.append(int(value) if coltype == "i" else value)
+        return tuple(row)
+
+    def fullname(self, i):
+        """Return the fullname of row i."""
+        if self._names is not None:
+            return self._names[i]
+        prefix = self._prefixes[self._get_kinds()[i]]
+        return prefix + "_" + to36(self._get_ids()[i])
+
+    def fullnames(self, limit=None):
+        """Return the fullnames of the first `limit` rows."""
+        if self._names is not None:
+            return self._names[:limit] if limit is not None else self._names
+
+        kinds = self._get_kinds()
+        ids = self._get_ids()
+        if limit is not None:
+            kinds = kinds[:limit]
+            ids = ids[:limit]
+
+        if len(self._prefixes) == 1:
+            prefix = self._prefixes[0] + "_"
+            names = [prefix + to36(thing_id) for thing_id in ids]
+        else:
+            prefixes = [prefix + "_" for prefix in self._prefixes]
+            names = [prefixes[kind] + to36(thing_id)
+                     for kind, thing_id in zip(kinds, ids)]
+
+        if limit is None or limit >= self._count:
+            self._names = names
+        return names
+
+    def columns(self, limit=None):
+        """Return the sort value columns of the first `limit` rows.
+
+        Integer columns are converted back to lists of ints so rows match
+        what was originally inserted.
+
+        """
+
+        ret = []
+        for i, coltype in enumerate(self._coltypes):
+            col = self._get_column(i)
+            if limit is not None:
+                col = col[:limit]
+            if coltype == "i":
+                col = [int(value) for value in col]
+            ret.append(col)
+        return ret
+
+    def _key(self, i):
+        return tuple(col[i] for col in self._columns)
+
+    def _find(self, kind, thing_id):
+        ids = self._ids
+        kinds = self._kinds
+        start = 0
+        while True:
+            try:
+                i = ids.index(thing_id, start)
+            except ValueError:
+                return None
+            if kinds[i] == kind:
+                return i
+            start = i + 1
+
+    def _bisect(self, key):
+        """Return the position to insert `key` after any equal rows."""
+        lo, hi = 0, self._count
+        if len(self._columns) == 1:
+            col = self._columns[0]
+            value = key[0]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if value > col[mid]:
+                    hi = mid
+                else:
+                    lo = mid + 1
+        else:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if key > self._key(mid):
+                    hi = mid
+                else:
+                    lo = mid + 1
+        return lo
+
+    def _remove_at(self, i):
+        del self._kinds[i]
+        del self._ids[i]
+        for col in self._columns:
+            del col[i]
+        self._count -= 1
+
+    def _insert_at(self, i, kind, thing_id, key):
+        self._kinds.insert(i, kind)
+        self._ids.insert(i, thing_id)
+        for col, value in zip(self._columns, key):
+            col.insert(i, value)
+        self._count += 1
+
+    def truncate(self, limit):
+        if self._count <= limit:
+            return
+        self._load_all()
+        del self._kinds[limit:]
+        del self._ids[limit:]
+        for col in self._columns:
+            del col[limit:]
+        self._count = limit
+        self._names = None
+
+    def insert(self, rows, limit):
+        """Insert rows, replacing any existing rows for the same fullname.
+
+        Each row costs a binary search plus a splice of the underlying
+        arrays. If the listing is full, new rows that would sort below the
+        current last row are dropped since they'd be immediately truncated.
+
+        Raises ValueError without modifying the listing if any row can't be
+        packed.
+
+        """
+
+        parsed = self._parse_rows(rows)
+        if not parsed:
+            return
+
+        self._load_all()
+        self._names = None
+
+        # later rows for the same thing win
+        by_thing = {}
+        for kind, thing_id, key in parsed:
+            by_thing[(kind, thing_id)] = key
+
+        existing = {thing: self._find(*thing) for thing in by_thing}
+        num_new = sum(1 for i in existing.itervalues() if i is None)
+        would_truncate = self._count + num_new >= limit
+        if would_truncate and self._count:
+            smallest = self._key(self._count - 1)
+            by_thing = {thing: key for thing, key in by_thing.iteritems()
+                        if existing[thing] is not None or key >= smallest}
+
+        # remove from the back so earlier indexes stay valid
+        to_remove = sorted((existing[thing] for thing in by_thing
+                            if existing[thing] is not None), reverse=True)
+        for i in to_remove:
+            self._remove_at(i)
+
+        # keep the relative order that a stable sort of the new rows would
+        # produce for rows with equal sort values
+        for kind, thing_id, key in parsed:
+            if by_thing.get((kind, thing_id)) is not key:
+                continue
+            del by_thing[(kind, thing_id)]
+            self._insert_at(self._bisect(key), kind, thing_id, key)
+
+        self.truncate(limit)
+
+    def delete(self, fullnames):
+        """Remove rows by fullname, ignoring names that aren't present."""
+        self._load_all()
+        self._names = None
+
+        to_remove = []
+        for fullname in fullnames:
+            try:
+                prefix, thing_id = _split_fullname(fullname)
+            except ValueError:
+                continue
+            if prefix not in self._prefixes:
+                continue
+            i = self._find(self._prefixes.index(prefix), thing_id)
+            if i is not None:
+                to_remove.append(i)
+
+        for i in sorted(set(to_remove), reverse=True):
+            self._remove_at(i)
+
+    def to_string(self):
+        if self._raw is not None:
+            return self._raw
+
+        self._load_all()
+        ncols = len(self._columns)
+        count = self._count
+        parts = [
+            _HEADER.pack(MAGIC, VERSION, count, ncols, len(self._prefixes)),
+            "".join(self._coltypes),
+        ]
+        for prefix in self._prefixes:
+            parts.append(chr(len(prefix)))
+            parts.append(prefix)
+        if len(self._prefixes) > 1:
+            parts.append(str(self._kinds))
+        parts.append(struct.pack("<%dQ" % count, *self._ids))
+        for col in self._columns:
+            if _BIG_ENDIAN:
+                col = array("d", col)
+                col.byteswap()
+            parts.append(col.tostring())
+        return "".join(parts)
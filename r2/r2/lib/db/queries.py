@@ -35,17 +35,19 @@ from pylons import app_globals as g
 from pylons import tmpl_context as c
 from pylons import request
 
+from r2.lib import all_sr
 from r2.lib import amqp
 from r2.lib import filters
+from r2.lib import rising
 from r2.lib.comment_tree import add_comments
-from r2.lib.db import tdb_cassandra
+from r2.lib.db import packed_listing, tdb_cassandra
 from r2.lib.db.operators import and_, or_
 from r2.lib.db.operators import asc, desc, timeago
 from r2.lib.db.sorts import epoch_seconds
 from r2.lib.db.thing import Thing, Merge
 from r2.lib import utils
 from r2.lib.utils import in_chunks, is_subdomain, SimpleSillyStub
-from r2.lib.utils import fetch_things2, tup, UniqueIterator
+from r2.lib.utils import fetch_things2, tup, UniqueIterator, merge_sorted
 from r2.lib.voting import consume_vote_queue, prequeued_vote_key
 from r2.models import (
     Account,
@@ -76,7 +78,7 @@ from r2.models.query_cache import (
     ThingTupleComparator,
     UserQueryCache,
 )
-from r2.models.vote import Vote
+from r2.models.vote import Vote, VotedThingFilter
 
 
 precompute_limit = 1000
@@ -162,7 +164,7 @@ class CachedResults(object):
             stale=stale,
         )
         for cr in unfetched:
-            cr.data = cached.get(cr.iden) or []
+            cr.data = packed_listing.load(cached.get(cr.iden))
             cr._fetched = True
 
     def make_item_tuple(self, item):
@@ -207,14 +209,20 @@ class CachedResults(object):
         return True
 
     def _mutate(self, fn, willread=True):
-        self.data = g.permacache.mutate(
+        data = g.permacache.mutate(
             key=self.iden,
             mutation_fn=fn,
             default=[],
             willread=willread,
         )
+        self.data = packed_listing.load(data)
         self._fetched=True
 
+    def _dump(self, rows):
+        if g.live_config["packed_listings"]:
+            return packed_listing.dump(rows)
+        return list(rows)
+
     def insert(self, items):
         """Inserts the item into the cached data. This only works
            under certain criteria, see can_insert."""
@@ -222,37 +230,22 @@ class CachedResults(object):
 
     def _insert_tuples(self, tuples):
         def _mutate(data):
-            data = data or []
+            data = packed_listing.load(data)
             item_tuples = tuples or []
 
-            existing_fnames = {item[0] for item in data}
-            new_fnames = {item[0] for item in item_tuples}
-
-            mutated_length = len(existing_fnames.union(new_fnames))
-            would_truncate = mutated_length >= precompute_limit
-            if would_truncate and data:
-                # only insert items that are already stored or new items
-                # that are large enough that they won't be immediately truncated
-                # out of storage
-                # item structure is (name, sortval1[, sortval2, ...])
-                smallest = data[-1] if data else None
-                item_tuples = [item for item in item_tuples
-                               if (smallest is None or
-                                   item[0] in existing_fnames or
-                                   item[1:] >= smallest[1:])]
-
-            if not item_tuples:
-                return data
-
-            # insert the items, remove the duplicates (keeping the
-            # one being inserted over the stored value if applicable),
-            # and sort the result
-            data = filter(lambda x: x[0] not in new_fnames, data)
-            data.extend(item_tuples)
-            data.sort(reverse=True, key=lambda x: x[1:])
-            if len(data) > precompute_limit:
-                data = data[:precompute_limit]
-            return data
+            if g.live_config["packed_listings"]:
+                try:
+                    if not isinstance(data, packed_listing.PackedListing):
+                        data = packed_listing.PackedListing.from_rows(data)
+                    data.insert(item_tuples, precompute_limit)
+                except ValueError:
+                    # something in here can't be packed, fall back to the
+                    # old format
+                    pass
+                else:
+                    return data.to_string()
+
+            return _insert_tuples_legacy(list(data), item_tuples)
 
         self._mutate(_mutate)
 
@@ -261,9 +254,11 @@ class CachedResults(object):
         fnames = set(self.filter(x)._fullname for x in tup(items))
 
         def _mutate(data):
-            data = data or []
-            return filter(lambda x: x[0] not in fnames,
-                          data)
+            data = packed_listing.load(data)
+            if isinstance(data, packed_listing.PackedListing):
+                data.delete(fnames)
+                return self._dump(data)
+            return self._dump(x for x in data if x[0] not in fnames)
 
         self._mutate(_mutate)
 
@@ -271,21 +266,23 @@ class CachedResults(object):
         """Take pre-rendered tuples from mr_top and replace the
            contents of the query outright. This should be considered a
            private API"""
+        value = self._dump(tuples)
         if lock:
             def _mutate(data):
-                return tuples
+                return value
             self._mutate(_mutate, willread=False)
         else:
             self._fetched = True
-            self.data = tuples
-            g.permacache.pessimistically_set(self.iden, tuples)
+            self.data = packed_listing.load(value)
+            g.permacache.pessimistically_set(self.iden, value)
 
     def update(self):
         """Runs the query and stores the result in the cache. This is
            only run by hand."""
-        self.data = [self.make_item_tuple(i) for i in self.query]
+        value = self._dump(self.make_item_tuple(i) for i in self.query)
+        self.data = packed_listing.load(value)
         self._fetched = True
-        g.permacache.set(self.iden, self.data)
+        g.permacache.set(self.iden, value)
 
     def __repr__(self):
         return '<CachedResults %s %s>' % (self.query._rules, self.query._sort)
@@ -293,8 +290,45 @@ class CachedResults(object):
     def __iter__(self):
         self.fetch()
 
-        for x in self.data:
-            yield x[0]
+        if isinstance(self.data, packed_listing.PackedListing):
+            for fullname in self.data.fullnames():
+                yield fullname
+        else:
+            for x in self.data:
+                yield x[0]
+
+
+def _insert_tuples_legacy(data, item_tuples):
+    """Insert into a listing stored as a plain list of tuples."""
+    existing_fnames = {item[0] for item in data}
+    new_fnames = {item[0] for item in item_tuples}
+
+    mutated_length = len(existing_fnames.union(new_fnames))
+    would_truncate = mutated_length >= precompute_limit
+    if would_truncate and data:
+        # only insert items that are already stored or new items
+        # that are large enough that they won't be immediately truncated
+        # out of storage
+        # item structure is (name, sortval1[, sortval2, ...])
+        smallest = data[-1] if data else None
+        item_tuples = [item for item in item_tuples
+                       if (smallest is None or
+                           item[0] in existing_fnames or
+                           item[1:] >= smallest[1:])]
+
+    if not item_tuples:
+        return data
+
+    # insert the items, remove the duplicates (keeping the
+    # one being inserted over the stored value if applicable),
+    # and sort the result
+    data = filter(lambda x: x[0] not in new_fnames, data)
+    data.extend(item_tuples)
+    data.sort(reverse=True, key=lambda x: x[1:])
+    if len(data) > precompute_limit:
+        data = data[:precompute_limit]
+    return data
+
 
 class MergedCachedResults(object):
     """Given two CachedResults, merges their lists based on the sorts
@@ -312,22 +346,32 @@ class MergedCachedResults(object):
         self._fetched = True
 
         self.sort = results[0].sort
-        comparator = ThingTupleComparator(self.sort)
         # make sure they're all the same
         assert all(r.sort == self.sort for r in results[1:])
+        self._data = None
 
-        all_items = []
-        for cr in results:
-            all_items.extend(cr.data)
-        all_items.sort(cmp=comparator)
-        self.data = all_items
+    # each of the underlying listings is already sorted, so they can be
+    # merged lazily and builders that only need the first page don't have
+    # to pay for sorting everything
+    lazy_listing = True
+
+    def _merged(self):
+        comparator = ThingTupleComparator(self.sort)
+        return merge_sorted([cr.data for cr in self.cached_results],
+                            cmp=comparator)
 
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = list(self._merged())
+        return self._data
 
     def __repr__(self):
         return '<MergedCachedResults %r>' % (self.cached_results,)
 
     def __iter__(self):
-        for x in self.data:
+        items = self._data if self._data is not None else self._merged()
+        for x in items:
             yield x[0]
 
     def update(self):
@@ -1136,16 +1180,22 @@ def new_link(link):
 
     add_queries(results, insert_items = link)
     amqp.add_item('new_link', link._fullname)
+    rising.mark_changed(link)
+    all_sr.mark_active(link.sr_id)
 
 
 def add_to_commentstree_q(comment):
+    # the link id lets consumers keep each link's comments in order
+    headers = {"link_id": comment.link_id}
+
     if utils.to36(comment.link_id) in g.live_config["fastlane_links"]:
-        amqp.add_item('commentstree_fastlane_q', comment._fullname)
+        amqp.add_item('commentstree_fastlane_q', comment._fullname,
+                      headers=headers)
     elif g.shard_commentstree_queues:
         amqp.add_item('commentstree_%d_q' % (comment.link_id % 10),
-                      comment._fullname)
+                      comment._fullname, headers=headers)
     else:
-        amqp.add_item('commentstree_q', comment._fullname)
+        amqp.add_item('commentstree_q', comment._fullname, headers=headers)
 
 
 def update_comment_notifications(comment, inbox_rels):
@@ -1214,59 +1264,89 @@ def new_subreddit(sr):
 
 
 def new_vote(vote):
-    vote_valid = vote.is_automatic_initial_vote or vote.effects.affects_score
-    thing_valid = not (vote.thing._spam or vote.thing._deleted)
+    new_votes([vote])
+
+
+def _vote_updates_listings(vote):
+    return vote.is_automatic_initial_vote or vote.effects.affects_score
+
+
+def new_votes(votes):
+    """Update the cached queries affected by votes.
+
+    The votes must already have been applied. The listings a thing is in
+    are updated once no matter how many of the votes were on it.
+
+    """
 
-    if vote_valid and thing_valid:
-        sr = vote.thing.subreddit_slow
+    votes_by_thing = collections.OrderedDict()
+    for vote in votes:
+        votes_by_thing.setdefault(vote.thing._fullname, []).append(vote)
+
+    for thing_votes in votes_by_thing.itervalues():
+        thing = thing_votes[0].thing
+        vote_valid = any(_vote_updates_listings(vote) for vote in thing_votes)
+        thing_valid = not (thing._spam or thing._deleted)
+        if not (vote_valid and thing_valid):
+            continue
+
+        sr = thing.subreddit_slow
 
         # these sorts can be changed by voting - we don't need to do "new"
         # since that's taken care of by new_link and new_comment
         sorts_to_update = ["hot", "top", "controversial"]
         results = []
 
-        author = Account._byID(vote.thing.author_id)
+        author = Account._byID(thing.author_id)
         for sort in sorts_to_update:
-            if isinstance(vote.thing, Link):
+            if isinstance(thing, Link):
                 results.append(get_submitted(author, sort, 'all'))
-            if isinstance(vote.thing, Comment):
+            if isinstance(thing, Comment):
                 results.append(get_comments(author, sort, 'all'))
 
-        if isinstance(vote.thing, Link):
+        if isinstance(thing, Link):
             for sort in sorts_to_update:
                 results.append(get_links(sr, sort, "all"))
 
-            parsed = utils.UrlParser(vote.thing.url)
+            parsed = utils.UrlParser(thing.url)
             if not is_subdomain(parsed.hostname, 'imgur.com'):
                 for domain in parsed.domain_permutations():
                     for sort in sorts_to_update:
                         results.append(get_domain_links(domain, sort, "all"))
-        elif isinstance(vote.thing, Comment):
-            comment = vote.thing
-
-            # update the score periodically when a comment has many votes
+        elif isinstance(thing, Comment):
+            # update the score periodically when a comment has many votes.
+            # check the number of votes after each vote that would have
+            # updated it on its own.
             update_threshold = g.live_config['comment_vote_update_threshold']
             update_period = g.live_config['comment_vote_update_period']
-            num_votes = comment.num_votes
-            if num_votes <= update_threshold or num_votes % update_period == 0:
-                add_to_commentstree_q(comment)
+            num_votes_after = Vote.num_votes_after_each(thing_votes)
+            if any(num_votes <= update_threshold or
+                        num_votes % update_period == 0
+                    for vote, num_votes in zip(thing_votes, num_votes_after)
+                    if _vote_updates_listings(vote)):
+                add_to_commentstree_q(thing)
 
-        add_queries(results, insert_items=vote.thing)
-    
-    if isinstance(vote.thing, Link):
-        with CachedQueryMutator() as m:
-            # if this is a changed vote, remove from the previous cached query
-            if vote.previous_vote:
-                if vote.previous_vote.is_upvote:
-                    m.delete(get_liked(vote.user), [vote.previous_vote])
-                elif vote.previous_vote.is_downvote:
-                    m.delete(get_disliked(vote.user), [vote.previous_vote])
+        add_queries(results, insert_items=thing)
+
+    link_votes = [vote for vote in votes if isinstance(vote.thing, Link)]
+    if link_votes:
+        rising.mark_changed([vote.thing for vote in link_votes])
 
-            # and then add to the new cached query
-            if vote.is_upvote:
-                m.insert(get_liked(vote.user), [vote])
-            elif vote.is_downvote:
-                m.insert(get_disliked(vote.user), [vote])
+        with CachedQueryMutator() as m:
+            for vote in link_votes:
+                # if this is a changed vote, remove from the previous cached
+                # query
+                if vote.previous_vote:
+                    if vote.previous_vote.is_upvote:
+                        m.delete(get_liked(vote.user), [vote.previous_vote])
+                    elif vote.previous_vote.is_downvote:
+                        m.delete(get_disliked(vote.user), [vote.previous_vote])
+
+                # and then add to the new cached query
+                if vote.is_upvote:
+                    m.insert(get_liked(vote.user), [vote])
+                elif vote.is_downvote:
+                    m.insert(get_disliked(vote.user), [vote])
 
 
 def new_message(message, inbox_rels, add_to_sent=True, update_modmail=True):
@@ -1903,7 +1983,7 @@ def run_commentstree(qname="commentstree_q", limit=400):
     """Add new incoming comments to their respective comments trees"""
 
     @g.stats.amqp_processor(qname)
-    def _run_commentstree(msgs, chan):
+    def _run_commentstree(msgs, chan=None):
         comment_names = {msg.body for msg in msgs}
         comments = Comment._by_fullname(
             comment_names, data=True, return_dict=False)
@@ -1926,7 +2006,20 @@ def run_commentstree(qname="commentstree_q", limit=400):
     # High velocity threads put additional pressure on Cassandra.
     if qname == "commentstree_fastlane_q":
         limit = max(1000, limit)
-    amqp.handle_items(qname, _run_commentstree, limit=limit)
+
+    workers = g.amqp_consumer_workers
+    if workers:
+        amqp.consume_batches(qname, _run_commentstree,
+                             key_fn=_commentstree_queue_key,
+                             prefetch_count=limit * workers, workers=workers,
+                             batch_size=limit)
+    else:
+        amqp.handle_items(qname, _run_commentstree, limit=limit)
+
+
+def _commentstree_queue_key(msg):
+    headers = msg.properties.get("application_headers") or {}
+    return headers.get("link_id")
 
 
 def _by_type(items):
@@ -1943,15 +2036,35 @@ def get_stored_votes(user, things):
     results = {}
     things_by_type = _by_type(things)
 
+    # skip looking up the things the user definitely hasn't voted on
+    voted_filter = VotedThingFilter.get(user)
+    if voted_filter is None:
+        g.stats.simple_event("vote.filter.missing")
+
     for thing_class, items in things_by_type.iteritems():
         if not thing_class.is_votable:
             continue
 
+        if voted_filter is not None:
+            maybe_voted = [item for item in items
+                           if item._fullname in voted_filter]
+            g.stats.simple_event("vote.filter.skipped",
+                                 delta=len(items) - len(maybe_voted))
+            items = maybe_voted
+            if not items:
+                continue
+
         rel_class = VotesByAccount.rel(thing_class)
         votes = rel_class.fast_query(user, items)
         for cross, direction in votes.iteritems():
             results[cross] = Vote.deserialize_direction(int(direction))
 
+        if voted_filter is not None:
+            # false positives divided by maybe_voted is the filter's error rate
+            g.stats.simple_event("vote.filter.maybe_voted", delta=len(items))
+            g.stats.simple_event("vote.filter.false_positive",
+                                 delta=len(items) - len(votes))
+
     return results
 
 
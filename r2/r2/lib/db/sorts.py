@@ -21,4 +21,11 @@
 ###############################################################################
 
 from r2.lib.db._sorts import epoch_seconds, score, hot, _hot
-from r2.lib.db._sorts import controversy, confidence, qa
+from r2.lib.db._sorts import controversy, confidence, qa, _qa
+from r2.lib.db._sorts import (
+    confidence_batch,
+    controversy_batch,
+    hot_batch,
+    qa_batch,
+    score_batch,
+)
@@ -579,6 +579,12 @@ def incr_data_prop(table, type_id, thing_id, prop, amount):
                  values={t.c.value : sa.cast(t.c.value, sa.Float) + amount})
     u.execute()
 
+def del_data(table, thing_id, keys):
+    transactions.add_engine(table.bind)
+    d = table.delete(sa.and_(table.c.thing_id == thing_id,
+                             table.c.key.in_(keys)))
+    d.execute()
+
 def fetch_query(table, id_col, thing_id):
     """pull the columns from the thing/data tables for a list or single
     thing_id"""
@@ -627,6 +633,10 @@ def incr_thing_data(type_id, thing_id, prop, amount):
     table = get_thing_table(type_id, action = 'write')[1]
     return incr_data_prop(table, type_id, thing_id, prop, amount)    
 
+def del_thing_data(type_id, thing_id, keys):
+    table = get_thing_table(type_id, action = 'write')[1]
+    return del_data(table, thing_id, keys)
+
 def get_thing_data(type_id, thing_id):
     table = get_thing_table(type_id)[1]
     return get_data(table, thing_id)
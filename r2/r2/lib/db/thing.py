@@ -20,6 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from collections import defaultdict
 from copy import copy, deepcopy
 import cPickle as pickle
 from datetime import datetime, timedelta
@@ -27,13 +28,16 @@ import hashlib
 import itertools
 import new
 import sys
+import threading
+import time
 
-from _pylibmc import MemcachedError
+from _pylibmc import MemcachedError, NotFound as CacheKeyNotFound
 from pylons import app_globals as g
 
 from r2.lib import amqp, hooks
 from r2.lib.db import tdb_sql as tdb, sorts, operators
 from r2.lib.sgm import sgm
+from r2.lib.singleflight import SingleFlight
 from r2.lib.utils import class_property, Results, tup, to36
 
 
@@ -46,6 +50,84 @@ CreationError = tdb.CreationError
 thing_types = {}
 rel_types = {}
 
+# shares db reads between concurrent _byID cache misses for the same things
+_byID_flight = SingleFlight("thing_byID")
+
+# cached query results are stamped with generations that are bumped when the
+# things or relations they could contain are added, changed or deleted. results
+# whose generations are all unchanged can be kept (up to QUERY_MAX_CACHE_TIME)
+# past their cache_time. changes to things only bump the generations of the
+# columns that changed, and new things bump their kind's insert generation.
+# relation generations are split by the thing1 or thing2 the query is limited
+# to so that bumping one doesn't invalidate every query of the kind.
+QUERY_GEN_PREFIX = "querygen:"
+QUERY_MAX_CACHE_TIME = 86400
+
+# sorts computed by the db from other columns
+_derived_sort_columns = {
+    "_hot": ("_ups", "_downs", "_date"),
+    "_score": ("_ups", "_downs"),
+    "_controversy": ("_ups", "_downs"),
+}
+
+# the vote columns are incremented far too often to bump a generation each
+# time, so queries using them are only cached for cache_time
+_unversioned_columns = ("_ups", "_downs")
+
+
+def _query_gen_key(kind, column):
+    return QUERY_GEN_PREFIX + kind.__name__ + "." + column
+
+
+def _query_partition_key(kind, column, value):
+    return _query_gen_key(kind, column) + "=" + str(value)
+
+
+def _query_insert_key(kind):
+    return QUERY_GEN_PREFIX + kind.__name__ + ":new"
+
+
+def _query_column_keys(kind, column):
+    """Return the generations a query using column of kind depends on.
+
+    Returns None if the column can change without bumping anything.
+
+    """
+
+    keys = []
+    for column in _derived_sort_columns.get(column, (column,)):
+        if column in _unversioned_columns:
+            return None
+        keys.append(_query_gen_key(kind, column))
+    return keys
+
+
+def _bump_generations(keys):
+    if not keys:
+        return
+
+    try:
+        try:
+            g.gencache.incr_multi(keys)
+        except CacheKeyNotFound:
+            # a generation that isn't in the cache has nothing to invalidate
+            # but the others still need bumping
+            for key in keys:
+                try:
+                    g.gencache.incr(key)
+                except CacheKeyNotFound:
+                    pass
+    except MemcachedError:
+        g.log.warning("Failed to bump query generations %r", keys)
+        g.stats.simple_event("thing_query.generation_error")
+
+
+def bump_query_generations(kind, columns):
+    """Invalidate the cached relation queries that use columns of kind."""
+    columns = [column for column in columns
+               if column not in _unversioned_columns]
+    _bump_generations([_query_gen_key(kind, column) for column in columns])
+
 
 class SafeSetAttr:
     def __init__(self, cls):
@@ -166,6 +248,11 @@ class DataThing(object):
     @classmethod
     def get_things_from_cache(cls, ids, stale=False, allow_local=True):
         """Read things from cache and return id->thing dict."""
+        if allow_local:
+            prefetcher = ThingPrefetcher.current(stale)
+            if prefetcher:
+                return prefetcher.get_things(cls, ids)
+
         cache = cls._cache
         prefix = cls._cache_prefix()
         things_by_id = cache.get_multi(
@@ -313,7 +400,8 @@ class DataThing(object):
 
         """
 
-        if not self._created:
+        brand_new_thing = not self._created
+        if brand_new_thing:
             with TdbTransactionContext():
                 _id = self.write_new_thing_to_db()
                 self._id = _id
@@ -339,8 +427,13 @@ class DataThing(object):
                 self.write_thing_to_cache(lock)
                 self.record_cache_write(event="modify")
 
+        self._bump_query_generations(changes, brand_new_thing)
+
         hooks.get_hook("thing.commit").call(thing=self, changes=changes)
 
+    def _bump_query_generations(self, changes, brand_new_thing):
+        raise NotImplementedError
+
     def _incr(self, prop, amt=1):
         raise NotImplementedError
 
@@ -360,6 +453,29 @@ class DataThing(object):
     def _fullname(self):
         return self._fullname_from_id36(self._id36)
 
+    @classmethod
+    def _get_things_from_db_coalesced(cls, ids):
+        """Read things from the db and populate the cache.
+
+        Concurrent callers in this process that miss the cache for the same
+        things share a single db read rather than each doing their own.
+
+        """
+
+        prefix = cls._cache_prefix()
+
+        def _get_and_cache(keys):
+            from_db_by_id = cls.get_things_from_db([_id for _, _id in keys])
+            if from_db_by_id:
+                cls.write_things_to_cache(from_db_by_id)
+                cls.record_cache_write(event="cache", delta=len(from_db_by_id))
+            return {(prefix, _id): thing
+                    for _id, thing in from_db_by_id.iteritems()}
+
+        keys = [(prefix, _id) for _id in ids]
+        things_by_key = _byID_flight.do_multi(keys, _get_and_cache)
+        return {_id: thing for (_, _id), thing in things_by_key.iteritems()}
+
     @classmethod
     def _byID(cls, ids, data=True, return_dict=True, stale=False,
               ignore_missing=False):
@@ -387,15 +503,8 @@ class DataThing(object):
         ]
 
         if missing_ids:
-            from_db_by_id = cls.get_things_from_db(missing_ids)
-        else:
-            from_db_by_id = {}
-
-        if from_db_by_id:
-            cls.write_things_to_cache(from_db_by_id)
-            cls.record_cache_write(event="cache", delta=len(from_db_by_id))
-
-        things_by_id.update(from_db_by_id)
+            from_db_by_id = cls._get_things_from_db_coalesced(missing_ids)
+            things_by_id.update(from_db_by_id)
 
         # Check to see if we found everything we asked for
         missing = [_id for _id in ids if _id not in things_by_id]
@@ -490,6 +599,93 @@ class DataThing(object):
         raise NotImplementedError()
 
 
+class ThingPrefetcher(object):
+    """Batch up the cache reads for things several callers are going to need.
+
+    Ids are registered with `want` and looked up together: one get_multi per
+    cache chain, then one db read per type for anything that missed. While
+    the prefetcher is active (inside a `with` block) every _byID in the
+    thread goes through it, so its own ids are fetched along with anything
+    still pending and things that were already loaded aren't looked up again.
+
+    A stale prefetcher is only used by lookups that are happy with stale
+    things.
+
+    """
+
+    _local = threading.local()
+
+    def __init__(self, stale=False):
+        self.stale = stale
+        self.pending = defaultdict(set)
+        self.things = defaultdict(dict)
+        self.missing = defaultdict(set)
+
+    @classmethod
+    def current(cls, stale=False):
+        """Return the innermost active prefetcher usable for the lookup."""
+        for prefetcher in reversed(getattr(cls._local, "active", ())):
+            if stale or not prefetcher.stale:
+                return prefetcher
+        return None
+
+    def __enter__(self):
+        if not hasattr(self._local, "active"):
+            self._local.active = []
+        self._local.active.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.active.remove(self)
+
+    def want(self, cls, ids):
+        things = self.things[cls]
+        missing = self.missing[cls]
+        self.pending[cls].update(
+            _id for _id in ids
+            if _id is not None and _id not in things and _id not in missing
+        )
+
+    def load(self):
+        """Look up everything that's pending."""
+        pending, self.pending = self.pending, defaultdict(set)
+
+        # things of different types often share a cache chain
+        keys_by_cache = defaultdict(dict)
+        for cls, ids in pending.iteritems():
+            prefix = cls._cache_prefix()
+            for _id in ids:
+                keys_by_cache[cls._cache][prefix + str(_id)] = (cls, _id)
+
+        for cache, keys in keys_by_cache.iteritems():
+            from_cache = cache.simple_get_multi(
+                keys.keys(), stale=self.stale, allow_local=True,
+                stat_subname="prefetch")
+
+            ids_by_cls = defaultdict(list)
+            for key, (cls, _id) in keys.iteritems():
+                thing = from_cache.get(key)
+                if thing is not None:
+                    self.things[cls][_id] = thing
+                else:
+                    ids_by_cls[cls].append(_id)
+
+            for cls, ids in ids_by_cls.iteritems():
+                from_db = cls._get_things_from_db_coalesced(ids)
+                self.things[cls].update(from_db)
+                self.missing[cls].update(_id for _id in ids
+                                         if _id not in from_db)
+
+    def get_things(self, cls, ids):
+        """Return id->thing dict for the ids, loading anything pending."""
+        self.want(cls, ids)
+        if any(self.pending.itervalues()):
+            self.load()
+
+        things = self.things[cls]
+        return {_id: things[_id] for _id in ids if _id in things}
+
+
 class ThingMeta(type):
     def __init__(cls, name, bases, dct):
         if name == 'Thing' or hasattr(cls, '_nodb') and cls._nodb: return
@@ -549,6 +745,15 @@ class Thing(DataThing):
         event_name = "thing.{event}.{name}".format(event=event, name=name)
         g.stats.simple_event(event_name, delta)
 
+    def _bump_query_generations(self, changes, brand_new_thing):
+        # a new thing can show up in any query of its kind, but relation
+        # queries only once a relation to it is made, which bumps the
+        # relation's own generations
+        if brand_new_thing:
+            _bump_generations([_query_insert_key(self.__class__)])
+        else:
+            bump_query_generations(self.__class__, changes.keys())
+
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__,
                             self._id if self._created else '[unsaved]')
@@ -668,6 +873,35 @@ class Thing(DataThing):
                 # will cause a transaction rollback
                 self.write_thing_to_cache(lock)
         self.record_cache_write(event="incr")
+        bump_query_generations(self.__class__, [prop])
+
+    def _del_data_props(self, props):
+        """Remove data props from the thing and return their old values.
+
+        Props that aren't set are ignored. The values are read under the
+        thing's lock so concurrent callers never see the same prop removed
+        twice.
+
+        """
+        assert not self._dirty
+
+        with self.get_read_modify_write_lock() as lock:
+            self.update_from_cache(lock)
+            props = [prop for prop in props if prop in self._t]
+            if not props:
+                return {}
+
+            with TdbTransactionContext():
+                tdb.del_thing_data(
+                    type_id=self.__class__._type_id,
+                    thing_id=self._id,
+                    keys=props,
+                )
+                removed = {prop: self._t.pop(prop) for prop in props}
+                self.write_thing_to_cache(lock)
+        self.record_cache_write(event="modify")
+        bump_query_generations(self.__class__, props)
+        return removed
 
     @property
     def _age(self):
@@ -913,6 +1147,14 @@ def Relation(type1, type2):
             event_name = "rel.{event}.{name}".format(event=event, name=name)
             g.stats.simple_event(event_name, delta)
 
+        def _bump_query_generations(self, changes=None, brand_new_thing=False):
+            _bump_generations([
+                _query_partition_key(
+                    self.__class__, "_thing1_id", self._thing1_id),
+                _query_partition_key(
+                    self.__class__, "_thing2_id", self._thing2_id),
+            ])
+
         def __getattr__(self, attr):
             if attr == '_thing1':
                 return self._type1._byID(self._thing1_id)
@@ -965,6 +1207,7 @@ def Relation(type1, type2):
             tdb.del_rel(self._type_id, self._id)
 
             self._cache.delete(self._cache_key())
+            self._bump_query_generations()
 
             if self.__class__._enable_fast_query:
                 ttl = self.__class__._rel_cache_ttl
@@ -1193,17 +1436,103 @@ class Query(object):
         things = self._cursor().fetchall()
         return things
 
+    def _query_columns(self):
+        """Return the columns the query filters and sorts by.
+
+        Returns None if the results depend on the time or are random.
+
+        """
+
+        columns = set()
+        for rule in operators.op_iter(self._rules):
+            if any(isinstance(val, operators.timeago)
+                   for val in tup(rule.rval)):
+                return None
+            columns.add(rule.lval_name)
+
+        for sort in self._sort:
+            if isinstance(sort, operators.shuffled):
+                return None
+            columns.add(getattr(sort.col, "name", sort.col))
+
+        return columns
+
+    def _gen_keys(self):
+        """Return the keys of the generations the results depend on.
+
+        Returns None if the results can change without any of them being
+        bumped, so they can't be kept past cache_time.
+
+        """
+
+        return None
+
+    def _get_generations(self):
+        """Return the current generations the results depend on.
+
+        This must be called before running the query, so anything committed
+        while it runs invalidates the results.
+
+        """
+
+        gen_keys = self._gen_keys()
+        if gen_keys is None:
+            return None
+
+        gens = g.gencache.get_multi(gen_keys, allow_local=False)
+        missing = [key for key in gen_keys if key not in gens]
+        if missing:
+            # start from the time so a generation that was evicted from the
+            # cache doesn't come back with a value it's had before
+            initial = int(time.time() * 1000)
+            for key in missing:
+                g.gencache.add(key, initial)
+            gens.update(g.gencache.get_multi(missing, allow_local=False))
+
+        return [gens.get(key) for key in gen_keys]
+
+    def _get_cached(self, allow_local=True):
+        cache_key = self._cache_key()
+        gen_keys = self._gen_keys() or []
+        cached = g.gencache.get_multi(
+            [cache_key] + gen_keys, allow_local=allow_local)
+
+        entry = cached.get(cache_key)
+        if not isinstance(entry, tuple):
+            # results cached before they were stamped with generations
+            return entry
+
+        built, gens, results = entry
+        if time.time() - built < self._cache_time:
+            return results
+
+        current = [cached.get(key) for key in gen_keys]
+        if gens and None not in gens and gens == current:
+            g.stats.simple_event("thing_query.generation_hit")
+            return results
+
+        g.stats.simple_event("thing_query.generation_miss")
+        return None
+
+    def _set_cached(self, results, generations):
+        if generations is None:
+            cache_time = self._cache_time
+        else:
+            cache_time = max(self._cache_time, QUERY_MAX_CACHE_TIME)
+
+        entry = (time.time(), generations, results)
+        g.gencache.set(self._cache_key(), entry, cache_time)
+
     def get_from_cache(self, allow_local=True):
-        thing_fullnames = g.gencache.get(
-            self._cache_key(), allow_local=allow_local)
+        thing_fullnames = self._get_cached(allow_local=allow_local)
         if thing_fullnames:
             things = Thing._by_fullname(thing_fullnames, return_dict=False,
                                         stale=self._stale)
             return things
 
-    def set_to_cache(self, things):
+    def set_to_cache(self, things, generations=None):
         thing_fullnames = [thing._fullname for thing in things]
-        g.gencache.set(self._cache_key(), thing_fullnames, self._cache_time)
+        self._set_cached(thing_fullnames, generations)
 
     def __iter__(self):
         if self._read_cache:
@@ -1226,8 +1555,9 @@ class Query(object):
                     things = None
 
                 if things is None:
+                    generations = self._get_generations()
                     things = self._get_results()
-                    self.set_to_cache(things)
+                    self.set_to_cache(things, generations)
 
         for thing in things:
             yield thing
@@ -1266,6 +1596,20 @@ class Things(Query):
 
         return Results(cursor, row_fn, do_batch=True)
 
+    def _gen_keys(self):
+        columns = self._query_columns()
+        if columns is None:
+            return None
+
+        gen_keys = {_query_insert_key(self._kind)}
+        for column in columns:
+            keys = _query_column_keys(self._kind, column)
+            if keys is None:
+                return None
+            gen_keys.update(keys)
+
+        return sorted(gen_keys)
+
 def load_things(rels, stale=False):
     rels = tup(rels)
     kind = rels[0].__class__
@@ -1294,6 +1638,40 @@ class Relations(Query):
         self._rules += rules
         return self
 
+    def _gen_keys(self):
+        # new, changed and deleted relations only bump the generations of
+        # their thing1 and thing2, so the query has to be limited to one
+        gen_keys = set()
+        for rule in self._rules:
+            if (isinstance(rule, operators.eq) and
+                    rule.lval_name in ("_thing1_id", "_thing2_id") and
+                    len(tup(rule.rval)) == 1):
+                gen_keys.add(_query_partition_key(
+                    self._kind, rule.lval_name, tup(rule.rval)[0]))
+        if not gen_keys:
+            return None
+
+        columns = self._query_columns()
+        if columns is None:
+            return None
+
+        for column in columns:
+            # the relation's own columns are covered by its generations but
+            # it can also be filtered and sorted by its things' columns
+            if column.startswith("_t1_"):
+                kind, column = self._kind._type1, column[4:]
+            elif column.startswith("_t2_"):
+                kind, column = self._kind._type2, column[4:]
+            else:
+                continue
+
+            keys = _query_column_keys(kind, column)
+            if keys is None:
+                return None
+            gen_keys.update(keys)
+
+        return sorted(gen_keys)
+
     def _eager(self, eager):
         #load the things (id, ups, down, etc.)
         self._eager_load = eager
@@ -1354,10 +1732,10 @@ class RelationsPropsOnly(Relations):
         return rows
 
     def get_from_cache(self, allow_local=True):
-        return g.gencache.get(self._cache_key(), allow_local=allow_local)
+        return self._get_cached(allow_local=allow_local)
 
-    def set_to_cache(self, rows):
-        g.gencache.set(self._cache_key(), rows, self._cache_time)
+    def set_to_cache(self, rows, generations=None):
+        self._set_cached(rows, generations)
 
 
 class MultiCursor(object):
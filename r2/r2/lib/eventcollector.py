@@ -19,11 +19,17 @@
 # All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
 # Inc. All Rights Reserved.
 ###############################################################################
+import atexit
 import baseplate.events
+import collections
+import contextlib
+import os
+import threading
 import time
 import re
 from urlparse import urlparse
 
+from baseplate.message_queue import MessageQueue, TimedOutError
 from pylons import app_globals as g
 from collections import defaultdict
 
@@ -46,13 +52,155 @@ from r2.lib.utils import (
 # XXX External dependencies!
 _datetime_to_millis = to_epoch_milliseconds
 
+# events are sent on to the publisher in batches of up to this many events
+# (and MAX_EVENT_SIZE bytes), or whatever has been saved in this many seconds
+EVENT_BATCH_SIZE = 50
+EVENT_BATCH_AGE = 1.
+
+# batches that don't fit in the publisher's queue are kept and retried until
+# this many events are waiting, then the oldest are dropped
+MAX_PENDING_EVENTS = 5000
+
+# field blocks cached for the duration of an EventQueue.batch() block
+_field_cache = threading.local()
+
+
+def _cached_fields(kind, key, get_fields):
+    """Return get_fields(), reusing the result within the current batch."""
+    blocks = getattr(_field_cache, "blocks", None)
+    if blocks is None:
+        return get_fields()
+
+    try:
+        return blocks[(kind, key)]
+    except KeyError:
+        fields = blocks[(kind, key)] = get_fields()
+        return fields
+
+
+class EventBatcher(object):
+    """Send serialized events to the event publisher several at a time.
+
+    Each message on the publisher's queue holds a batch of events as comma
+    separated JSON objects. The publisher joins messages with commas into a
+    JSON list and gzips it before posting to the collector, so a message
+    holding a batch reads the same as that many single event messages.
+
+    """
+
+    def __init__(self, name, stats, log):
+        self.name = name
+        self.stats = stats
+        self.log = log
+        self.queue = MessageQueue(
+            "/events-" + name,
+            max_messages=baseplate.events.MAX_QUEUE_SIZE,
+            max_message_size=baseplate.events.MAX_EVENT_SIZE,
+        )
+        self.lock = threading.Lock()
+        self.events = []
+        self.size = 0
+        self.started = None
+        # (message, number of events) waiting for room in the queue
+        self.pending = collections.deque()
+        self.num_pending = 0
+
+    def put(self, event):
+        serialized = event.serialize()
+        if len(serialized) > baseplate.events.MAX_EVENT_SIZE:
+            raise baseplate.events.EventTooLargeError(len(serialized))
+
+        with self.lock:
+            # the batch needs room for a comma before the event too
+            size = self.size + len(serialized) + 1
+            if self.events and size > baseplate.events.MAX_EVENT_SIZE:
+                self._end_batch()
+                self._send()
+
+            if not self.events:
+                self.started = time.time()
+                self.size = len(serialized)
+            else:
+                self.size += len(serialized) + 1
+            self.events.append(serialized)
+
+            if len(self.events) >= EVENT_BATCH_SIZE:
+                self._end_batch()
+                self._send()
+
+    def flush(self, max_age=None):
+        """Send the current batch, if it's at least max_age seconds old.
+
+        Batches held back because the queue was full are retried either way.
+
+        """
+
+        with self.lock:
+            if self.events and (max_age is None or
+                                time.time() - self.started >= max_age):
+                self._end_batch()
+            self._send()
+
+    def _end_batch(self):
+        self.pending.append((",".join(self.events), len(self.events)))
+        self.num_pending += len(self.events)
+        self.events = []
+        self.size = 0
+        self.started = None
+
+    def _send(self):
+        while self.pending:
+            message, count = self.pending[0]
+            try:
+                self.queue.put(message, timeout=0)
+            except TimedOutError:
+                # the publisher is falling behind, hold on to the batch
+                self.stats.simple_event("eventcollector.queue_full")
+                break
+
+            self.pending.popleft()
+            self.num_pending -= count
+            self.stats.simple_event("eventcollector.batch_sent")
+            self.stats.simple_event("eventcollector.event_sent", delta=count)
+
+        while self.num_pending > MAX_PENDING_EVENTS:
+            message, count = self.pending.popleft()
+            self.num_pending -= count
+            self.log.warning("dropping %d events for %s", count, self.name)
+            self.stats.simple_event(
+                "eventcollector.pending_dropped", delta=count)
+
 
 class EventQueue(object):
-    def __init__(self):
-        self.queue_production = baseplate.events.EventQueue("production")
-        self.queue_test = baseplate.events.EventQueue("test")
+    def __init__(self, stats, log):
+        self.queue_production = EventBatcher("production", stats, log)
+        self.queue_test = EventBatcher("test", stats, log)
+        self.log = log
+        self.flusher = None
+        self.flusher_pid = None
+        atexit.register(self.flush)
+
+    def _ensure_flusher(self):
+        # threads don't survive forking so each process starts its own
+        if self.flusher_pid == os.getpid():
+            return
+
+        self.flusher_pid = os.getpid()
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(EVENT_BATCH_AGE)
+            try:
+                self.flush(max_age=EVENT_BATCH_AGE)
+            except Exception:
+                self.log.exception("failed to flush events")
 
     def save_event(self, event, test=False):
+        self._ensure_flusher()
+
         try:
             if not test:
                 self.queue_production.put(event)
@@ -69,6 +217,38 @@ class EventQueue(object):
             # encounter invalid utf-8 strings in the Referer header or path.
             g.log.error("Got weird unicode in the event data: %s", exc)
 
+    def flush(self, max_age=None):
+        """Send batched events on to the publisher.
+
+        If max_age is given, only batches that have been waiting at least that
+        many seconds are sent.
+
+        """
+
+        self.queue_production.flush(max_age)
+        self.queue_test.flush(max_age)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Save a group of related events together.
+
+        Inside the block the subreddit and target fields are only looked up
+        once per subreddit and target, and the events are sent on to the
+        publisher when it exits.
+
+        """
+
+        if getattr(_field_cache, "blocks", None) is not None:
+            yield
+            return
+
+        _field_cache.blocks = {}
+        try:
+            yield
+        finally:
+            _field_cache.blocks = None
+            self.flush()
+
     @squelch_exceptions
     @sampled("events_collector_vote_sample_rate")
     def vote_event(self, vote):
@@ -1843,6 +2023,14 @@ class EventQueue(object):
         self.save_event(event)
 
 
+def _charset_fields(key, value):
+    if value is None:
+        return []
+
+    return [("{}_{}".format(key, k), v)
+            for k, v in charset_summary(value).iteritems()]
+
+
 class Event(baseplate.events.Event):
     def __init__(self, topic, event_type,
                  time=None, uuid=None, request=None, context=None,
@@ -1892,69 +2080,87 @@ class Event(baseplate.events.Event):
     def add_text(self, key, value, kind=baseplate.events.FieldKind.NORMAL):
         self.add(key, value, kind=kind)
 
-        if value is None:
-            return
-
-        for k, v in charset_summary(value).iteritems():
-            self.add("{}_{}".format(key, k), v)
+        for k, v in _charset_fields(key, value):
+            self.add(k, v)
 
     def add_target_fields(self, target):
         if not target:
             return
-        from r2.models import Comment, Link, Message
 
-        self.add("target_id", target._id)
-        self.add("target_fullname", target._fullname)
+        fields = _cached_fields(
+            "target", target._fullname, lambda: self.target_fields(target))
+        for key, value in fields:
+            self.add(key, value)
+
+        # this changes from one event to the next so it's never cached
         self.add("target_age_seconds", target._age.total_seconds())
 
+        hooks.get_hook("eventcollector.add_target_fields").call(
+            event=self,
+            target=target,
+        )
+
+    @staticmethod
+    def target_fields(target):
+        """Return a list of (key, value) fields describing the target."""
+        from r2.models import Comment, Link, Message
+
+        fields = [
+            ("target_id", target._id),
+            ("target_fullname", target._fullname),
+        ]
+
         target_type = target.__class__.__name__.lower()
         if target_type == "link" and target.is_self:
             target_type = "self"
-        self.add("target_type", target_type)
+        fields.append(("target_type", target_type))
 
         # If the target is an Account or Subreddit (or has a "name" attr),
         # add the target_name
         if hasattr(target, "name"):
-            self.add("target_name", target.name)
+            fields.append(("target_name", target.name))
 
         # Add info about the target's author for comments, links, & messages
         if isinstance(target, (Comment, Link, Message)):
             author = target.author_slow
             if target._deleted or author._deleted:
-                self.add("target_author_id", 0)
-                self.add("target_author_name", "[deleted]")
+                fields.append(("target_author_id", 0))
+                fields.append(("target_author_name", "[deleted]"))
             else:
-                self.add("target_author_id", author._id)
-                self.add("target_author_name", author.name)
+                fields.append(("target_author_id", author._id))
+                fields.append(("target_author_name", author.name))
 
         # Add info about the url being linked to for link posts
         if isinstance(target, Link):
-            self.add_text("target_title", target.title)
+            fields.append(("target_title", target.title))
+            fields.extend(_charset_fields("target_title", target.title))
             if not target.is_self:
-                self.add("target_url", target.url)
-                self.add("target_url_domain", target.link_domain())
+                fields.append(("target_url", target.url))
+                fields.append(("target_url_domain", target.link_domain()))
 
         # Add info about the link being commented on for comments
         if isinstance(target, Comment):
             link_fullname = Link._fullname_from_id36(to36(target.link_id))
-            self.add("link_id", target.link_id)
-            self.add("link_fullname", link_fullname)
+            fields.append(("link_id", target.link_id))
+            fields.append(("link_fullname", link_fullname))
 
         # Add info about when target was originally posted for links/comments
         if isinstance(target, (Comment, Link)):
-            self.add("target_created_ts", to_epoch_milliseconds(target._date))
+            fields.append(
+                ("target_created_ts", to_epoch_milliseconds(target._date)))
 
-        hooks.get_hook("eventcollector.add_target_fields").call(
-            event=self,
-            target=target,
-        )
+        return fields
 
     def add_subreddit_fields(self, subreddit):
         if not subreddit:
             return
 
-        self.add("sr_id", subreddit._id)
-        self.add("sr_name", subreddit.name)
+        fields = _cached_fields("subreddit", subreddit._id, lambda: [
+            ("sr_id", subreddit._id),
+            ("sr_name", subreddit.name),
+        ])
+        for key, value in fields:
+            self.add(key, value)
 
     @classmethod
     def get_context_data(self, request, context):
@@ -25,12 +25,35 @@ from hashlib import md5
 from r2.lib.filters import _force_utf8
 from r2.lib.cache import NoneResult, make_key_id
 from r2.lib.lock import make_lock_factory
+from r2.lib.singleflight import SingleFlight
 from pylons import app_globals as g
 
 
+_memoize_flight = SingleFlight("memoize")
+
+
 def memoize(iden, time = 0, stale=False, timeout=30):
     def memoize_fn(fn):
         from r2.lib.memoize import NoneResult
+
+        def _calculate(key, update, a, kw):
+            with g.make_lock("memoize", 'memoize_lock(%s)' % key,
+                             time=timeout, timeout=timeout):
+
+                # see if it was completed while we were waiting
+                # for the lock
+                stored = None if update else g.memoizecache.get(key)
+                if stored is not None:
+                    # it was calculated while we were waiting
+                    return stored
+
+                # okay now go and actually calculate it
+                res = fn(*a, **kw)
+                if res is None:
+                    res = NoneResult
+                g.memoizecache.set(key, res, time=time)
+                return res
+
         def new_fn(*a, **kw):
 
             #if the keyword param _update == True, the cache will be
@@ -42,22 +65,12 @@ def memoize(iden, time = 0, stale=False, timeout=30):
             res = None if update else g.memoizecache.get(key, stale=stale)
 
             if res is None:
-                # not cached, we should calculate it.
-                with g.make_lock("memoize", 'memoize_lock(%s)' % key,
-                                 time=timeout, timeout=timeout):
-
-                    # see if it was completed while we were waiting
-                    # for the lock
-                    stored = None if update else g.memoizecache.get(key)
-                    if stored is not None:
-                        # it was calculated while we were waiting
-                        res = stored
-                    else:
-                        # okay now go and actually calculate it
-                        res = fn(*a, **kw)
-                        if res is None:
-                            res = NoneResult
-                        g.memoizecache.set(key, res, time=time)
+                # not cached, we should calculate it. concurrent callers in
+                # this process share one calculation and the memcache lock
+                # coordinates with other processes.
+                flight_key = key + (":update" if update else "")
+                res = _memoize_flight.do(flight_key, _calculate, key, update,
+                                         a, kw)
 
             if res == NoneResult:
                 res = None
@@ -265,3 +265,20 @@ def populate_spam_filtered():
         with CachedQueryMutator() as m:
             m.insert(get_spam_filtered_links(sr), insert_links)
             m.insert(get_spam_filtered_comments(sr), insert_comments)
+
+def migrate_account_karma(verbosity=1000):
+    """Move per-subreddit karma props off of accounts into AccountKarma.
+
+    Accounts are migrated as their karma changes anyway, this catches the
+    ones that aren't getting votes."""
+    from r2.models import Account
+    from r2.lib.db.operators import desc
+    from r2.lib.utils import fetch_things2
+
+    q = Account._query(Account.c._spam == (True, False),
+                       Account.c._deleted == (True, False),
+                       sort=desc('_date'),
+                       data=True,
+                       )
+    for account in fetch_things2(q, verbosity):
+        account.migrate_karma()
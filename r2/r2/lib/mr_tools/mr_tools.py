@@ -24,7 +24,7 @@ import sys
 import multiprocessing
 
 from r2.lib.mr_tools._mr_tools import mr_map, mr_reduce, format_dataspec
-from r2.lib.mr_tools._mr_tools import emit
+from r2.lib.mr_tools._mr_tools import emit, keyiter
 
 STDIN = sys.stdin
 STDOUT = sys.stdout
@@ -32,37 +32,37 @@ STDERR = sys.stderr
 NCPUS = multiprocessing.cpu_count()
 
 
-def join_things(
+def iter_joined_things(
     fields,
     deleted=False,
     spam=True,
     fd=STDIN,
-    out=STDOUT,
-    err=STDERR,
     defaults=None,
+    counters=None,
 ):
-    """A reducer that joins thing table dumps and data table dumps
+    """Join thing table dumps and data table dumps, yielding the rows.
+
+    This is the in-process version of :py:func:`join_things`, which yields
+    each joined row as a tuple rather than writing it to a stream.
 
     :param list fields: list of data fields that the resulting thing must
-        contain.  Any things that missing these any of these fields (unless
-        provided in the dump or by :param:`defaults`) will be silently dropped.
+        contain.
     :param bool deleted: Allow deleted items.
     :param bool spam: Allow spam items.
-    :param file fd: Input stream.
-    :param file out: Output stream.
-    :param file err: Error stream.
+    :param file fd: Input stream, sorted by thing id.
     :param defaults: mapping of fieldnames to default values if not provided
         in the input stream.
     :type defaults: dict or None
+    :param counters: if provided, a dict whose 'processed' and 'skipped'
+        counts will be incremented.
+    :type counters: dict or None
     """
-    # Because of how Python handles scope, if we want to modify these outside
-    # the closure function below, they need to be inside a mutable object.
-    # http://stackoverflow.com/a/23558809/120999
-    counters = {
-        'processed': 0,
-        'skipped': 0,
-    }
-    def process(thing_id, vals):
+    if counters is None:
+        counters = {}
+    counters.setdefault('processed', 0)
+    counters.setdefault('skipped', 0)
+
+    for thing_id, vals in keyiter(fd):
         data = {}
         if defaults:
             data.update(defaults)
@@ -106,7 +106,35 @@ def join_things(
         else:
             counters['skipped'] += 1
 
-    mr_reduce(process, fd=fd, out=out)
+
+def join_things(
+    fields,
+    deleted=False,
+    spam=True,
+    fd=STDIN,
+    out=STDOUT,
+    err=STDERR,
+    defaults=None,
+):
+    """A reducer that joins thing table dumps and data table dumps
+
+    :param list fields: list of data fields that the resulting thing must
+        contain.  Any things that missing these any of these fields (unless
+        provided in the dump or by :param:`defaults`) will be silently dropped.
+    :param bool deleted: Allow deleted items.
+    :param bool spam: Allow spam items.
+    :param file fd: Input stream.
+    :param file out: Output stream.
+    :param file err: Error stream.
+    :param defaults: mapping of fieldnames to default values if not provided
+        in the input stream.
+    :type defaults: dict or None
+    """
+    counters = {}
+    joined = iter_joined_things(fields, deleted=deleted, spam=spam, fd=fd,
+                                defaults=defaults, counters=counters)
+    for row in joined:
+        emit(row, out=out)
 
     # Print to stderr to avoid getting this caught up in the pipe of
     # compute_time_listings.
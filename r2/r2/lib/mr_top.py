@@ -25,11 +25,24 @@
 # a submission in the last year), we won't write out an empty
 # list. I'll call it a feature.
 
+import json
+import multiprocessing
+import os
 import sys
+from array import array
 from collections import OrderedDict, namedtuple
+from heapq import heappush, heapreplace
+
+from pylons import app_globals as g
 
 from r2.models import Link, Comment
-from r2.lib.db.sorts import epoch_seconds, score, controversy
+from r2.lib.db.sorts import (
+    controversy,
+    controversy_batch,
+    epoch_seconds,
+    score,
+    score_batch,
+)
 from r2.lib.db import queries
 from r2.lib import mr_tools
 from r2.lib.utils import timeago, UrlParser
@@ -62,6 +75,9 @@ STDIN = sys.stdin
 STDOUT = sys.stdout
 STDERR = sys.stderr
 
+# how many things listing_heaps scores at once with the batch sorts
+SCORE_CHUNK_SIZE = 1000
+
 
 def top_score(thing):
     return score(thing.ups, thing.downs)
@@ -92,6 +108,12 @@ class MrTop(object):
         "controversial": controversy_score,
     }
 
+    # the same sorts, for arrays of ups and downs
+    LISTING_BATCH_SORTS = {
+        "top": score_batch,
+        "controversial": controversy_batch,
+    }
+
     def __init__(
         self, thing_type, min_id=None, fd=STDIN, out=STDOUT, err=STDERR
     ):
@@ -117,17 +139,19 @@ class MrTop(object):
             except (TypeError, ValueError):
                 raise AssertionError("Invalid min_id: {0!r}".format(min_id))
 
-    def join_things(self):
-        fields = []
+    def _field_defaults(self):
         defaults = {}
         for k, typ in self.fields.iteritems():
-            fields.append(k)
             if typ is int:
                 defaults[k] = 0
             elif typ is str:
                 defaults[k] = ""
+        return defaults
+
+    def join_things(self):
         mr_tools.join_things(
-            fields, fd=self.fd, out=self.out, err=self.err, defaults=defaults
+            list(self.fields), fd=self.fd, out=self.out, err=self.err,
+            defaults=self._field_defaults(),
         )
 
     @staticmethod
@@ -164,13 +188,15 @@ class MrTop(object):
 
         mr_tools.mr_map(process, fd=self.fd, out=self.out)
 
-    def time_listing_iter(self, thing, cutoff_by_interval):
+    def time_listing_iter(self, thing, cutoff_by_interval, scores=None):
         if thing.deleted:
             return
 
         thing_cls = self.thing_cls
         fname = make_fullname(thing_cls, thing.thing_id)
-        scores = {k: func(thing) for k, func in self.LISTING_SORTS.iteritems()}
+        if scores is None:
+            scores = {k: func(thing)
+                      for k, func in self.LISTING_SORTS.iteritems()}
 
         for interval, cutoff in cutoff_by_interval.iteritems():
             if thing.timestamp < cutoff:
@@ -202,6 +228,13 @@ class MrTop(object):
                         key = self.make_key("domain", sort, interval, d)
                         yield (key, value, thing.timestamp, fname)
 
+    def batch_scores(self, things):
+        """Return a dict of sort -> array of the things' scores."""
+        ups = array("l", [thing.ups for thing in things])
+        downs = array("l", [thing.downs for thing in things])
+        return {sort: func(ups, downs)
+                for sort, func in self.LISTING_BATCH_SORTS.iteritems()}
+
     def emit_thing_query(self, stream=STDOUT):
         assert self.min_id is not None
         stream.write(THING_TEMPLATE_SQL.format(
@@ -219,13 +252,7 @@ class MrTop(object):
         ))
 
     @classmethod
-    def store_keys(cls, key, listing):
-        """Look up query based on key, and update with provided listing.
-
-        :param str key: key generated by :py:method:`make_key`
-        :param list listing: sorted listing generated by
-            `mr_reduce_max_per_key`, generally by :py:method:`write_permacache`
-        """
+    def _get_query(cls, key):
         category, thing_cls, sort, time, uid = cls.split_key(key)
 
         query = None
@@ -242,6 +269,17 @@ class MrTop(object):
                 query = queries.get_domain_links(uid, sort, time)
 
         assert query, 'unknown query type for {}'.format(key)
+        return query
+
+    @classmethod
+    def store_keys(cls, key, listing):
+        """Look up query based on key, and update with provided listing.
+
+        :param str key: key generated by :py:method:`make_key`
+        :param list listing: sorted listing generated by
+            `mr_reduce_max_per_key`, generally by :py:method:`write_permacache`
+        """
+        query = cls._get_query(key)
 
         item_tuples = [
             (thing_fullname, float(value), float(timestamp))
@@ -249,10 +287,233 @@ class MrTop(object):
         ]
         # we only need locking updates for non-time-based listings, since for
         # time- based ones we're the only ones that ever update it
-        lock = time == 'all'
+        lock = cls.split_key(key)[3] == 'all'
 
         query._replace(item_tuples, lock=lock)
 
+    @classmethod
+    def store_listings(cls, listings):
+        """Update the queries for many keys at once.
+
+        Listings for time-based queries are written in a single batch,
+        since nothing else updates them; "all" listings still need to be
+        replaced one by one under a lock.
+
+        :param list listings: (key, listing) pairs, where each listing is
+            a list of (value, timestamp, fullname) tuples as collected by
+            :py:meth:`listing_heaps`
+        """
+        unlocked = {}
+        for key, listing in listings:
+            query = cls._get_query(key)
+            item_tuples = [
+                (thing_fullname, value, timestamp)
+                for value, timestamp, thing_fullname
+                in sorted(listing, reverse=True)
+            ]
+
+            if cls.split_key(key)[3] == 'all':
+                query._replace(item_tuples, lock=True)
+            else:
+                unlocked[query.iden] = query._dump(item_tuples)
+
+        if unlocked:
+            g.permacache.pessimistically_set_multi(unlocked)
+
+    def listing_heaps(self, intervals, fd, num=1000, shard=0, num_shards=1):
+        """Compute the listings for a sorted thing and data dump in-process.
+
+        This does the work of :py:meth:`join_things`, :py:meth:`time_listings`
+        and :py:meth:`reduce_listings` in a single pass, keeping a heap of
+        at most `num` items for every key rather than serializing every
+        item in between.
+
+        :param list intervals: the listing intervals to compute
+        :param file fd: concatenated thing and data dumps, sorted by thing id
+        :param int num: maximum listing size
+        :param int shard: which shard of the keys to compute
+        :param int num_shards: how many shards the keys are split into
+        :return: a dict mapping keys to unsorted lists of
+            (value, timestamp, fullname) tuples
+        """
+        cutoff_by_interval = self._get_cutoffs(intervals)
+        spec = self.fields.items()
+
+        @mr_tools.dataspec_m_thing(*spec)
+        def parse(thing):
+            return thing
+
+        counters = {}
+        joined = mr_tools.iter_joined_things(
+            list(self.fields), fd=fd, defaults=self._field_defaults(),
+            counters=counters,
+        )
+
+        heaps = {}
+        for rows in mr_tools.in_chunks(joined, SCORE_CHUNK_SIZE):
+            things = [parse(row) for row in rows]
+            scores_by_sort = self.batch_scores(things)
+
+            for i, thing in enumerate(things):
+                scores = {sort: values[i]
+                          for sort, values in scores_by_sort.iteritems()}
+                listing_items = self.time_listing_iter(
+                    thing, cutoff_by_interval, scores)
+
+                for key, value, timestamp, fname in listing_items:
+                    if num_shards > 1 and hash(key) % num_shards != shard:
+                        continue
+
+                    item = (float(value), timestamp, fname)
+                    heap = heaps.get(key)
+                    if heap is None:
+                        heaps[key] = [item]
+                    elif len(heap) < num:
+                        heappush(heap, item)
+                    elif item > heap[0]:
+                        heapreplace(heap, item)
+
+        self.err.write(
+            '%s items processed, %s skipped, %s listings\n' % (
+                counters['processed'], counters['skipped'], len(heaps)
+            )
+        )
+        return heaps
+
+    def _checkpoint_state(self, intervals, shard, num_shards, path):
+        # a new dump has new data, so identify the dump file itself and not
+        # just the arguments
+        stat = os.stat(path)
+        return {
+            "thing_type": self.thing_type,
+            "intervals": sorted(intervals),
+            "shard": shard,
+            "num_shards": num_shards,
+            "dump": [os.path.abspath(path), stat.st_size, int(stat.st_mtime)],
+        }
+
+    def _read_checkpoint(self, path, state):
+        """Return the last key written by an interrupted run, if any."""
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        last_key = checkpoint.pop("last_key", None)
+        if checkpoint != state:
+            # left behind by a run with different arguments
+            return None
+        return last_key
+
+    def _write_checkpoint(self, path, state, last_key):
+        checkpoint = dict(state, last_key=last_key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.rename(tmp_path, path)
+
+    def write_listings(self, heaps, checkpoint=None, state=None,
+                       batch_size=1000):
+        """Write computed listings to the permacache in batches.
+
+        Keys are written in sorted order, and if `checkpoint` is given the
+        last key of each batch is recorded there so that a run that's
+        interrupted can skip the keys it already wrote when it's resumed
+        with the same dump. Only the writes are skipped: the listings are
+        computed from the whole dump again first.
+
+        :param dict heaps: listings as computed by :py:meth:`listing_heaps`
+        :param str checkpoint: path of the checkpoint file
+        :param dict state: identifies the run the checkpoint belongs to
+        :param int batch_size: number of listings to write at once
+        """
+        keys = sorted(heaps)
+
+        if checkpoint:
+            last_key = self._read_checkpoint(checkpoint, state)
+            if last_key is not None:
+                keys = [key for key in keys if key > last_key]
+                self.err.write('resuming after %s\n' % last_key)
+            elif os.path.exists(checkpoint):
+                os.unlink(checkpoint)
+
+        for batch in mr_tools.in_chunks(keys, batch_size):
+            self.store_listings([(key, heaps.pop(key)) for key in batch])
+            if checkpoint:
+                self._write_checkpoint(checkpoint, state, batch[-1])
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.unlink(checkpoint)
+
+    def _compute_shard(self, intervals, path, num, shard, num_shards,
+                       checkpoint, batch_size):
+        state = None
+        if not path:
+            # there's no telling one stream from another, so there's nothing
+            # to resume
+            checkpoint = None
+        elif checkpoint:
+            if num_shards > 1:
+                checkpoint = "%s.%d" % (checkpoint, shard)
+            state = self._checkpoint_state(intervals, shard, num_shards, path)
+
+        if path:
+            with open(path) as fd:
+                heaps = self.listing_heaps(
+                    intervals, fd, num=num, shard=shard, num_shards=num_shards)
+        else:
+            heaps = self.listing_heaps(
+                intervals, self.fd, num=num, shard=shard,
+                num_shards=num_shards)
+
+        self.write_listings(
+            heaps, checkpoint=checkpoint, state=state, batch_size=batch_size)
+
+    def compute_listings(self, intervals, path=None, num=1000, workers=1,
+                         checkpoint=None, batch_size=1000):
+        """Compute and write listings from a sorted thing and data dump.
+
+        The streaming replacement for the join_things | time_listings |
+        write_permacache pipeline.  With more than one worker, the keys are
+        sharded by hash between forked processes that each read the whole
+        dump, so `path` is required.
+
+        :param list intervals: the listing intervals to compute
+        :param str path: path of the sorted dump, or None to read from `fd`
+        :param int num: maximum listing size
+        :param int workers: number of processes to shard the keys between
+        :param str checkpoint: path of the checkpoint file(s) used to skip
+            the listings an interrupted run already wrote from the same
+            `path`. The listings themselves are always computed again.
+        :param int batch_size: number of listings to write at once
+        """
+        if workers <= 1:
+            self._compute_shard(
+                intervals, path, num, 0, 1, checkpoint, batch_size)
+            return
+
+        assert path, "Need a dump file to compute listings in parallel"
+
+        processes = []
+        for shard in xrange(workers):
+            process = multiprocessing.Process(
+                target=self._compute_shard,
+                args=(intervals, path, num, shard, workers, checkpoint,
+                      batch_size),
+            )
+            process.start()
+            processes.append(process)
+
+        failed = []
+        for shard, process in enumerate(processes):
+            process.join()
+            if process.exitcode != 0:
+                failed.append(shard)
+
+        if failed:
+            raise RuntimeError("Shards {} failed".format(failed))
+
     @staticmethod
     def _sorting_key(x):
         """Cast iterable to a float."""
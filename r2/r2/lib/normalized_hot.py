@@ -20,6 +20,8 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+
+import hashlib
 import heapq
 import itertools
 from datetime import datetime, timedelta
@@ -27,6 +29,7 @@ from datetime import datetime, timedelta
 from pylons import app_globals as g
 
 from r2.config import feature
+from r2.lib.db import packed_listing
 from r2.lib.db.queries import _get_links, CachedResults
 from r2.lib.db.sorts import epoch_seconds
 
@@ -34,12 +37,36 @@ from r2.lib.db.sorts import epoch_seconds
 MAX_PER_SUBREDDIT = 150
 MAX_LINKS = 1000
 
+# the merged listing is built this many links at a time (growing as more of it
+# is read) and cached for this many seconds
+MERGE_CHUNK_SIZE = 100
+MERGED_CACHE_TIME = 60
+
+
+def _iter_hot_tuples(listing, hot_factor):
+    # heapq.merge sorts from smallest to largest so we need to flip
+    # ehot and hot to get the hottest links first
+    if isinstance(listing, packed_listing.PackedListing):
+        hots, timestamps = listing.columns(limit=MAX_PER_SUBREDDIT)
+        for i, hot in enumerate(hots):
+            yield (-hot / hot_factor, -hot, listing.fullname(i), timestamps[i])
+    else:
+        for link_name, hot, timestamp in listing[:MAX_PER_SUBREDDIT]:
+            yield (-hot / hot_factor, -hot, link_name, timestamp)
+
 
 def get_hot_tuples(sr_ids, ageweight=None):
+    """Return a dict of sr_id -> iterator of hot tuples for the subreddit.
+
+    The tuples are (-effective_hot, -hot, link_name, timestamp) and are
+    decoded from the subreddit's listing as they're consumed.
+
+    """
+
     queries_by_sr_id = {sr_id: _get_links(sr_id, sort='hot', time='all')
                         for sr_id in sr_ids}
     CachedResults.fetch_multi(queries_by_sr_id.values(), stale=True)
-    tuples_by_srid = {sr_id: [] for sr_id in sr_ids}
+    tuples_by_srid = {sr_id: iter(()) for sr_id in sr_ids}
 
     now_seconds = epoch_seconds(datetime.now(g.tz))
 
@@ -48,14 +75,7 @@ def get_hot_tuples(sr_ids, ageweight=None):
             continue
 
         hot_factor = get_hot_factor(q.data[0], now_seconds, ageweight)
-
-        for link_name, hot, timestamp in q.data[:MAX_PER_SUBREDDIT]:
-            effective_hot = hot / hot_factor
-            # heapq.merge sorts from smallest to largest so we need to flip
-            # ehot and hot to get the hottest links first
-            tuples_by_srid[sr_id].append(
-                (-effective_hot, -hot, link_name, timestamp)
-            )
+        tuples_by_srid[sr_id] = _iter_hot_tuples(q.data, hot_factor)
 
     return tuples_by_srid
 
@@ -79,27 +99,108 @@ def get_hot_factor(qdata, now, ageweight):
     return max(hot + ((now - timestamp) * ageweight) / 45000.0, 1.0)
 
 
-def normalized_hot(sr_ids, obey_age_limit=True, ageweight=None):
-    timer = g.stats.get_timer("normalized_hot")
-    timer.start()
+class NormalizedHotListing(object):
+    """The normalized hot listing of several subreddits, merged lazily.
 
-    if not sr_ids:
-        return []
+    Links are merged in growing chunks as the listing is iterated over, so
+    reading the first page only decodes and merges the top of each
+    subreddit's listing. The merged links are cached briefly so the next page
+    (or the next user with the same subreddits) can start from them.
 
-    if not feature.is_enabled("scaled_normalized_hot"):
-        ageweight = None
+    """
 
-    tuples_by_srid = get_hot_tuples(sr_ids, ageweight=ageweight)
+    # builders should only read as much of the listing as they need
+    lazy_listing = True
+
+    def __init__(self, sr_ids, obey_age_limit=True, ageweight=None):
+        if not feature.is_enabled("scaled_normalized_hot"):
+            ageweight = None
+
+        self.sr_ids = sr_ids
+        self.obey_age_limit = obey_age_limit
+        self.ageweight = ageweight
+        self._names = None
+        self._exhausted = False
+        self._merged = None
+
+    @property
+    def cache_key(self):
+        sr_ids = ",".join(str(sr_id) for sr_id in sorted(set(self.sr_ids)))
+        iden = "%s:%s:%s" % (sr_ids, self.ageweight, self.obey_age_limit)
+        return "normalized_hot:" + hashlib.md5(iden).hexdigest()
+
+    def _load(self):
+        cached = g.gencache.get(self.cache_key)
+        if cached:
+            names, self._exhausted = cached
+            self._names = list(names)
+            g.stats.simple_event("normalized_hot.cache.hit")
+        else:
+            self._names = []
+            g.stats.simple_event("normalized_hot.cache.miss")
+
+    def _get_merged(self):
+        if self._merged is None:
+            if self.obey_age_limit:
+                cutoff = datetime.now(g.tz) - timedelta(days=g.HOT_PAGE_AGE)
+                oldest = epoch_seconds(cutoff)
+            else:
+                oldest = 0.
+
+            # skip anything we already got from the cache. hot order may have
+            # changed since it was cached, so that's by name and not position
+            cached_names = set(self._names)
+
+            tuples_by_srid = get_hot_tuples(self.sr_ids, self.ageweight)
+            merged = heapq.merge(*tuples_by_srid.values())
+            generator = (link_name for ehot, hot, link_name, timestamp in merged
+                                   if timestamp > oldest and
+                                      link_name not in cached_names)
+
+            self._merged = itertools.islice(
+                generator, MAX_LINKS - len(self._names))
+        return self._merged
+
+    def _extend(self):
+        timer = g.stats.get_timer("normalized_hot")
+        timer.start()
+
+        chunk_size = max(MERGE_CHUNK_SIZE, len(self._names))
+        chunk = list(itertools.islice(self._get_merged(), chunk_size))
+        self._names.extend(chunk)
+        self._exhausted = (len(chunk) < chunk_size or
+                           len(self._names) >= MAX_LINKS)
+        g.gencache.set(self.cache_key, (self._names, self._exhausted),
+                       time=MERGED_CACHE_TIME)
+
+        timer.stop()
+
+    def __iter__(self):
+        if not self.sr_ids:
+            return
+
+        if self._names is None:
+            self._load()
+
+        i = 0
+        while True:
+            while i < len(self._names):
+                yield self._names[i]
+                i += 1
+
+            if self._exhausted:
+                return
+            self._extend()
+
+    def __repr__(self):
+        return "<NormalizedHotListing %d srs>" % len(self.sr_ids)
 
-    if obey_age_limit:
-        cutoff = datetime.now(g.tz) - timedelta(days=g.HOT_PAGE_AGE)
-        oldest = epoch_seconds(cutoff)
-    else:
-        oldest = 0.
-
-    merged = heapq.merge(*tuples_by_srid.values())
-    generator = (link_name for ehot, hot, link_name, timestamp in merged
-                           if timestamp > oldest)
-    ret = list(itertools.islice(generator, MAX_LINKS))
-    timer.stop()
-    return ret
+
+def normalized_hot(sr_ids, obey_age_limit=True, ageweight=None):
+    """Return the merged hot listing of the subreddits as a list."""
+    if not sr_ids:
+        return []
+
+    listing = NormalizedHotListing(sr_ids, obey_age_limit=obey_age_limit,
+                                   ageweight=ageweight)
+    return list(listing)
@@ -22,7 +22,12 @@
 
 import cProfile
 import pstats
+import sys
+import thread
+from collections import Counter
 from functools import wraps, partial
+from threading import Event, Lock, Thread
+import time
 
 
 def profile(fn):
@@ -40,3 +45,108 @@ def profile(fn):
 
         return ret
     return _fn
+
+
+# where time is attributed in sampled stacks. each sample goes to the category
+# of the innermost frame that belongs to one of these modules.
+SAMPLE_CATEGORIES = (
+    ("db", ("r2.lib.db", "sqlalchemy", "pycassa", "psycopg2")),
+    ("cache", ("r2.lib.cache", "r2.lib.memoize", "pylibmc")),
+    ("render", ("r2.lib.pages", "r2.lib.template_helpers", "r2.lib.wrapped",
+                "r2.lib.jsontemplates", "mako", "_mako", "r2.templates")),
+    ("builder", ("r2.models.builder",)),
+    ("controller", ("r2.controllers",)),
+)
+
+
+def sample_category(stack):
+    """Return the category for a stack of (module, function) pairs."""
+    for module, function in reversed(stack):
+        for category, prefixes in SAMPLE_CATEGORIES:
+            if module.startswith(prefixes):
+                return category
+    return "other"
+
+
+def collapse_samples(samples, root=None):
+    """Return lines in the "collapsed stack" format flamegraph tools read.
+
+    Each line is the semicolon-separated stack from the outermost frame in,
+    followed by the number of times it was sampled. `root` and the stack's
+    category are added as the outermost frames.
+
+    """
+
+    lines = []
+    for stack, count in samples.iteritems():
+        frames = ["%s:%s" % frame for frame in stack]
+        frames.insert(0, sample_category(stack))
+        if root:
+            frames.insert(0, root)
+        lines.append("%s %d" % (";".join(frames), count))
+    return lines
+
+
+class SamplingProfiler(object):
+    """Sample the stacks of chosen threads at a fixed interval.
+
+    One daemon thread wakes up every `interval` seconds while any thread is
+    being profiled and records where each of those threads is. Profiled
+    threads don't do any extra work, so the cost is roughly the time it
+    takes to walk their stacks, and nothing at all while no thread is
+    being profiled.
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.samples_by_thread = {}
+        self.sampler = None
+
+    def start(self):
+        """Start sampling the calling thread."""
+        with self.lock:
+            self.samples_by_thread[thread.get_ident()] = Counter()
+            if not self.sampler:
+                self.sampler = Thread(target=self._run,
+                                      name="SamplingProfiler")
+                self.sampler.daemon = True
+                self.sampler.start()
+        self.wakeup.set()
+
+    def stop(self):
+        """Stop sampling the calling thread and return its samples.
+
+        The samples are a Counter of stacks, each a tuple of (module,
+        function) pairs starting with the outermost frame.
+
+        """
+
+        with self.lock:
+            return self.samples_by_thread.pop(thread.get_ident(), Counter())
+
+    def _run(self):
+        while True:
+            with self.lock:
+                if not self.samples_by_thread:
+                    self.wakeup.clear()
+            self.wakeup.wait()
+
+            time.sleep(self.interval)
+            self.sample()
+
+    def sample(self):
+        frames_by_thread = sys._current_frames()
+        with self.lock:
+            for thread_id, samples in self.samples_by_thread.iteritems():
+                frame = frames_by_thread.get(thread_id)
+                stack = []
+                while frame is not None:
+                    module = frame.f_globals.get("__name__", "?")
+                    stack.append((module, frame.f_code.co_name))
+                    frame = frame.f_back
+                if stack:
+                    stack.reverse()
+                    samples[tuple(stack)] += 1
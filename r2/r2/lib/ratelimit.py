@@ -31,9 +31,15 @@ simultaneous accesses may push the actual rate limit above the intended limit.
 The RateLimit class implements the "check a rate limit" and the "record a usage"
 operations and a policy of how the rate limit configuration is loaded from the
 application configuration.
+
+Limits that are recorded very often can trade some accuracy for fewer cache
+round trips by passing exact=False to record_usage or record_usage_multi. Their
+usage is then counted in the process and sent to the cache in aggregate every
+`ratelimit_flush_interval_ms`, see LocalUsage.
 """
 
 import collections
+import threading
 import time
 
 import pylibmc
@@ -85,16 +91,27 @@ def get_timeslice(slice_seconds):
     return TimeSlice(slice_start, slice_end)
 
 
-def record_usage(key_prefix, time_slice):
+def record_usage(key_prefix, time_slice, exact=True):
     """Record usage of a ratelimit for the specified time slice.
 
     The total usage (including this one) of the ratelimit is returned or
     RatelimitError is raised if something went wrong during the process.
 
+    If `exact` is False and local counting is enabled the usage may only be
+    counted in this process for now, and the total returned may miss up to
+    `ratelimit_local_overshoot` recent uses in each other process.
+
     """
 
     key = _make_ratelimit_cache_key(key_prefix, time_slice)
 
+    if not exact and g.ratelimit_flush_interval_ms:
+        return local_usage.record(key, time_slice)
+
+    return _record_usage_exact(key, time_slice)
+
+
+def _record_usage_exact(key, time_slice):
     try:
         g.ratelimitcache.add(key, 0, time=time_slice.remaining)
 
@@ -112,7 +129,7 @@ def record_usage(key_prefix, time_slice):
         raise RatelimitError(e)
 
 
-def record_usage_multi(prefix_slices):
+def record_usage_multi(prefix_slices, exact=True):
     """Record usage of multiple rate limits.
 
     If any of the of the rate limits expire during the processing of the
@@ -123,6 +140,7 @@ def record_usage_multi(prefix_slices):
 
     Arguments:
         prefix_slices: A list of (prefix, timeslice)
+        exact: See record_usage.
 
     Raises:
         RateLimitError if anything goes wrong.
@@ -131,27 +149,15 @@ def record_usage_multi(prefix_slices):
 
     """
 
-    keys = [_make_ratelimit_cache_key(k, t) for k, t in prefix_slices]
+    key_slices = [(_make_ratelimit_cache_key(k, t), t)
+                  for k, t in prefix_slices]
 
-    try:
-        # Can't use add_multi because the various timeslices may be different.
-        now = int(time.time())
-        for key, (_, time_slice) in zip(keys, prefix_slices):
-            g.ratelimitcache.add(key, 0, time=time_slice.end - now + 1)
+    if not exact and g.ratelimit_flush_interval_ms:
+        local_usage.record_multi(key_slices)
+        return
 
-        try:
-            g.ratelimitcache.incr_multi(keys)
-        except pylibmc.NotFound:
-            # Some part of the previous round of ratelimiting fell out in the
-            # time between calling `add` and calling `incr`.
-            now = int(time.time())
-            for key, (_, time_slice) in zip(keys, prefix_slices):
-                if now < time_slice.end:
-                    if g.ratelimitcache.add(key, 1,
-                                            time=time_slice.end - now + 1):
-                        g.stats.simple_event("ratelimit.eviction")
-    except pylibmc.Error as e:
-        raise RatelimitError(e)
+    LocalUsage._send({key: (time_slice, 1) for key, time_slice in key_slices},
+                     read_totals=False)
 
 
 def get_usage(key_prefix, time_slice):
@@ -160,12 +166,17 @@ def get_usage(key_prefix, time_slice):
     key = _make_ratelimit_cache_key(key_prefix, time_slice)
 
     try:
-        return g.ratelimitcache.get(key)
+        usage = g.ratelimitcache.get(key)
     except pylibmc.NotFound:
-        return 0
+        usage = 0
     except pylibmc.Error as e:
         raise RatelimitError(e)
 
+    pending = local_usage.get_pending(key)
+    if pending:
+        usage = (usage or 0) + pending
+    return usage
+
 
 def get_usage_multi(prefix_slices):
     """Return the current usage of several rate limits.
@@ -180,10 +191,207 @@ def get_usage_multi(prefix_slices):
 
     try:
         values = g.ratelimitcache.get_multi(keys)
-        return [values.get(k, 0) for k in keys]
     except pylibmc.Error as e:
         raise RatelimitError(e)
 
+    return [values.get(k, 0) + local_usage.get_pending(k) for k in keys]
+
+
+class LocalUsage(object):
+    """Rate limit usage counted in this process but not yet in the cache.
+
+    Usage is added up per key and flushed to g.ratelimitcache by whichever
+    request records usage once `ratelimit_flush_interval_ms` has passed
+    since the last flush, or once a key has `ratelimit_local_overshoot`
+    uses waiting. A flush sends all the waiting counts with a few multi
+    operations and reads back the new totals.
+
+    The usage reported for a key is the total read at its last flush plus
+    everything counted here since. The first use of a key in each time
+    slice is recorded in the cache directly so that total is never missing.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (time slice, uses not sent to the cache yet)
+        self.pending = {}
+        # key -> (time slice, total usage in the cache at the last flush)
+        self.flushed = {}
+        self.last_flush = time.time()
+        self.flushing = False
+
+    def get_pending(self, key):
+        entry = self.pending.get(key)
+        return entry[1] if entry else 0
+
+    def record(self, key, time_slice):
+        with self.lock:
+            flushed = self.flushed.get(key)
+            if flushed and flushed[0] == time_slice:
+                count = self.get_pending(key) + 1
+                self.pending[key] = (time_slice, count)
+                usage = flushed[1] + count
+            else:
+                count = 0
+                usage = None
+
+            interval = g.ratelimit_flush_interval_ms / 1000.
+            should_flush = not self.flushing and (
+                count >= g.ratelimit_local_overshoot or
+                time.time() - self.last_flush >= interval
+            )
+            if should_flush:
+                self.flushing = True
+
+        try:
+            if usage is None:
+                usage = _record_usage_exact(key, time_slice)
+                with self.lock:
+                    self.flushed[key] = (time_slice, usage)
+        finally:
+            if should_flush:
+                self.flush()
+
+        if should_flush:
+            # we know a more recent total now
+            with self.lock:
+                flushed = self.flushed.get(key)
+                if flushed:
+                    usage = flushed[1] + self.get_pending(key)
+
+        return usage
+
+    def record_multi(self, key_slices):
+        """Record one use of each key like `record`, without the totals."""
+        with self.lock:
+            unflushed = {}
+            max_count = 0
+            for key, time_slice in key_slices:
+                flushed = self.flushed.get(key)
+                if flushed and flushed[0] == time_slice:
+                    count = self.get_pending(key) + 1
+                    self.pending[key] = (time_slice, count)
+                    max_count = max(max_count, count)
+                else:
+                    unflushed[key] = (time_slice, 1)
+
+            interval = g.ratelimit_flush_interval_ms / 1000.
+            should_flush = not self.flushing and (
+                max_count >= g.ratelimit_local_overshoot or
+                time.time() - self.last_flush >= interval
+            )
+            if should_flush:
+                self.flushing = True
+
+        try:
+            if unflushed:
+                # the first uses all go to the cache together
+                totals = self._send(unflushed)
+                with self.lock:
+                    for key, usage in totals.iteritems():
+                        self.flushed[key] = (unflushed[key][0], usage)
+        finally:
+            if should_flush:
+                self.flush()
+
+    def flush(self):
+        """Send the waiting usage to the cache and read back the totals.
+
+        The caller must have set self.flushing.
+
+        """
+
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.last_flush = time.time()
+
+            # forget about totals from time slices that are over
+            now = int(time.time())
+            self.flushed = {
+                key: (time_slice, usage)
+                for key, (time_slice, usage) in self.flushed.iteritems()
+                if time_slice.end > now
+            }
+
+        try:
+            totals = self._send(pending)
+        except Exception:
+            with self.lock:
+                # put the usage back to be sent by the next flush. anything
+                # recorded meanwhile for a newer time slice replaces it.
+                for key, (time_slice, count) in pending.iteritems():
+                    entry = self.pending.get(key)
+                    if entry and entry[0] != time_slice:
+                        continue
+                    if entry:
+                        count += entry[1]
+                    self.pending[key] = (time_slice, count)
+            raise
+        finally:
+            with self.lock:
+                self.flushing = False
+
+        with self.lock:
+            for key, usage in totals.iteritems():
+                time_slice = pending[key][0]
+                self.flushed[key] = (time_slice, usage)
+
+    @staticmethod
+    def _send(pending, read_totals=True):
+        """Add the pending counts to the cache and return the new totals.
+
+        If `read_totals` is False the totals aren't read back and None is
+        returned.
+
+        """
+
+        now = int(time.time())
+        pending = {
+            key: (time_slice, count)
+            for key, (time_slice, count) in pending.iteritems()
+            if time_slice.end > now
+        }
+        if not pending:
+            return {}
+
+        keys_by_end = collections.defaultdict(list)
+        keys_by_count = collections.defaultdict(list)
+        for key, (time_slice, count) in pending.iteritems():
+            keys_by_end[time_slice.end].append(key)
+            keys_by_count[count].append(key)
+
+        try:
+            # the keys should already exist because their first use was
+            # recorded directly, but they can have been evicted since
+            for end, keys in keys_by_end.iteritems():
+                g.ratelimitcache.add_multi(
+                    {key: 0 for key in keys}, time=end - now + 1)
+
+            for count, keys in keys_by_count.iteritems():
+                try:
+                    g.ratelimitcache.incr_multi(keys, delta=count)
+                except pylibmc.NotFound:
+                    # some keys fell out between the add and the incr. the
+                    # others have been incremented so the add will fail.
+                    for key in keys:
+                        time_slice = pending[key][0]
+                        if g.ratelimitcache.add(key, count,
+                                                time=time_slice.end - now + 1):
+                            g.stats.simple_event("ratelimit.eviction")
+
+            if not read_totals:
+                return None
+            totals = g.ratelimitcache.get_multi(pending.keys())
+        except pylibmc.Error as e:
+            raise RatelimitError(e)
+
+        return {key: totals.get(key, 0) for key in pending}
+
+
+local_usage = LocalUsage()
+
 
 class RateLimit(object):
     """A general purpose whole system rate limit.
@@ -208,6 +416,8 @@ class RateLimit(object):
         key: The ratelimitcache key prefix.
         limit: The count of events per self.seconds to allow.
         seconds: The length of the interval over which to limit rates.
+        exact: Whether every usage is recorded in the cache right away (see
+            record_usage). Defaults to True.
 
     Example:
         class MyRateLimit(RateLimit):
@@ -230,6 +440,7 @@ class RateLimit(object):
             (if not limited) my_system.set_thing_limit
     """
     sample_rate = 0.1
+    exact = True
 
     def _record_event(self, event_type_template):
         g.stats.event_count(
@@ -265,7 +476,7 @@ class RateLimit(object):
     def record_usage(self):
         """Record a new usage within the current timeslice."""
         self._record_event('set_{event_type}_limit')
-        return record_usage(self.key, self.timeslice)
+        return record_usage(self.key, self.timeslice, exact=self.exact)
 
     @staticmethod
     def record_multi(ratelimits):
@@ -274,7 +485,8 @@ class RateLimit(object):
         """
         for r in ratelimits:
             r._record_event('set_{event_type}_limit')
-        record_usage_multi([(r.key, r.timeslice) for r in ratelimits])
+        record_usage_multi([(r.key, r.timeslice) for r in ratelimits],
+                           exact=all(r.exact for r in ratelimits))
 
 
 class LiveConfigRateLimit(RateLimit):
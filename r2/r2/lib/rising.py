@@ -20,79 +20,154 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from datetime import datetime
 import heapq
 
 from pylons import app_globals as g
 
 from r2.lib import count
-from r2.lib.sgm import sgm
+from r2.lib.bucketed_set import BucketedSet
+from r2.lib.utils import tup
 from r2.models.link import Link
 
 
+# links are marked as changed into per-minute buckets that calc_rising reads
+# back on its next run. if it falls further behind than the buckets live, or
+# some of the changes couldn't be recorded, it starts over from a full fetch.
+CHANGED_BUCKET_SECONDS = 60
+CHANGED_BUCKETS = 60
+CHANGED_SHARDS = 16
+STATE_KEY = "rising:state"
+SR_PREFIX = "rising:sr:"
+SR_IDS_KEY = "rising:srids"
+SR_RISING_TTL = 60 * 60
+
+
+changed_links = BucketedSet("rising:changed:", CHANGED_BUCKET_SECONDS,
+                            CHANGED_BUCKETS, num_shards=CHANGED_SHARDS)
+
+
+def mark_changed(links):
+    """Queue links for rescoring on the next calc_rising run.
+
+    Called with new links and links that have been voted on.
+
+    """
+
+    changed_links.add(link._fullname for link in tup(links))
+
+
+def get_changed(first_bucket, last_bucket):
+    """Return the links changed in the buckets, or None if unknown."""
+    changed, complete = changed_links.get(first_bucket, last_bucket)
+    if not complete:
+        g.stats.simple_event("rising.changed_incomplete")
+        return None
+    return changed
+
+
 def calc_rising():
-    link_counts = count.get_link_counts()
+    """Return the rising list as (fullname, score, sr_id) sorted by score.
 
-    links = Link._by_fullname(link_counts.keys(), data=True)
+    The vote counts of every eligible link are kept in the cache between
+    runs so only links that are new or have changed since the last run
+    (see mark_changed) need to be fetched.
 
-    def score(link):
-        count = link_counts[link._fullname][0]
-        return float(link._ups) / max(count, 1)
+    """
+
+    link_counts = count.get_link_counts()
+    bucket = changed_links.bucket()
+
+    changed = None
+    state = g.gencache.get(STATE_KEY, allow_local=False)
+    if state and bucket - state["bucket"] < CHANGED_BUCKETS:
+        # start a bucket early to pick up anything written into it after
+        # the last run read it, or by a server with a slightly slow clock
+        changed = get_changed(state["bucket"] - 1, bucket)
+
+    if changed is not None:
+        votes_by_link = state["links"]
+    else:
+        changed = set(link_counts)
+        votes_by_link = {}
+
+    to_fetch = [name for name in link_counts
+                if name in changed or name not in votes_by_link]
+    links = Link._by_fullname(to_fetch, data=True)
+    for name, link in links.iteritems():
+        votes_by_link[name] = (link._ups, link.sr_id)
+
+    # forget links that have aged out of the rising period
+    votes_by_link = {name: votes_by_link[name] for name in link_counts
+                     if name in votes_by_link}
+    g.gencache.set(STATE_KEY, {"bucket": bucket, "links": votes_by_link})
 
     # build the rising list, excluding items having 1 or less upvotes
     rising = []
-    for link in links.values():
-        if link._ups > 1:
-            rising.append((link._fullname, score(link), link.sr_id))
+    for name, (ups, sr_id) in votes_by_link.iteritems():
+        if ups > 1:
+            score = float(ups) / max(link_counts[name][0], 1)
+            rising.append((name, score, sr_id))
 
     # return rising sorted by score
     return sorted(rising, key=lambda x: x[1], reverse=True)
 
 
-def set_rising():
-    g.gencache.set("all:rising", calc_rising())
-
-
-def get_all_rising():
-    return g.gencache.get("all:rising", [], stale=True)
-
-
-def get_rising(sr):
-    rising = get_all_rising()
-    return [link for link, score, sr_id in rising if sr.keep_for_rising(sr_id)]
+def get_rising_tuples(rising, limit):
+    """Split a rising list into the top limit links for each subreddit.
 
+    The tuples are (-normalized score, -score, fullname) so that the lists
+    for several subreddits can be merged directly.
 
-def get_rising_tuples(sr_ids):
-    rising = get_all_rising()
+    """
 
-    tuples_by_srid = {sr_id: [] for sr_id in sr_ids}
+    tuples_by_srid = {}
     top_rising = {}
 
     for link, score, sr_id in rising:
-        if sr_id not in sr_ids:
+        tuples = tuples_by_srid.setdefault(sr_id, [])
+        if len(tuples) >= limit:
             continue
 
         if sr_id not in top_rising:
             top_rising[sr_id] = score
 
         norm_score = score / top_rising[sr_id]
-        tuples_by_srid[sr_id].append((-norm_score, -score, link))
+        tuples.append((-norm_score, -score, link))
 
     return tuples_by_srid
 
 
+def set_rising():
+    rising = calc_rising()
+    g.gencache.set("all:rising", rising)
+
+    tuples_by_srid = get_rising_tuples(rising, g.rising_links_per_subreddit)
+    g.gencache.set_multi(tuples_by_srid, prefix=SR_PREFIX, time=SR_RISING_TTL)
+
+    # subreddits with nothing rising anymore would otherwise keep their old
+    # list until it expires
+    old_sr_ids = g.gencache.get(SR_IDS_KEY, allow_local=False) or []
+    gone_sr_ids = set(old_sr_ids) - set(tuples_by_srid)
+    if gone_sr_ids:
+        g.gencache.delete_multi(
+            [SR_PREFIX + str(sr_id) for sr_id in gone_sr_ids])
+    g.gencache.set(SR_IDS_KEY, tuples_by_srid.keys())
+
+
+def get_all_rising():
+    return g.gencache.get("all:rising", [], stale=True)
+
+
+def get_rising(sr):
+    rising = get_all_rising()
+    return [link for link, score, sr_id in rising if sr.keep_for_rising(sr_id)]
+
+
 def normalized_rising(sr_ids):
     if not sr_ids:
         return []
 
-    tuples_by_srid = sgm(
-        cache=g.gencache,
-        keys=sr_ids,
-        miss_fn=get_rising_tuples,
-        prefix='rising:',
-        time=90,
-    )
-
+    tuples_by_srid = g.gencache.get_multi(sr_ids, prefix=SR_PREFIX, stale=True)
     merged = heapq.merge(*tuples_by_srid.values())
 
     return [link_name for norm_score, score, link_name in merged]
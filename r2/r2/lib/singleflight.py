@@ -0,0 +1,165 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+"""In-process coalescing of duplicate concurrent work.
+
+When many greenlets or threads in one process miss the cache for the same key
+at the same time, only one of them (the leader) needs to do the expensive
+work. The others wait for the leader and share its result. This only
+coalesces within a process; callers that need to coordinate across processes
+should still take a memcache lock inside the coalesced function.
+
+"""
+
+import cPickle as pickle
+import sys
+import threading
+
+from pylons import app_globals as g
+
+
+class _Call(object):
+    def __init__(self):
+        self.owner = threading.current_thread()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class SingleFlight(object):
+    """Share the results of concurrent calls for the same key.
+
+    Waiters receive a copy of the leader's result (made the same way the
+    cache would by pickling) so they can't see each other's modifications.
+    Stats on executed and coalesced calls are sent to
+    ``singleflight.<name>``.
+
+    """
+
+    def __init__(self, name, copy_results=True):
+        self.name = name
+        self.copy_results = copy_results
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def _copy(self, value):
+        if not self.copy_results or value is None:
+            return value
+        return pickle.loads(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def _count(self, executed=0, coalesced=0):
+        counter = g.stats.get_counter("singleflight.%s" % self.name)
+        if counter:
+            if executed:
+                counter.increment("executed", delta=executed)
+            if coalesced:
+                counter.increment("coalesced", delta=coalesced)
+
+    def _claim(self, keys):
+        """Split keys into calls we lead and calls already in flight."""
+        current = threading.current_thread()
+        mine = {}
+        theirs = {}
+        with self.lock:
+            for key in keys:
+                call = self.calls.get(key)
+                if call is None:
+                    call = self.calls[key] = _Call()
+                    mine[key] = call
+                elif call.owner is current:
+                    # this is a recursive call from the leader itself; waiting
+                    # would deadlock so just run it again
+                    mine[key] = _Call()
+                else:
+                    theirs[key] = call
+        return mine, theirs
+
+    def _finish(self, calls):
+        with self.lock:
+            for key, call in calls.iteritems():
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+        for call in calls.itervalues():
+            call.done.set()
+
+    def do(self, key, fn, *a, **kw):
+        """Return fn(*a, **kw), sharing the call with concurrent callers."""
+        mine, theirs = self._claim([key])
+
+        if theirs:
+            self._count(coalesced=1)
+            return self._copy(theirs[key].wait())
+
+        call = mine[key]
+        self._count(executed=1)
+        try:
+            call.result = fn(*a, **kw)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._finish(mine)
+        return call.result
+
+    def do_multi(self, keys, fn):
+        """Return a dict of results for keys from fn(keys).
+
+        fn is called once with only the keys that aren't already being
+        fetched by another caller and must return a dict; keys missing from
+        it are missing from our result too. Results for keys in flight
+        elsewhere are waited for and merged in.
+
+        """
+
+        keys = list(keys)
+        mine, theirs = self._claim(keys)
+        ret = {}
+
+        if mine:
+            self._count(executed=len(mine))
+            try:
+                ret = fn([key for key in keys if key in mine])
+            except:
+                exc_info = sys.exc_info()
+                for call in mine.itervalues():
+                    call.exc_info = exc_info
+                raise
+            else:
+                for key, call in mine.iteritems():
+                    call.result = ret.get(key)
+            finally:
+                self._finish(mine)
+
+        if theirs:
+            self._count(coalesced=len(theirs))
+            for key, call in theirs.iteritems():
+                result = call.wait()
+                if result is not None:
+                    ret[key] = self._copy(result)
+
+        return ret
@@ -457,6 +457,16 @@ class CacheStats:
             self.parent.cache_count_multi(data)
 
 
+class LRUCacheStats(CacheStats):
+    def __init__(self, parent, cache_name):
+        CacheStats.__init__(self, parent, cache_name)
+        self.eviction_stat_name = '%s.eviction' % self.cache_name
+
+    def cache_eviction(self, delta=1):
+        if delta:
+            self.parent.cache_count_multi({self.eviction_stat_name: delta})
+
+
 class StaleCacheStats(CacheStats):
     def __init__(self, parent, cache_name):
         CacheStats.__init__(self, parent, cache_name)
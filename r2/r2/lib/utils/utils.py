@@ -24,6 +24,7 @@ import base64
 import ConfigParser
 import cPickle as pickle
 import functools
+import heapq
 import itertools
 import math
 import os
@@ -1331,6 +1332,25 @@ def UniqueIterator(iterator, key = lambda x: x):
 
     return IteratorFilter(iterator, no_dups)
 
+def _decorate_for_merge(iterable, index, key):
+    for position, item in enumerate(iterable):
+        yield key(item), index, position, item
+
+def merge_sorted(iterables, cmp=None):
+    """Lazily merge iterables that are each already sorted.
+
+    Items come out in the same order that a stable sort of all the iterables
+    concatenated together would give, but each iterable is only read as far
+    as needed to produce the items consumed so far.
+
+    """
+
+    key = functools.cmp_to_key(cmp) if cmp else lambda x: x
+    decorated = [_decorate_for_merge(iterable, index, key)
+                 for index, iterable in enumerate(iterables)]
+    for item in heapq.merge(*decorated):
+        yield item[-1]
+
 def safe_eval_str(unsafe_str):
     return unsafe_str.replace('\\x3d', '=').replace('\\x26', '&')
 
@@ -31,7 +31,7 @@ from r2.lib.eventcollector import Event
 from r2.lib.utils import epoch_timestamp
 from r2.models import Account, Thing
 from r2.models.last_modified import LastModified
-from r2.models.vote import Vote, VotesByAccount
+from r2.models.vote import Vote, VoteDetailsByThing, VotesByAccount
 
 from r2.lib.geoip import organization_by_ips
 
@@ -122,26 +122,35 @@ def convert_old_vote_data(data, timestamp):
     return converted
 
 
+def _parse_vote_message(msg):
+    """Return the vote data from a queue message, or None if it's invalid."""
+    vote_data = json.loads(msg.body)
+    hook = hooks.get_hook('vote.validate_vote_data')
+    if hook.call_until_return(msg=msg, vote_data=vote_data) is False:
+        # Corrupt records in the queue. Ignore them.
+        print "Ignoring invalid vote by %s on %s %s" % (
+                vote_data.get('user_id', '<unknown>'),
+                vote_data.get('thing_fullname', '<unknown>'),
+                vote_data)
+        return None
+
+    # if it's an old-style vote, convert to the new format
+    if "uid" in vote_data:
+        vote_data = convert_old_vote_data(vote_data, msg.timestamp)
+
+    return vote_data
+
+
 def consume_vote_queue(queue):
     @g.stats.amqp_processor(queue)
     def process_message(msg):
         timer = g.stats.get_timer("new_voting.%s" % queue)
         timer.start()
 
-        vote_data = json.loads(msg.body)
-        hook = hooks.get_hook('vote.validate_vote_data')
-        if hook.call_until_return(msg=msg, vote_data=vote_data) is False:
-            # Corrupt records in the queue. Ignore them.
-            print "Ignoring invalid vote by %s on %s %s" % (
-                    vote_data.get('user_id', '<unknown>'),
-                    vote_data.get('thing_fullname', '<unknown>'),
-                    vote_data)
+        vote_data = _parse_vote_message(msg)
+        if vote_data is None:
             return
 
-        # if it's an old-style vote, convert to the new format
-        if "uid" in vote_data:
-            vote_data = convert_old_vote_data(vote_data, msg.timestamp)
-
         user = Account._byID(vote_data.pop("user_id"), data=True)
         thing = Thing._by_fullname(vote_data.pop("thing_fullname"), data=True)
 
@@ -171,4 +180,112 @@ def consume_vote_queue(queue):
 
             timer.flush()
 
-    amqp.consume_items(queue, process_message, verbose=False)
+    @g.stats.amqp_processor(queue)
+    def process_batch(msgs):
+        timer = g.stats.get_timer("new_voting.%s.batch" % queue)
+        timer.start()
+
+        vote_datas = filter(None, [_parse_vote_message(msg) for msg in msgs])
+        if not vote_datas:
+            return
+
+        users = Account._byID(
+            list({vote_data["user_id"] for vote_data in vote_datas}),
+            data=True, return_dict=True)
+        things = Thing._by_fullname(
+            list({vote_data["thing_fullname"] for vote_data in vote_datas}),
+            data=True, return_dict=True)
+
+        timer.intermediate("preamble")
+
+        votes_to_create = []
+        for vote_data in vote_datas:
+            user = users[vote_data.pop("user_id")]
+            thing = things[vote_data.pop("thing_fullname")]
+            votes_to_create.append((user, thing, vote_data))
+
+        lock_keys = sorted({
+            "vote-%s-%s" % (user._id36, thing._fullname)
+            for user, thing, vote_data in votes_to_create
+        })
+        locks = []
+        try:
+            for lock_key in lock_keys:
+                lock = g.make_lock("voting", lock_key, timeout=5)
+                lock.acquire()
+                locks.append(lock)
+
+            previous_votes = VoteDetailsByThing.get_votes(
+                (user, thing) for user, thing, vote_data in votes_to_create)
+            timer.intermediate("get_previous_votes")
+
+            votes = []
+            for user, thing, vote_data in votes_to_create:
+                print "Processing vote by %s on %s %s" % (
+                    user, thing, vote_data)
+
+                key = (user._id, thing._fullname)
+                try:
+                    vote = Vote(
+                        user,
+                        thing,
+                        direction=vote_data["direction"],
+                        date=datetime.utcfromtimestamp(vote_data["date"]),
+                        data=vote_data["data"],
+                        event_data=vote_data.get("event_data"),
+                        get_previous_vote=False,
+                        previous_vote=previous_votes.get(key),
+                    )
+                except TypeError as e:
+                    # a vote on an invalid type got in the queue, just skip it
+                    g.log.exception("Invalid type: %r", e.message)
+                    continue
+
+                # a later vote by the same user on the same thing replaces
+                # this one
+                if not vote.is_noop:
+                    previous_votes[key] = vote
+                votes.append(vote)
+
+            timer.intermediate("create_vote_objs")
+
+            Vote.commit_batch(votes)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        timer.flush()
+
+    workers = g.amqp_consumer_workers
+    batch_size = g.vote_batch_size
+    if batch_size:
+        # votes on the same thing go to the same worker so they can be
+        # added up together
+        workers = workers or 1
+        amqp.consume_batches(queue, process_batch, key_fn=_vote_queue_key,
+                             prefetch_count=2 * batch_size * workers,
+                             workers=workers, batch_size=batch_size,
+                             verbose=False)
+        return
+
+    if not workers:
+        amqp.consume_items(queue, process_message, verbose=False)
+        return
+
+    def process_messages(msgs):
+        for msg in msgs:
+            process_message(msg)
+
+    # keep votes on the same thing in order so they're applied the same way
+    # they would be by a single consumer
+    amqp.consume_batches(queue, process_messages, key_fn=_vote_queue_key,
+                         prefetch_count=20 * workers, workers=workers,
+                         batch_size=1, verbose=False)
+
+
+def _vote_queue_key(msg):
+    try:
+        vote_data = json.loads(msg.body)
+    except ValueError:
+        return None
+    return vote_data.get("thing_fullname") or vote_data.get("tid")
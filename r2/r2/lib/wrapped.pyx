@@ -27,6 +27,7 @@ from itertools import chain
 import random
 import re
 import types
+import zlib
 
 from r2.lib.cache import MemcachedError
 from r2.lib.utils import SimpleSillyStub
@@ -35,6 +36,11 @@ from r2.lib.utils import SimpleSillyStub
 CACHE_HIT_SAMPLE_RATE = 0.001
 RENDER_TIMER_SAMPLE_RATE = 0.001
 
+# rendercache values are utf8 prefixed with a flag saying whether they're
+# zlib compressed, which is only worth doing for larger fragments
+RENDERCACHE_COMPRESS_MIN_BYTES = 512
+RENDERCACHE_COMPRESSION_LEVEL = 6
+
 class _TemplateUpdater(object):
     # this class is just a hack to get around Cython's closure rules
 
@@ -103,6 +109,139 @@ class StringTemplate(object):
         return self.update(d).template
 
 
+class _StubSplicer(object):
+    """
+    Substitutes rendered templates for their stubs in a single pass.
+
+    rendered maps each stub name to (cache_key, template, kw), where
+    template is the StringTemplate fetched from the cache or rendered
+    for the stub and kw are the args it was rendered with.  The text of
+    each template is only scanned for stubs once, and the expanded
+    results are memoized so nested templates are spliced into their
+    parents rather than repeatedly re-substituted over the whole page.
+    """
+
+    def __init__(self, rendered, pattern):
+        self.rendered = rendered
+        self.pattern = pattern
+        # stubs currently being expanded, to guard against cycles
+        self.pending = set()
+        # the template with its kw args applied and stubs expanded, which
+        # is what gets inserted into the templates containing it
+        self.replacements = {}
+        # the template with its stubs expanded but kw args left in place
+        self.expansions = {}
+        # the expansion with its kw args applied
+        self.finals = {}
+        # the finals with the primary template's kw args applied
+        self.spliced = {}
+
+    def _convert(self, value):
+        # matches re.sub's handling of None, which is to drop the stub
+        if value is None:
+            return u""
+        return self.expand_text(value)
+
+    def expand_text(self, text):
+        """Replace the stubs in text with the rendered templates."""
+        parts = []
+        pos = 0
+        for m in self.pattern.finditer(text):
+            name = m.group("named")
+            if name in self.rendered and name not in self.pending:
+                parts.append(text[pos:m.start()])
+                parts.append(self.replacement(name))
+                pos = m.end()
+
+        if not parts:
+            return text
+        parts.append(text[pos:])
+        return u"".join(parts)
+
+    def replacement(self, name):
+        """Return the fully expanded template with its kw args applied."""
+        if name not in self.replacements:
+            self.pending.add(name)
+            cache_key, template, kw = self.rendered[name]
+            text = template.template
+
+            parts = []
+            pos = 0
+            for m in self.pattern.finditer(text):
+                name2 = m.group("named")
+                if name2 in kw:
+                    value = self._convert(kw[name2])
+                elif name2 in self.rendered and name2 not in self.pending:
+                    value = self.replacement(name2)
+                else:
+                    continue
+                parts.append(text[pos:m.start()])
+                parts.append(value)
+                pos = m.end()
+
+            if parts:
+                parts.append(text[pos:])
+                text = u"".join(parts)
+
+            self.pending.discard(name)
+            self.replacements[name] = text
+        return self.replacements[name]
+
+    def expansion(self, name):
+        """Return the template with its stubs expanded, as it's cached."""
+        if name not in self.expansions:
+            self.pending.add(name)
+            template = self.rendered[name][1]
+            self.expansions[name] = self.expand_text(template.template)
+            self.pending.discard(name)
+        return self.expansions[name]
+
+    def final(self, name):
+        """Return the expanded template with its own kw args applied."""
+        if name not in self.finals:
+            kw = self.rendered[name][2]
+            template = StringTemplate(self.expansion(name))
+            self.finals[name] = template.finalize(kw)
+        return self.finals[name]
+
+    def splice(self, text, kwargs):
+        """
+        Return the primary template's text with every stub replaced.
+
+        Stubs are replaced by the primary's kw args first and the
+        finalized templates otherwise, recursively, which produces the
+        same output as repeatedly updating the whole page until it
+        stops changing.
+        """
+        parts = []
+        pos = 0
+        for m in self.pattern.finditer(text):
+            name = m.group("named")
+            if name in self.spliced:
+                value = self.spliced[name]
+            elif name in self.pending:
+                continue
+            elif name in kwargs or name in self.rendered:
+                self.pending.add(name)
+                if name in kwargs:
+                    value = kwargs[name]
+                    value = u"" if value is None else self.splice(value, kwargs)
+                else:
+                    value = self.splice(self.final(name), kwargs)
+                self.pending.discard(name)
+                self.spliced[name] = value
+            else:
+                continue
+            parts.append(text[pos:m.start()])
+            parts.append(value)
+            pos = m.end()
+
+        if not parts:
+            return text
+        parts.append(text[pos:])
+        return u"".join(parts)
+
+
 class CacheStub(object):
     """
     When using cached renderings, this class generates a stub based on
@@ -232,7 +371,8 @@ class Templated(object):
         rendering has in turn cause more cachable things to be
         fetched.  Thus the first template to be rendered runs a loop
         and keeps rendering until there is nothing left to render.
-        Then it updates the master template until it doesn't change.
+        Then it splices everything into the master template in a
+        single pass (see _StubSplicer).
 
         NOTE 2: anything passed in as a kw to render (and thus
         _render) will not be part of the cached version of the object,
@@ -267,10 +407,10 @@ class Templated(object):
 
         # if this is the primary template, let the caching games begin
         if primary:
-            # updates will be the (self-updated) list of all of
-            # the cached templates that have been cached or
-            # rendered.
-            updates = {}
+            # rendered will be the list of all of the cached templates
+            # that have been fetched from the cache or rendered, along
+            # with the kw args they were rendered with.
+            rendered = {}
             # to_cache is just the keys of the cached templates
             # that were not in the cache.
             to_cache = set([])
@@ -285,11 +425,7 @@ class Templated(object):
                 # This dict cast will generate a new dict of cache_key
                 # to value
                 cached = self._read_cache(dict(current.values()))
-                # replacements will be a map of key -> rendered content
-                # for updateing the current set of updates
-                replacements = {}
 
-                new_updates = {}
                 # render items that didn't make it into the cached list
                 for key, (cache_key, others) in current.iteritems():
                     # unbundle the remaining args
@@ -297,7 +433,6 @@ class Templated(object):
                     if cache_key not in cached:
                         # this had to be rendered, so cache it later
                         to_cache.add(cache_key)
-                        # render the item and apply the stored kw args
                         r = item.render_nocache(style)
                     else:
                         r = cached[cache_key]
@@ -307,57 +442,47 @@ class Templated(object):
                     g.stats.event_count(
                         event_name, name, sample_rate=CACHE_HIT_SAMPLE_RATE)
 
-                    # store the unevaluated templates in
-                    # cached for caching
-                    replacements[key] = r.finalize(kw)
-                    new_updates[key] = (cache_key, (r, kw))
-
-                # update the updates so that when we can do the
-                # replacement in one pass.
-                
-                # NOTE: keep kw, but don't update based on them.
-                # We might have to cache these later, and we want
-                # to have things like $child present.
-                for k in updates.keys():
-                    cache_key, (value, kw) = updates[k]
-                    value = value.update(replacements)
-                    updates[k] = cache_key, (value, kw)
-
-                updates.update(new_updates)
-    
-            # at this point, we haven't touched res, but updates now
-            # has the list of all the updates we could conceivably
-            # want to make, and to_cache is the list of cache keys
-            # that we didn't find in the cache.
+                    # store the unevaluated templates so the stubs in
+                    # them can all be replaced at once at the end
+                    rendered[key] = (cache_key, r, kw)
 
-            # cache content that was newly rendered
+            # at this point, we haven't touched res, but rendered now
+            # has all of the templates we could conceivably want to
+            # splice in, and to_cache is the list of cache keys that we
+            # didn't find in the cache.
+            splicer = _StubSplicer(rendered, StringTemplate.pattern2)
+
+            # cache content that was newly rendered.  NOTE: the cached
+            # version has its nested templates expanded, but not its
+            # own kw args, so things like $child are still present.
             _to_cache = {}
-            for k, (v, kw) in updates.values():
-                if k in to_cache:
-                    _to_cache[k] = v
+            for key, (cache_key, r, kw) in rendered.iteritems():
+                if cache_key in to_cache:
+                    _to_cache[cache_key] = splicer.expansion(key)
             self._write_cache(_to_cache)
 
             # edge case: this may be the primary tempalte and cachable
             if isinstance(res, CacheStub):
-                res = updates[res.name][1][0]
-
-            # now we can update the updates to make use of their kw args.
-            _updates = {}
-            for k, (foo, (v, kw)) in updates.iteritems():
-                _updates[k] = v.finalize(kw)
-            updates = _updates
-
-            # update the response to use these values
-            # replace till we can't replace any more. 
-            npasses = 0
-            while True:
-                npasses += 1
-                r = res
-                res = res.update(kwargs).update(updates)
-                semi_final = res.finalize()
-                if r.finalize() == res.finalize():
-                    res = semi_final
-                    break
+                res = StringTemplate(splicer.expansion(res.name))
+
+            if res.__class__ is StringTemplate:
+                # assemble the response in a single pass
+                res = splicer.splice(res.template, kwargs)
+            else:
+                # subclasses (like ObjectTemplate for the API) do their
+                # own substitution, so replace till we can't replace any
+                # more.
+                updates = {}
+                for key in rendered:
+                    updates[key] = splicer.final(key)
+
+                while True:
+                    r = res
+                    res = res.update(kwargs).update(updates)
+                    semi_final = res.finalize()
+                    if r.finalize() == res.finalize():
+                        res = semi_final
+                        break
 
             # wipe out the render tracker object
             c.render_tracker = None
@@ -368,7 +493,7 @@ class Templated(object):
         return res
 
     def _cache_key(self, key):
-        return 'rend:%s(%s)' % (self.__class__.__name__, md5(key).hexdigest())
+        return 'rendz:%s(%s)' % (self.__class__.__name__, md5(key).hexdigest())
 
     def _write_cache(self, keys):
         from pylons import app_globals as g
@@ -377,7 +502,16 @@ class Templated(object):
             return
 
         toset = {}
+        uncompressed_bytes = 0
+        stored_bytes = 0
         for key, val in keys.iteritems():
+            val = val.encode("utf8")
+            uncompressed_bytes += len(val)
+            if len(val) >= RENDERCACHE_COMPRESS_MIN_BYTES:
+                val = "z" + zlib.compress(val, RENDERCACHE_COMPRESSION_LEVEL)
+            else:
+                val = "u" + val
+            stored_bytes += len(val)
             toset[self._cache_key(key)] = val
 
         try:
@@ -386,6 +520,10 @@ class Templated(object):
             g.log.warning("rendercache error: %s", e)
             return
 
+        g.stats.simple_event("render-cache.bytes.uncompressed",
+                             uncompressed_bytes)
+        g.stats.simple_event("render-cache.bytes.stored", stored_bytes)
+
     def _read_cache(self, keys):
         from pylons import app_globals as g
 
@@ -395,7 +533,23 @@ class Templated(object):
         found = g.rendercache.get_multi(ekeys)
         ret = {}
         for fkey, val in found.iteritems():
-            ret[ekeys[fkey]] = val
+            try:
+                if val[:1] == "z":
+                    val = zlib.decompress(val[1:])
+                elif val[:1] == "u":
+                    val = val[1:]
+                else:
+                    continue
+                ret[ekeys[fkey]] = StringTemplate(val.decode("utf8"))
+            except (zlib.error, UnicodeDecodeError, TypeError):
+                g.log.warning("rendercache: bad value for %s", fkey)
+
+        # sampled like the per-class counts, and together so their ratio
+        # holds up
+        if random.random() < CACHE_HIT_SAMPLE_RATE:
+            g.stats.simple_event("render-cache.total.hit", len(ret))
+            g.stats.simple_event("render-cache.total.miss",
+                                 len(ekeys) - len(ret))
         return ret
 
     def render(self, style = None, **kw):
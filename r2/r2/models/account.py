@@ -38,6 +38,7 @@ from r2.lib.db.operators import lower
 from r2.lib.db.userrel import UserRel
 from r2.lib.db import tdb_cassandra
 from r2.lib.geoip import can_auto_optin_email
+from r2.lib.lock import TimeoutExpired
 from r2.lib.log import log_text
 from r2.lib.memoize import memoize
 from r2.lib.permissions import ModeratorPermissionSet
@@ -56,6 +57,7 @@ from r2.models.trylater import TryLater
 
 trylater_hooks = hooks.HookRegistrar()
 COOKIE_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+KARMA_KINDS = ("link", "self", "comment")
 
 
 class AccountExists(Exception):
@@ -167,6 +169,7 @@ class Account(Thing):
                      accepted_promoted_links=0,
                      pref_allow_clicktracking=True,
                      disable_karma=False,
+                     karma_migrated=False,
                      pref_live_orangereds=True,
                      has_been_onboarded=True,
                      )
@@ -197,19 +200,55 @@ class Account(Thing):
 
         return (self, sr) in r
 
+    def _legacy_karma(self):
+        """Return per-subreddit karma still stored as data props.
+
+        Before AccountKarma this was kept as "<sr>_<kind>_karma" props on the
+        account. They're moved over by migrate_karma, which sets
+        karma_migrated once they've been added to the counters.
+
+        """
+        karma = {}
+        for key, value in self._t.iteritems():
+            for kind in KARMA_KINDS:
+                suffix = "_%s_karma" % kind
+                if key.endswith(suffix):
+                    karma[(key[:-len(suffix)], kind)] = value
+                    break
+        return karma
+
+    def _karma_by_sr(self):
+        """Return {(sr_name, kind): karma} and {kind: total} for the account.
+
+        Reads both AccountKarma and any karma props not yet migrated.
+
+        """
+        if self._created:
+            karma_by_sr, totals = AccountKarma.get(self)
+        else:
+            karma_by_sr, totals = {}, {}
+
+        legacy = {} if self.karma_migrated else self._legacy_karma()
+        if legacy:
+            karma_by_sr = dict(karma_by_sr)
+            totals = dict(totals)
+            for key, value in legacy.iteritems():
+                karma_by_sr[key] = karma_by_sr.get(key, 0) + value
+                sr_name, kind = key
+                totals[kind] = totals.get(kind, 0) + value
+
+        return karma_by_sr, totals
+
     def karma(self, kind, sr = None):
-        suffix = '_' + kind + '_karma'
+        karma_by_sr, totals = self._karma_by_sr()
 
         #if no sr, return the sum
         if sr is None:
-            total = 0
-            for k, v in self._t.iteritems():
-                if k.endswith(suffix):
-                    total += v
+            total = totals.get(kind, 0)
 
             # link karma includes both "link" and "self" values
             if kind == "link":
-                total += self.karma("self")
+                total += totals.get("self", 0)
 
             return total
 
@@ -221,8 +260,8 @@ class Account(Thing):
 
         if kind == "link":
             # link karma includes both "link" and "self", so it's a bit trickier
-            link_karma = getattr(self, sr.name + suffix, None)
-            self_karma = getattr(self, "%s_self_karma" % sr.name, None)
+            link_karma = karma_by_sr.get((sr.name, "link"))
+            self_karma = karma_by_sr.get((sr.name, "self"))
 
             # return default value only if they have *neither* link nor self
             if all(karma is None for karma in (link_karma, self_karma)):
@@ -230,12 +269,12 @@ class Account(Thing):
 
             return sum(karma for karma in (link_karma, self_karma) if karma)
         else:
-            return getattr(self, sr.name + suffix, default_karma)
+            return karma_by_sr.get((sr.name, kind), default_karma)
 
     def incr_karma(self, kind, sr, amt):
         # accounts can (manually) have their ability to gain/lose karma
         # disabled, to prevent special accounts like AutoModerator from
-        # having a massive number of subreddit-karma attributes
+        # having a massive number of subreddit-karma entries
         if self.disable_karma:
             return
 
@@ -243,13 +282,46 @@ class Account(Thing):
             g.log.info("Ignoring karma increase for subreddit %r" % (sr.name,))
             return
 
-        prop = '%s_%s_karma' % (sr.name, kind)
-        if hasattr(self, prop):
-            return self._incr(prop, amt)
-        else:
-            default_val = self.karma(kind, sr)
-            setattr(self, prop, default_val + amt)
-            self._commit()
+        if self._legacy_karma():
+            self.migrate_karma()
+
+        karma_by_sr, totals = self._karma_by_sr()
+        if (sr.name, kind) not in karma_by_sr:
+            # start from the default value so the first vote in a subreddit
+            # doesn't take the user below MIN_UP_KARMA
+            amt += self.karma(kind, sr)
+
+        AccountKarma.incr(self, sr.name, kind, amt)
+
+    def migrate_karma(self):
+        """Move per-subreddit karma props over to AccountKarma.
+
+        The counters are incremented before the props are removed so dying
+        part way through can't lose karma. The account is marked as migrated
+        in between, after which reads ignore the props and a retry only
+        finishes removing them.
+
+        """
+        if not self._legacy_karma():
+            return
+
+        with self.get_read_modify_write_lock() as lock:
+            self.update_from_cache(lock)
+            legacy = self._legacy_karma()
+            if not legacy:
+                return
+
+            if not self.karma_migrated:
+                karma = {key: int(value) for key, value in legacy.iteritems()}
+                # log the values first so they can be put back by hand if we
+                # die between incrementing and marking the account
+                g.log.info("Migrating karma for %s: %r", self._fullname, karma)
+                AccountKarma.incr_multi(self, karma)
+                self.karma_migrated = True
+                self._commit()
+                g.stats.simple_event("account.karma_migrated")
+
+            self._del_data_props(["%s_%s_karma" % key for key in legacy])
 
     @property
     def link_karma(self):
@@ -266,27 +338,18 @@ class Account(Thing):
         (link_karma, comment_karma) tuples, ordered by the combined total
         descending.
         """
-        link_suffix = '_link_karma'
-        self_suffix = '_self_karma'
-        comment_suffix = '_comment_karma'
+        karma_by_sr, totals = self._karma_by_sr()
 
         comment_karmas = Counter()
         link_karmas = Counter()
         combined_karmas = Counter()
 
-        for key, value in self._t.iteritems():
-            if key.endswith(link_suffix):
-                sr_name = key[:-len(link_suffix)]
-                link_karmas[sr_name] += value
-            elif key.endswith(self_suffix):
+        for (sr_name, kind), value in karma_by_sr.iteritems():
+            if kind == "comment":
+                comment_karmas[sr_name] += value
+            else:
                 # self karma gets added to link karma too
-                sr_name = key[:-len(self_suffix)]
                 link_karmas[sr_name] += value
-            elif key.endswith(comment_suffix):
-                sr_name = key[:-len(comment_suffix)]
-                comment_karmas[sr_name] = value
-            else:
-                continue
 
             combined_karmas[sr_name] += value
 
@@ -1036,6 +1099,110 @@ class DeletedUser(FakeAccount):
             object.__setattr__(self, attr, val)
 
 
+class AccountKarma(tdb_cassandra.Counter):
+    """Per-subreddit karma for accounts.
+
+    Each row is keyed on an account's id36 with a counter column per
+    subreddit and kind of karma, e.g. "pics_link". Keeping these out of the
+    Account thing keeps it small and lets karma change without taking the
+    account's lock.
+
+    """
+
+    _use_db = True
+    _cache_prefix = "account_karma:"
+    _cache_ttl = 6 * 60 * 60
+
+    @staticmethod
+    def _column(sr_name, kind):
+        return "%s_%s" % (sr_name, kind)
+
+    @classmethod
+    def _cache_key(cls, account):
+        return cls._cache_prefix + account._id36
+
+    @classmethod
+    def get(cls, account):
+        """Return {(sr_name, kind): karma} and {kind: total} for account."""
+        key = cls._cache_key(account)
+        karma = g.gencache.get(key)
+        if karma is not None:
+            return karma
+
+        # filled under the lock so an increment can't land between reading
+        # the counters and caching them
+        try:
+            with g.make_lock("account_karma", "lock_" + key):
+                karma = g.gencache.get(key, allow_local=False)
+                if karma is None:
+                    karma = cls._get_from_db(account)
+                    g.gencache.add(key, karma, time=cls._cache_ttl)
+        except TimeoutExpired:
+            karma = cls._get_from_db(account)
+        return karma
+
+    @classmethod
+    def get_multi(cls, accounts):
+        """Return {account._id: karma} for accounts, as from get.
+
+        Fetching the cached karma in one go also puts it in the local cache,
+        so use this to prefetch karma for pages that show it for many users.
+
+        """
+        keys = {cls._cache_key(account): account for account in accounts}
+        karmas = g.gencache.get_multi(keys.keys())
+
+        ret = {}
+        for key, account in keys.iteritems():
+            karma = karmas.get(key)
+            if karma is None:
+                karma = cls.get(account)
+            ret[account._id] = karma
+        return ret
+
+    @classmethod
+    def _get_from_db(cls, account):
+        karma_by_sr = {}
+        totals = Counter()
+        for column, value in cls._cf.xget(account._id36):
+            sr_name, kind = column.rsplit("_", 1)
+            karma_by_sr[(sr_name, kind)] = value
+            totals[kind] += value
+        return karma_by_sr, dict(totals)
+
+    @classmethod
+    def incr(cls, account, sr_name, kind, amt):
+        cls.incr_multi(account, {(sr_name, kind): amt})
+
+    @classmethod
+    def incr_multi(cls, account, karma):
+        """Add a {(sr_name, kind): karma} dict to the account's karma."""
+        data = {cls._column(sr_name, kind): amt
+                for (sr_name, kind), amt in karma.iteritems()}
+        key = cls._cache_key(account)
+        try:
+            with g.make_lock("account_karma", "lock_" + key):
+                cls._incr_multi(account._id36, data)
+                cls._update_cached(key, karma)
+        except TimeoutExpired:
+            cls._incr_multi(account._id36, data)
+            g.gencache.delete(key)
+
+    @classmethod
+    def _update_cached(cls, key, karma):
+        cached = g.gencache.get(key, allow_local=False)
+        if cached is None:
+            # it'll be read from the db next time
+            return
+
+        karma_by_sr, totals = cached
+        for (sr_name, kind), amt in karma.iteritems():
+            karma_by_sr[(sr_name, kind)] = (
+                karma_by_sr.get((sr_name, kind), 0) + amt)
+            totals[kind] = totals.get(kind, 0) + amt
+        g.gencache.set(key, (karma_by_sr, totals), time=cls._cache_ttl)
+
+
 class BlockedSubredditsByAccount(tdb_cassandra.DenormalizedRelation):
     _use_db = True
     _last_modified_name = 'block_subreddit'
@@ -24,6 +24,7 @@ from collections import defaultdict, namedtuple
 from copy import deepcopy
 import datetime
 import heapq
+from itertools import dropwhile, islice
 from random import shuffle, random
 import time
 
@@ -46,6 +47,7 @@ from r2.lib.comment_tree import (
 )
 from r2.lib.wrapped import Wrapped
 from r2.lib.db import operators, tdb_cassandra
+from r2.lib.db.thing import ThingPrefetcher
 from r2.lib.filters import _force_unicode
 from r2.lib.jsontemplates import get_trimmed_sr_dicts
 from r2.lib.utils import (
@@ -59,6 +61,7 @@ from r2.lib.utils import (
 
 from r2.models import (
     Account,
+    AccountKarma,
     Comment,
     CommentSavesByAccount,
     Link,
@@ -82,11 +85,105 @@ from r2.models.vote import Vote
 EXTRA_FACTOR = 1.5
 MAX_RECURSION = 10
 
+# the fraction of fetched items a listing ends up keeping is remembered so the
+# next time it's built enough can be fetched to fill the page in one round
+KEEP_RATIO_PREFIX = "keepratio:"
+KEEP_RATIO_TTL = 86400
+KEEP_RATIO_DECAY = 0.8
+MIN_KEEP_RATIO = 0.2
+
 
 class InconsistentCommentTreeError(Exception):
   pass
 
 
+class WrapContext(object):
+    """The lookups wrap_items needs, shared by the builders in a request.
+
+    A page usually wraps things with several builders (the listing, spotlight,
+    sticky links...) and they all need the authors, subreddits, moderator
+    permissions and votes for their items. Each builder's lookups are still
+    done when it wraps, but the results are kept for the rest of the request
+    so later builders only look up what's new to them.
+
+    """
+
+    def __init__(self, stale):
+        self.stale = stale
+        self.user = c.user if c.user_is_loggedin else None
+        self.authors = {}
+        self.subreddits = {}
+        self.can_ban_sr_ids = set()
+        self.likes = {}
+        self._friend_rels = None
+
+    @classmethod
+    def current(cls, stale):
+        """Return the request's context for builders with the staleness.
+
+        Contexts are per user as well, since some pages wrap things for
+        another user partway through. Scripts and queue consumers keep one c
+        for everything they do, so they get a new context every time.
+
+        """
+
+        if g.running_as_script:
+            return cls(stale)
+
+        user_id = c.user._id if c.user_is_loggedin else None
+        key = (stale, user_id)
+        contexts = getattr(c, "wrap_contexts", None)
+        if contexts is None:
+            contexts = c.wrap_contexts = {}
+
+        if key not in contexts:
+            contexts[key] = cls(stale)
+        return contexts[key]
+
+    @property
+    def friend_rels(self):
+        if self._friend_rels is None:
+            if self.user and self.user.gold:
+                self._friend_rels = self.user.friend_rels()
+            else:
+                self._friend_rels = {}
+        return self._friend_rels
+
+    def load(self, items):
+        """Look up what wrapping items needs that hasn't been already."""
+        from r2.lib.db import queries
+
+        author_ids = {item.author_id for item in items
+                      if getattr(item, "author_id", None) is not None}
+        author_ids.difference_update(self.authors)
+        if author_ids:
+            self.authors.update(
+                Account._byID(author_ids, data=True, stale=self.stale))
+
+        sr_items = [item for item in items
+                    if getattr(item, "sr_id", None) is not None and
+                    item.sr_id not in self.subreddits]
+        if sr_items:
+            subreddits = Subreddit.load_subreddits(sr_items, stale=self.stale)
+            self.subreddits.update(subreddits)
+            if self.user:
+                self.can_ban_sr_ids.update(
+                    sr_id for sr_id, sr in subreddits.iteritems()
+                    if sr.can_ban(self.user))
+
+        unvoted = {item._fullname: item for item in items
+                   if item._fullname not in self.likes}
+        if unvoted:
+            try:
+                likes = queries.get_likes(self.user, unvoted.values())
+            except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
+                # don't keep the missing votes so they're retried
+                g.log.warning("Cassandra vote lookup failed: %r", e)
+            else:
+                for fullname, item in unvoted.iteritems():
+                    self.likes[fullname] = likes.get((self.user, item))
+
+
 class Builder(object):
     def __init__(self, wrap=Wrapped, prewrap_fn=None, keep_fn=None, stale=True,
                  spam_listing=False):
@@ -102,8 +199,29 @@ class Builder(object):
         else:
             return item.keep_item(item)
 
+    def prefetch_items(self, prefetcher, items):
+        """Register the things wrapping `items` is going to look up."""
+        prefetcher.want(Account, (getattr(item, "author_id", None)
+                                  for item in items))
+        prefetcher.want(Subreddit, (getattr(item, "sr_id", None)
+                                    for item in items))
+
+        # comments also need their links and any parents that aren't
+        # being wrapped along with them
+        comments = [item for item in items if isinstance(item, Comment)]
+        comment_ids = {comment._id for comment in comments}
+        parent_ids = {getattr(comment, "parent_id", None)
+                      for comment in comments}
+        prefetcher.want(Link, (comment.link_id for comment in comments))
+        prefetcher.want(Comment, parent_ids - comment_ids)
+
     def wrap_items(self, items):
-        from r2.lib.db import queries
+        prefetcher = ThingPrefetcher(stale=self.stale)
+        self.prefetch_items(prefetcher, items)
+        with prefetcher:
+            return self._wrap_items(items)
+
+    def _wrap_items(self, items):
         from r2.lib.template_helpers import (
             add_friend_distinguish,
             add_admin_distinguish,
@@ -113,29 +231,16 @@ class Builder(object):
         )
 
         user = c.user if c.user_is_loggedin else None
-        aids = set(l.author_id for l in items if hasattr(l, 'author_id')
-                   and l.author_id is not None)
-
-        authors = Account._byID(aids, data=True, stale=self.stale)
-        now = datetime.datetime.now(g.tz)
-        cakes = {a._id for a in authors.itervalues()
-                       if a.cake_expiration and a.cake_expiration >= now}
-        friend_rels = user.friend_rels() if user and user.gold else {}
 
-        subreddits = Subreddit.load_subreddits(items, stale=self.stale)
-        can_ban_set = set()
+        wrap_context = WrapContext.current(self.stale)
+        wrap_context.load(items)
 
-        if user:
-            for sr_id, sr in subreddits.iteritems():
-                if sr.can_ban(user):
-                    can_ban_set.add(sr_id)
-
-        #get likes/dislikes
-        try:
-            likes = queries.get_likes(user, items)
-        except tdb_cassandra.TRANSIENT_EXCEPTIONS as e:
-            g.log.warning("Cassandra vote lookup failed: %r", e)
-            likes = {}
+        authors = wrap_context.authors
+        now = datetime.datetime.now(g.tz)
+        friend_rels = wrap_context.friend_rels
+        subreddits = wrap_context.subreddits
+        can_ban_set = wrap_context.can_ban_sr_ids
+        likes = wrap_context.likes
 
         types = {}
         wrapped = []
@@ -194,13 +299,14 @@ class Builder(object):
             if w.distinguished == 'special':
                 add_special_distinguish(distinguish_attribs_list, w.author)
 
-            if (not author_is_hidden and
-                    w.author and w.author._id in cakes and not c.profilepage):
+            if (not author_is_hidden and w.author and
+                    w.author.cake_expiration and
+                    w.author.cake_expiration >= now and not c.profilepage):
                 add_cakeday_distinguish(distinguish_attribs_list, w.author)
 
             w.attribs = distinguish_attribs_list
 
-            user_vote_dir = likes.get((user, item))
+            user_vote_dir = likes.get(item._fullname)
 
             if user_vote_dir == Vote.DIRECTIONS.up:
                 w.likes = True
@@ -399,19 +505,60 @@ class Builder(object):
 
 class QueryBuilder(Builder):
     def __init__(self, query, skip=False, num=None, sr_detail=None, count=0,
-                 after=None, reverse=False, **kw):
+                 after=None, reverse=False, prefilter=True, **kw):
         self.query = query
         self.skip = skip
+        # whether items can be skipped by their keep_unwrapped before they're
+        # wrapped, which is wrong if keep_fn keeps items keep_item wouldn't
+        self.prefilter = prefilter
         self.num = num
         self.sr_detail = sr_detail
         self.start_count = count or 0
         self.after = after
         self.reverse = reverse
+        self.keep_ratio = 1.
         Builder.__init__(self, **kw)
 
     def __repr__(self):
         return "<%s(%r)>" % (self.__class__.__name__, self.query)
 
+    def _keep_ratio_key(self):
+        """Return the cache key of the listing's keep ratio, if it has one.
+
+        Must be called before init_query modifies the query for the page.
+
+        """
+
+        if not self.skip or not hasattr(self.query, "_cache_key"):
+            return None
+        return self._keep_ratio_key_for(self.query._cache_key())
+
+    def _keep_ratio_key_for(self, iden):
+        # what gets hidden depends a lot on whether there's a user
+        viewer = "user" if c.user_is_loggedin else "anon"
+        return "%s%s:%s:%s" % (KEEP_RATIO_PREFIX, self.__class__.__name__,
+                               viewer, iden)
+
+    def fetch_size(self, num_need):
+        """Return how many items to fetch to keep num_need of them."""
+        keep_ratio = max(self.keep_ratio, MIN_KEEP_RATIO)
+        return max(int(num_need * EXTRA_FACTOR / keep_ratio), self.num // 2, 1)
+
+    def skip_unwrapped(self, item):
+        """Whether item would be skipped anyway, checked before wrapping it.
+
+        Wrapping is the expensive part of building, so items that keep_item
+        would reject based on the unwrapped thing alone are dropped first.
+
+        """
+
+        # prewrap_fn can swap the item for a different one
+        if not self.skip or not self.prefilter or self.prewrap_fn:
+            return False
+
+        keep_unwrapped = getattr(item, "keep_unwrapped", None)
+        return keep_unwrapped is not None and not keep_unwrapped()
+
     def item_iter(self, a):
         """Iterates over the items returned by get_items"""
         for i in a[0]:
@@ -443,7 +590,7 @@ class QueryBuilder(Builder):
                     q._rules = deepcopy(self.orig_rules)
                     q._after(last_item)
                     last_item = None
-                q._limit = max(int(num_need * EXTRA_FACTOR), self.num // 2, 1)
+                q._limit = self.fetch_size(num_need)
         else:
             done = True
         new_items = list(q)
@@ -451,6 +598,13 @@ class QueryBuilder(Builder):
         return done, new_items
 
     def get_items(self):
+        keep_ratio_key = self._keep_ratio_key()
+        stored_ratio = None
+        if keep_ratio_key:
+            stored_ratio = g.gencache.get(keep_ratio_key)
+            if stored_ratio is not None:
+                self.keep_ratio = stored_ratio
+
         self.init_query()
 
         num_have = 0
@@ -460,6 +614,7 @@ class QueryBuilder(Builder):
         fetch_after = None
         loopcount = 0
         stopped_early = False
+        num_checked = 0
 
         while not done:
             done, fetched_items = self.fetch_more(fetch_after, num_have)
@@ -478,10 +633,16 @@ class QueryBuilder(Builder):
             elif self.num and len(fetched_items) < self.num - num_have:
                 done = True
 
-            # Wrap the fetched items if necessary
-            new_items = self.convert_items(fetched_items)
+            fetch_after = fetched_items[-1]
+
+            # Wrap the fetched items that might be kept if necessary
+            unskipped = [i for i in fetched_items
+                         if not self.skip_unwrapped(i)]
+            num_skipped = len(fetched_items) - len(unskipped)
+            new_items = self.convert_items(unskipped)
 
             #skip and count
+            num_wrapped = len(new_items)
             while new_items and (not self.num or num_have < self.num):
                 i = new_items.pop(0)
 
@@ -493,7 +654,21 @@ class QueryBuilder(Builder):
                     if self.wrap:
                         i.num = count
 
-            fetch_after = fetched_items[-1]
+            if new_items:
+                # the page filled up partway through, assume the items skipped
+                # before wrapping were spread evenly through the fetched ones
+                num_used = num_wrapped - len(new_items)
+                num_checked += num_used + num_skipped * num_used // num_wrapped
+            else:
+                num_checked += len(fetched_items)
+                # fetch enough to fill the rest of the page next round
+                self.keep_ratio = num_have / float(num_checked)
+
+        g.stats.simple_event("builder.rounds.%d" % min(loopcount, 5))
+
+        if keep_ratio_key and num_checked and self.num:
+            self._update_keep_ratio(
+                keep_ratio_key, stored_ratio, num_have / float(num_checked))
 
         # Is there a next page or not?
         have_next = True
@@ -541,20 +716,55 @@ class QueryBuilder(Builder):
                 before_count,
                 after_count)
 
+    def _update_keep_ratio(self, key, old_ratio, observed):
+        if old_ratio is None:
+            new_ratio = observed
+        else:
+            new_ratio = (KEEP_RATIO_DECAY * old_ratio +
+                         (1 - KEEP_RATIO_DECAY) * observed)
+
+            # don't bother writing small changes
+            if abs(new_ratio - old_ratio) < 0.05:
+                return
+
+        g.gencache.set(key, new_ratio, time=KEEP_RATIO_TTL)
+
 class IDBuilder(QueryBuilder):
     def thing_lookup(self, names):
         return Thing._by_fullname(names, data=True, return_dict=False,
                                   stale=self.stale)
 
-    def init_query(self):
-        names = list(tup(self.query))
+    def _keep_ratio_key(self):
+        # only cached listings have a stable identity
+        iden = getattr(self.query, "iden", None)
+        if not self.skip or not iden:
+            return None
+        return self._keep_ratio_key_for(iden)
 
+    def init_query(self):
         after = self.after._fullname if self.after else None
 
+        if getattr(self.query, "lazy_listing", False) and not self.reverse:
+            # lazy listings produce names as they're read, so only consume
+            # as many as the page actually needs
+            self.names = self._iter_after(iter(self.query), after)
+            return
+
+        names = list(tup(self.query))
+
         self.names = self._get_after(names,
                                      after,
                                      self.reverse)
 
+    @staticmethod
+    def _iter_after(names, after):
+        if after:
+            names = dropwhile(lambda name: name != after, names)
+            # skip past `after` itself. if it wasn't found the iterator is
+            # now exhausted, matching _get_after
+            next(names, None)
+        return names
+
     @staticmethod
     def _get_after(l, after, reverse):
         names = list(l)
@@ -582,12 +792,16 @@ class IDBuilder(QueryBuilder):
             else:
                 if last_item:
                     last_item = None
-                slice_size = max(int(num_need * EXTRA_FACTOR), self.num // 2, 1)
+                slice_size = self.fetch_size(num_need)
         else:
-            slice_size = len(names)
+            slice_size = None
             done = True
 
-        self.names, new_names = names[slice_size:], names[:slice_size]
+        if isinstance(names, (list, tuple)):
+            slice_size = len(names) if slice_size is None else slice_size
+            self.names, new_names = names[slice_size:], names[:slice_size]
+        else:
+            new_names = list(islice(names, slice_size))
         new_items = self.thing_lookup(new_names)
         return done, new_items
 
@@ -864,13 +1078,14 @@ class CommentOrdererBase(object):
             comment_tree = CommentTree.by_link(self.link, comment_tree_timer)
             sort_name = self.sort.col
             sorter = get_comment_scores(
-                self.link, sort_name, comment_tree.cids, comment_tree_timer)
+                self.link, sort_name, comment_tree.index, comment_tree_timer)
             comment_tree_timer.intermediate('get_scores')
 
         self.timer.intermediate("load_storage")
 
         comment_tree = self.modify_comment_tree(comment_tree)
         self.timer.intermediate("modify_comment_tree")
+        index = comment_tree.index
 
         initial_candidates, offset_depth = self.get_initial_candidates(comment_tree)
 
@@ -892,20 +1107,20 @@ class CommentOrdererBase(object):
         # choose which comments to show
         while candidates and len(comment_tuples) < self.max_comments:
             sort_val, comment_id = heapq.heappop(candidates)
-            if comment_id not in comment_tree.cids:
+            if comment_id not in index:
                 continue
 
-            comment_depth = comment_tree.depth[comment_id] - offset_depth
+            comment_depth = index.depth(comment_id) - offset_depth
             if comment_depth >= self.max_depth:
                 continue
 
-            child_ids = comment_tree.tree.get(comment_id, [])
+            child_ids = comment_tree.get_children(comment_id)
 
             comment_tuples.append(CommentTuple(
                 comment_id=comment_id,
                 depth=comment_depth,
-                parent_id=comment_tree.parents[comment_id],
-                num_children=comment_tree.num_children[comment_id],
+                parent_id=index.parent(comment_id),
+                num_children=comment_tree.get_num_children(comment_id),
                 child_ids=child_ids,
             ))
 
@@ -917,14 +1132,15 @@ class CommentOrdererBase(object):
 
         # add all not-selected top level comments to the comment_tuples list
         # so we can make MoreChildren for them later
-        top_level_not_visible = {
-            comment_id for sort_val, comment_id in candidates
-            if comment_tree.depth.get(comment_id, 0) - offset_depth == 0
-        }
+        top_level_not_visible = set()
+        for sort_val, comment_id in candidates:
+            depth = index.depth(comment_id) if comment_id in index else 0
+            if depth - offset_depth == 0:
+                top_level_not_visible.add(comment_id)
 
         if top_level_not_visible:
             num_children_not_visible = sum(
-                1 + comment_tree.num_children[comment_id]
+                1 + comment_tree.get_num_children(comment_id)
                 for comment_id in top_level_not_visible
             )
             comment_tuples.append(MissingChildrenTuple(
@@ -970,9 +1186,9 @@ SORT_OPERATOR_BY_NAME = {
 class CommentOrderer(CommentOrdererBase):
     def get_initial_candidates(self, comment_tree):
         """Build the tree starting from all root level comments."""
-        initial_candidates = comment_tree.tree.get(None, [])
+        initial_candidates = comment_tree.get_children(None)
         if initial_candidates:
-            offset_depth = min(comment_tree.depth[comment_id]
+            offset_depth = min(comment_tree.index.depth(comment_id)
                 for comment_id in initial_candidates)
         else:
             offset_depth = 0
@@ -983,15 +1199,16 @@ class CommentOrderer(CommentOrdererBase):
         comment_tuples = []
 
         if self.link.sticky_comment_id:
-            root_level_comments = comment_tree.tree.get(None, [])
+            root_level_comments = comment_tree.get_children(None)
             sticky_comment_id = self.link.sticky_comment_id
             if sticky_comment_id in root_level_comments:
                 comment_tuples.append(CommentTuple(
                     comment_id=sticky_comment_id,
                     depth=0,
                     parent_id=None,
-                    num_children=comment_tree.num_children[sticky_comment_id],
-                    child_ids=comment_tree.tree.get(sticky_comment_id, []),
+                    num_children=comment_tree.get_num_children(
+                        sticky_comment_id),
+                    child_ids=comment_tree.get_children(sticky_comment_id),
                 ))
             else:
                 g.log.warning("Non-top-level sticky comment detected on "
@@ -1256,41 +1473,22 @@ class PermalinkCommentOrderer(CommentOrdererBase):
 
         Restrict the path to a maximum of `context` levels deep."""
 
-        if comment._id not in comment_tree.cids:
-            # the comment isn't in the tree
+        try:
+            return comment_tree.index.path(comment._id, context)
+        except KeyError:
+            # either the comment isn't in the tree or its parent is missing
+            # from it. this might just mean that the child was added to the
+            # tree first and the tree will be correct when the parent is
+            # added.
             raise InconsistentCommentTreeError
 
-        comment_id = comment._id
-        path = []
-        while comment_id and len(path) <= context:
-            path.append(comment_id)
-            try:
-                comment_id = comment_tree.parents[comment_id]
-            except KeyError:
-                # the comment's parent is missing from the tree. this might
-                # just mean that the child was added to the tree first and
-                # the tree will be correct when the parent is added.
-                raise InconsistentCommentTreeError
-
-        # reverse the list so the first element is the most root level comment
-        path.reverse()
-        return path
-
     def modify_comment_tree(self, comment_tree):
         path = self.get_path_to_comment(
             self.comment, self.context, comment_tree)
 
-        # work through the path in reverse starting with the requested comment
-        for comment_id in reversed(path):
-            # rewrite parent's tree so it leads only to the requested comment
-            parent_id = comment_tree.parents[comment_id]
-            comment_tree.tree[parent_id] = [comment_id]
-
-            # rewrite parent's num_children to count only this branch
-            if parent_id is not None:
-                branch_num_children = comment_tree.num_children[comment_id]
-                comment_tree.num_children[parent_id] = branch_num_children + 1
-
+        # make each comment on the path the only child of its parent, so the
+        # tree leads only to the requested comment
+        comment_tree.restrict_to_path(path)
         return comment_tree
 
     def get_initial_candidates(self, comment_tree):
@@ -1302,7 +1500,7 @@ class PermalinkCommentOrderer(CommentOrdererBase):
         # selected comment
         root_comment = path[0]
         initial_candidates = [root_comment]
-        offset_depth = comment_tree.depth[root_comment]
+        offset_depth = comment_tree.index.depth(root_comment)
         return initial_candidates, offset_depth
 
 
@@ -1317,16 +1515,16 @@ class ChildrenCommentOrderer(CommentOrdererBase):
 
         children = [
             comment_id for comment_id in self.children
-            if comment_id in comment_tree.depth
+            if comment_id in comment_tree.index
         ]
 
         if children:
             children_depth = min(
-                comment_tree.depth[comment_id] for comment_id in children)
+                comment_tree.index.depth(comment_id) for comment_id in children)
 
             children = [
                 comment_id for comment_id in children
-                if comment_tree.depth[comment_id] == children_depth
+                if comment_tree.index.depth(comment_id) == children_depth
             ]
 
         initial_candidates = children
@@ -1398,8 +1596,15 @@ class CommentBuilder(Builder):
             comment_tuple.comment_id
             for comment_tuple in self.ordered_comment_tuples
         }
-        self.comments = Comment._byID(
-            comment_ids, data=True, return_dict=False, stale=self.stale)
+
+        # look up the link's author and subreddit along with the comments,
+        # wrapping them will need both
+        prefetcher = ThingPrefetcher(stale=self.stale)
+        prefetcher.want(Account, [self.link.author_id])
+        prefetcher.want(Subreddit, [self.link.sr_id])
+        with prefetcher:
+            self.comments = Comment._byID(
+                comment_ids, data=True, return_dict=False, stale=self.stale)
         self.timer.intermediate("lookup_comments")
 
     def load_comment_order(self):
@@ -1917,6 +2122,8 @@ class UserMessageBuilder(MessageBuilder):
 class UserListBuilder(QueryBuilder):
     def thing_lookup(self, rels):
         accounts = Account._byID([rel._thing2_id for rel in rels], data=True)
+        # the user table shows each user's karma
+        AccountKarma.get_multi(accounts.itervalues())
         for rel in rels:
             rel._thing2 = accounts.get(rel._thing2_id)
         return rels
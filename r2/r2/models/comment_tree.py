@@ -20,16 +20,22 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from itertools import izip
+import uuid
 
+from _pylibmc import MemcachedError, NotFound as CacheKeyNotFound
 from pycassa import batch, types
 from pycassa.cassandra import ttypes
+from pycassa.cassandra.ttypes import NotFoundException
 from pycassa.system_manager import ASCII_TYPE, COUNTER_COLUMN_TYPE
 from pylons import app_globals as g
 
 from r2.lib import utils
 from r2.lib.db import tdb_cassandra
-from r2.lib.utils import SimpleSillyStub
+from r2.lib.utils import SimpleSillyStub, to36
 from r2.lib.utils.comment_tree_utils import get_tree_details, calc_num_children
 from r2.models.link import Comment
 
@@ -66,6 +72,20 @@ CommentTreeStorageV3: for each comment, write a column where the column name is
 data model was abandoned because of more unexpected GC problems after longer
 time periods and generally insufficient regular-case performance.
 
+CommentTreeDeltaPermacache keeps the permacache tree as a snapshot but doesn't
+rewrite it for every new comment. New comments are appended to a
+CommentTreeDeltas row as (comment_id, parent_id) columns without locking or
+reading the tree, and readers merge the snapshot and the deltas. Once enough
+deltas accumulate they are compacted into the snapshot. This keeps the cost of
+adding comments proportional to the number of new comments rather than the
+size of the tree, which matters for megathreads.
+
+CommentTreeIndex is a read-only flattening of the tree that the comment
+orderers use instead of the dicts above. Every write to a tree stores a new
+random version next to it, and the index is kept in an in-process cache keyed
+on that version, so showing a few hundred comments from a huge thread doesn't
+cost a pass over every comment in it.
+
 """
 
 
@@ -102,11 +122,43 @@ class CommentTreePermacache(object):
         assert lock.have_lock
         key = cls._permacache_key(link)
         g.permacache.set(key, tree)
+        cls._bump_version(link)
 
     @classmethod
-    def get_tree_pieces(cls, link, timer):
+    def _version_key(cls, link):
+        return 'comments_version_' + str(link._id)
+
+    @classmethod
+    def _bump_version(cls, link):
+        """Mark the tree as changed. Call after the tree has been written."""
+        version = uuid.uuid4().hex
+        g.permacache.set(cls._version_key(link), version)
+        return version
+
+    @classmethod
+    def get_version(cls, link):
+        """Return a value that changes whenever the link's tree does.
+
+        Must be read before the tree itself: the version is written after the
+        tree so a tree read after it is at least as new as the version.
+
+        """
+
+        version = g.permacache.get(cls._version_key(link))
+        if version is None:
+            # trees written before versions existed
+            version = cls._bump_version(link)
+        return version
+
+    @classmethod
+    def get_tree(cls, link, timer):
         tree = cls._load_tree(link)
         timer.intermediate('load')
+        return tree
+
+    @classmethod
+    def get_tree_pieces(cls, link, timer):
+        tree = cls.get_tree(link, timer)
 
         cids, depth, parents = get_tree_details(tree)
         num_children = calc_num_children(tree)
@@ -164,32 +216,467 @@ class CommentTreePermacache(object):
             cls._write_tree(link, tree, lock)
 
 
-class CommentTree:
-    def __init__(self, link, cids, tree, depth, parents, num_children):
+class CommentTreeDeltas(tdb_cassandra.View):
+    """Comments added to a link's tree since the last compaction.
+
+    Each column name is a comment's id36 and its value is the parent comment's
+    id36 or an empty string for top level comments.
+
+    """
+
+    _use_db = True
+    _connection_pool = "main"
+    _read_consistency_level = tdb_cassandra.CL.QUORUM
+    _write_consistency_level = tdb_cassandra.CL.QUORUM
+    _extra_schema_creation_args = {
+        "key_validation_class": tdb_cassandra.ASCII_TYPE,
+        "column_name_class": tdb_cassandra.ASCII_TYPE,
+        "default_validation_class": tdb_cassandra.ASCII_TYPE,
+    }
+    _compare_with = tdb_cassandra.ASCII_TYPE
+
+    @classmethod
+    def _rowkey(cls, link):
+        return link._id36
+
+    @classmethod
+    def add_comments(cls, link, comments):
+        columns = {
+            comment._id36: to36(comment.parent_id) if comment.parent_id else ""
+            for comment in comments
+        }
+        cls._set_values(cls._rowkey(link), columns)
+
+    @classmethod
+    def get_parents(cls, link):
+        """Return a dict of comment id -> parent comment id."""
+        try:
+            columns = list(cls._cf.xget(cls._rowkey(link)))
+        except NotFoundException:
+            return {}
+
+        return {
+            int(comment_id36, 36): int(parent_id36, 36) if parent_id36 else None
+            for comment_id36, parent_id36 in columns
+        }
+
+    @classmethod
+    def _count_key(cls, link):
+        return "comment_tree_deltas_" + link._id36
+
+    @classmethod
+    def incr_count(cls, link, delta):
+        """Add to the link's count of deltas and return (before, after).
+
+        The count is kept in memcache next to the row so adding comments
+        doesn't need to read it. If the count isn't cached the row is counted
+        once and `before` is 0.
+
+        """
+
+        key = cls._count_key(link)
+        try:
+            after = g.gencache.incr(key, delta=delta)
+            return after - delta, after
+        except CacheKeyNotFound:
+            after = cls._cf.get_count(cls._rowkey(link))
+            g.gencache.add(key, after)
+            return 0, after
+        except MemcachedError:
+            g.log.warning("Failed to count comment tree deltas for %s", link)
+            return 0, 0
+
+    @classmethod
+    def reset_count(cls, link):
+        g.gencache.delete(cls._count_key(link))
+
+    @classmethod
+    def remove_comments(cls, link, comment_ids):
+        if comment_ids:
+            cls._remove(cls._rowkey(link), [to36(cid) for cid in comment_ids])
+
+
+class CommentTreeDeltaPermacache(CommentTreePermacache):
+    # number of deltas that will trigger a compaction into the snapshot
+    COMPACTION_THRESHOLD = 500
+
+    @classmethod
+    def _merge_deltas(cls, tree, parents_by_id):
+        """Add comments from deltas to the tree and return the added ids."""
+        existing = {cid for children in tree.itervalues() for cid in children}
+        added = []
+        for comment_id in sorted(parents_by_id):
+            if comment_id in existing:
+                continue
+            parent_id = parents_by_id[comment_id]
+            tree.setdefault(parent_id, []).append(comment_id)
+            added.append(comment_id)
+        return added
+
+    @classmethod
+    def _load_tree(cls, link):
+        # read the deltas before the snapshot: compaction writes the snapshot
+        # before it removes the deltas it merged, so in this order we can't
+        # miss a comment that is being compacted
+        parents_by_id = CommentTreeDeltas.get_parents(link)
+        tree = super(CommentTreeDeltaPermacache, cls)._load_tree(link)
+        cls._merge_deltas(tree, parents_by_id)
+        return tree
+
+    @classmethod
+    def add_comments(cls, link, comments):
+        # duplicates just overwrite the same column so there's no need to read
+        # the tree or take the lock here
+        CommentTreeDeltas.add_comments(link, comments)
+        cls._bump_version(link)
+
+        # only the writer that takes the count over the threshold compacts, so
+        # the others don't queue up on the lock behind it
+        before, after = CommentTreeDeltas.incr_count(link, len(comments))
+        if before < cls.COMPACTION_THRESHOLD <= after:
+            cls.compact(link)
+
+    @classmethod
+    def compact(cls, link):
+        """Merge the deltas into the snapshot and remove them."""
+        try:
+            cls._compact(link)
+        finally:
+            # recount from the row on the next write, which also lets a failed
+            # compaction be retried
+            CommentTreeDeltas.reset_count(link)
+
+    @classmethod
+    def _compact(cls, link):
+        with cls._mutation_context(link) as lock:
+            # read-modify-write of the snapshot, so get the lock
+            parents_by_id = CommentTreeDeltas.get_parents(link)
+            if not parents_by_id:
+                # someone else compacted while we were waiting for the lock
+                return
+
+            tree = super(CommentTreeDeltaPermacache, cls)._load_tree(link)
+            added = cls._merge_deltas(tree, parents_by_id)
+
+            # warn on any comments whose parents are missing from the tree
+            # (see CommentTreePermacache.add_comments)
+            cids, _, _ = get_tree_details(tree)
+            cids = set(cids)
+            possible_orphan_ids = [
+                comment_id for comment_id in added
+                if (parents_by_id[comment_id] and
+                    parents_by_id[comment_id] not in cids)
+            ]
+            if possible_orphan_ids:
+                g.log.error("comment_tree_inconsistent: %s %s", link,
+                    possible_orphan_ids)
+                g.stats.simple_event('comment_tree_inconsistent')
+
+            if added:
+                cls._write_tree(link, tree, lock)
+            CommentTreeDeltas.remove_comments(link, parents_by_id.keys())
+            g.stats.simple_event("comment_tree.compact.deltas",
+                                 delta=len(parents_by_id))
+
+    @classmethod
+    def rebuild(cls, link, comments):
+        super(CommentTreeDeltaPermacache, cls).rebuild(link, comments)
+
+        # deltas for comments that existed when the rebuild query ran are
+        # either in the new tree or were deliberately left out of it. newer
+        # ones need to stay to be merged later.
+        if comments:
+            newest_id = max(comment._id for comment in comments)
+            parents_by_id = CommentTreeDeltas.get_parents(link)
+            CommentTreeDeltas.remove_comments(link, [
+                comment_id for comment_id in parents_by_id
+                if comment_id <= newest_id
+            ])
+            CommentTreeDeltas.reset_count(link)
+
+            # the deltas that were left out of the new tree are gone now
+            cls._bump_version(link)
+
+
+class CommentTreeIndex(object):
+    """Flat arrays describing a comment tree.
+
+    Comments are laid out in pre-order, so each comment is followed directly
+    by its descendants: the subtree of the comment at position `i` is
+    positions `i` to `i + sizes[i] - 1`. For each position the index keeps the
+    comment id, the parent id and position, the depth and the subtree size.
+    Comments are looked up by bisecting a sorted copy of the ids.
+
+    Comments whose parent is missing from the tree are included with
+    `MISSING_PARENT` as their parent position, and their depth counts from 0
+    the same way get_tree_details does it.
+
+    """
+
+    TOP_LEVEL = -1
+    MISSING_PARENT = -2
+
+    def __init__(self, tree):
+        self.version = None
+        self.ids = array("l")
+        self.parents = array("l")
+        self.parent_positions = array("l")
+        self.depths = array("l")
+        self.sizes = array("l")
+
+        child_ids = {cid for children in tree.itervalues() for cid in children}
+        orphan_parent_ids = sorted(
+            parent_id for parent_id in tree
+            if parent_id is not None and parent_id not in child_ids
+        )
+
+        seen = set()
+        for root_id in [None] + orphan_parent_ids:
+            if root_id is None:
+                root_position = self.TOP_LEVEL
+            else:
+                root_position = self.MISSING_PARENT
+
+            stack = [(child_id, root_id, root_position, 0)
+                     for child_id in reversed(tree.get(root_id, []))]
+            while stack:
+                comment_id, parent_id, parent_position, depth = stack.pop()
+                if comment_id in seen:
+                    continue
+                seen.add(comment_id)
+
+                position = len(self.ids)
+                self.ids.append(comment_id)
+                self.parents.append(parent_id or 0)
+                self.parent_positions.append(parent_position)
+                self.depths.append(depth)
+                self.sizes.append(1)
+
+                stack.extend((child_id, comment_id, position, depth + 1)
+                             for child_id in reversed(tree.get(comment_id, [])))
+
+        # children always come after their parent so a single backwards pass
+        # adds up the subtree sizes
+        for position in xrange(len(self.ids) - 1, -1, -1):
+            parent_position = self.parent_positions[position]
+            if parent_position >= 0:
+                self.sizes[parent_position] += self.sizes[position]
+
+        order = sorted(xrange(len(self.ids)), key=self.ids.__getitem__)
+        self.sorted_ids = array("l", (self.ids[i] for i in order))
+        self.sorted_positions = array("l", order)
+
+    @classmethod
+    def for_link(cls, link, tree, version):
+        """Return the index of `tree`, from the process' cache if possible.
+
+        `version` is the tree's stored version, see
+        CommentTreePermacache.get_version.
+
+        """
+
+        cache = g.comment_tree_index_cache
+        if cache is None:
+            return cls(tree)
+
+        key = "comment_tree_index_%s" % link._id
+        cached = cache.get(key)
+        if cached and cached.version == version:
+            return cached
+
+        # the cache hands this same object to every request, so it's never
+        # modified after this
+        index = cls(tree)
+        index.version = version
+        cache.set(key, index)
+        return index
+
+    def __sizeof__(self):
+        arrays = (self.ids, self.parents, self.parent_positions, self.depths,
+                  self.sizes, self.sorted_ids, self.sorted_positions)
+        return object.__sizeof__(self) + sum(a.__sizeof__() for a in arrays)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, comment_id):
+        try:
+            self.position(comment_id)
+        except KeyError:
+            return False
+        return True
+
+    def position(self, comment_id):
+        i = bisect_left(self.sorted_ids, comment_id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == comment_id:
+            return self.sorted_positions[i]
+        raise KeyError(comment_id)
+
+    def depth(self, comment_id):
+        return self.depths[self.position(comment_id)]
+
+    def parent(self, comment_id):
+        position = self.position(comment_id)
+        if self.parent_positions[position] == self.TOP_LEVEL:
+            return None
+        return self.parents[position]
+
+    def num_children(self, comment_id):
+        """Return the number of descendants of the comment."""
+        return self.sizes[self.position(comment_id)] - 1
+
+    def is_descendant(self, comment_id, ancestor_id):
+        position = self.position(comment_id)
+        ancestor_position = self.position(ancestor_id)
+        return (ancestor_position < position <
+                ancestor_position + self.sizes[ancestor_position])
+
+    def path(self, comment_id, context):
+        """Return the ids from an ancestor down to the comment.
+
+        The path goes up at most `context` levels above the comment. Raise
+        KeyError if the comment or an ancestor the path needs isn't in the
+        tree.
+
+        """
+
+        position = self.position(comment_id)
+        path = []
+        while len(path) <= context:
+            path.append(self.ids[position])
+            parent_position = self.parent_positions[position]
+            if parent_position == self.TOP_LEVEL:
+                break
+            elif parent_position == self.MISSING_PARENT:
+                if len(path) <= context:
+                    raise KeyError(self.parents[position])
+                break
+            position = parent_position
+
+        path.reverse()
+        return path
+
+
+class CommentTree(object):
+    """A link's comment tree.
+
+    `tree` is the stored structure and `index` the CommentTreeIndex built
+    from it. `cids`, `depth`, `parents` and `num_children` are the older
+    dict versions of the index, generated from it when they're first used.
+
+    """
+
+    def __init__(self, link, cids, tree, depth, parents, num_children,
+                 index=None):
         self.link = link
-        self.cids = cids
         self.tree = tree
-        self.depth = depth
-        self.parents = parents
-        self.num_children = num_children
+        self._index = index
+        self._cids = cids
+        self._depth = depth
+        self._parents = parents
+        self._num_children = num_children
+
+        # children lists and descendant counts that replace the ones in the
+        # index, see restrict_to_path
+        self.branch_children = {}
+        self.branch_num_children = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CommentTreeIndex(self.tree)
+        return self._index
+
+    @property
+    def cids(self):
+        if self._cids is None:
+            self._cids = list(self.index.ids)
+        return self._cids
+
+    @property
+    def depth(self):
+        if self._depth is None:
+            self._depth = dict(izip(self.index.ids, self.index.depths))
+        return self._depth
+
+    @property
+    def parents(self):
+        if self._parents is None:
+            self._parents = {
+                comment_id: self.index.parent(comment_id)
+                for comment_id in self.index.ids
+            }
+        return self._parents
+
+    @property
+    def num_children(self):
+        if self._num_children is None:
+            self._num_children = defaultdict(int, (
+                (comment_id, size - 1)
+                for comment_id, size in izip(self.index.ids, self.index.sizes)
+                if size > 1
+            ))
+        return self._num_children
+
+    def get_children(self, comment_id):
+        if comment_id in self.branch_children:
+            return self.branch_children[comment_id]
+        return self.tree.get(comment_id, [])
+
+    def get_num_children(self, comment_id):
+        if comment_id in self.branch_num_children:
+            return self.branch_num_children[comment_id]
+        try:
+            return self.index.num_children(comment_id)
+        except KeyError:
+            return 0
+
+    def restrict_to_path(self, path):
+        """Hide everything but `path` from its ancestors' children.
+
+        `path` is a list of comment ids from an ancestor down to a comment,
+        as returned by CommentTreeIndex.path. The comments on it keep their
+        own children.
+
+        """
+
+        for comment_id in reversed(path):
+            parent_id = self.index.parent(comment_id)
+            self.branch_children[parent_id] = [comment_id]
+
+            if parent_id is not None:
+                self.branch_num_children[parent_id] = (
+                    self.get_num_children(comment_id) + 1)
 
     @classmethod
     def by_link(cls, link, timer=None):
         if timer is None:
             timer = SimpleSillyStub()
 
-        pieces = CommentTreePermacache.get_tree_pieces(link, timer)
-        cids, tree, depth, parents, num_children = pieces
-        comment_tree = cls(link, cids, tree, depth, parents, num_children)
-        return comment_tree
+        storage = cls._storage()
+        version = storage.get_version(link)
+        tree = storage.get_tree(link, timer)
+        index = CommentTreeIndex.for_link(link, tree, version)
+        timer.intermediate('index')
+
+        return cls(link, None, tree, None, None, None, index=index)
+
+    @classmethod
+    def _storage(cls):
+        if g.comment_tree_deltas:
+            return CommentTreeDeltaPermacache
+        return CommentTreePermacache
 
     @classmethod
     def on_new_link(cls, link):
-        CommentTreePermacache.prepare_new_storage(link)
+        cls._storage().prepare_new_storage(link)
 
     @classmethod
     def add_comments(cls, link, comments):
-        CommentTreePermacache.add_comments(link, comments)
+        cls._storage().add_comments(link, comments)
 
     @classmethod
     def rebuild(cls, link):
@@ -209,7 +696,7 @@ class CommentTree:
             if not comment.parent_id or comment.parent_id in comment_ids 
         ]
 
-        CommentTreePermacache.rebuild(link, comments)
+        cls._storage().rebuild(link, comments)
 
         link.num_comments = sum(1 for c in comments if not c._deleted)
         link._commit()
@@ -95,8 +95,9 @@ from time import sleep
 import simplejson as json
 
 import random, re
+from array import array
 from collections import defaultdict
-from itertools import cycle
+from itertools import cycle, izip
 from pycassa.cassandra.ttypes import NotFoundException
 from pycassa.system_manager import (
     ASCII_TYPE,
@@ -387,6 +388,19 @@ class Link(Thing, Printable):
         # Paper over obviously broken comment counts (those that are negative).
         return max(self.__getattr__('num_comments'), 0)
 
+    def keep_unwrapped(self):
+        if c.user_is_admin:
+            return True
+
+        if self._deleted:
+            return False
+
+        # keep_item only shows spam to admins, mods and the author
+        if self._spam and not c.user_is_loggedin:
+            return False
+
+        return True
+
     def keep_item(self, wrapped):
         user = c.user if c.user_is_loggedin else None
         if not c.user_is_admin and self._deleted:
@@ -1736,17 +1750,54 @@ class Comment(Thing, Printable):
         # that can be applied to any Things, which is why it's defined here
         # instead of in Thing.
 
-        op_children = [c for c in children if c.author_id in responder_ids]
-        score = sorts.qa(self._ups, self._downs, len(self.body), op_children)
+        return self._qa_multi([self], [children], responder_ids)[0]
+
+    @classmethod
+    def _qa_multi(cls, comments, children_lists, responder_ids):
+        """Sort several comments according to the Q&A-type sort.
 
-        # When replies to a question, we want to rank OP replies higher than
-        # non-OP replies (generally).  This is a rough way to do so.
-        # Don't add extra scoring when we've already added it due to replies,
-        # though (because an OP responds to themselves).
-        if self.author_id in responder_ids and not op_children:
-            score *= 2
+        `children_lists` has the list of children for each comment in
+        `comments`. Returns a list of the comments' scores.
 
-        return score
+        """
+
+        ups = array("l", [comment._ups for comment in comments])
+        downs = array("l", [comment._downs for comment in comments])
+        question_lengths = array("l",
+                                 [len(comment.body) for comment in comments])
+        answer_scores = array("d")
+        answer_lengths = array("l")
+        has_op_children = []
+        for children in children_lists:
+            op_children = [c for c in children if c.author_id in responder_ids]
+
+            # Only take into account the "best" answer from OP. Without one
+            # the defaults of sorts._qa are used.
+            best_score, answer_length = None, 1
+            for answer in op_children:
+                score = sorts.confidence(answer._ups, answer._downs)
+                if best_score is None or score > best_score:
+                    best_score = score
+                    answer_length = len(answer.body)
+            answer_scores.append(best_score or 0.)
+            answer_lengths.append(answer_length)
+            has_op_children.append(bool(op_children))
+
+        question_scores = sorts.confidence_batch(ups, downs)
+        scores = sorts.qa_batch(question_scores, question_lengths,
+                                answer_scores, answer_lengths)
+
+        ret = []
+        for comment, score, op_replied in izip(comments, scores,
+                                               has_op_children):
+            # When replies to a question, we want to rank OP replies higher
+            # than non-OP replies (generally).  This is a rough way to do so.
+            # Don't add extra scoring when we've already added it due to
+            # replies, though (because an OP responds to themselves).
+            if comment.author_id in responder_ids and not op_replied:
+                score *= 2
+            ret.append(score)
+        return ret
 
     @classmethod
     def update_nofollow(cls, user, wrapped):
@@ -2097,6 +2148,15 @@ class CommentScoresByLink(tdb_cassandra.View):
         rowkey = cls._rowkey(link, sort)
         cls._set_values(rowkey, scores_by_comment)
 
+    @classmethod
+    def set_scores_multi(cls, link, scores_by_sort):
+        """Write the scores for several sorts in one batch."""
+        batch = cls._cf.batch(write_consistency_level=cls._wcl(None))
+        with batch as b:
+            for sort, scores_by_comment in scores_by_sort.iteritems():
+                rowkey = cls._rowkey(link, sort)
+                cls._set_values(rowkey, scores_by_comment, batch=b)
+
     @classmethod
     def get_scores(cls, link, sort):
         rowkey = cls._rowkey(link, sort)
@@ -88,6 +88,10 @@ class Printable(object):
     def keep_item(self, wrapped):
         return True
 
+    def keep_unwrapped(self):
+        """Whether keep_item might keep this thing, checked before wrapping."""
+        return True
+
     @staticmethod
     def wrapped_cache_key(wrapped, style):
         s = [wrapped._fullname, wrapped._spam]
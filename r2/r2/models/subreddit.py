@@ -698,15 +698,12 @@ class Subreddit(Thing, Printable, BaseSite):
         """
         assert context in self.activity_contexts
 
-        if not c.activity_service:
+        if not g.activity_buffer:
             return
 
+        # the visit is sent to the service in the background, along with others
         context_id = self._activity_context_id(context)
-
-        try:
-            c.activity_service.record_activity(context_id, visitor_id)
-        except (TApplicationException, TProtocolException, TTransportException):
-            pass
+        g.activity_buffer.record(context_id, visitor_id)
 
     def count_activity(self):
         """Count activity in this subreddit in all known contexts.
@@ -720,9 +717,13 @@ class Subreddit(Thing, Printable, BaseSite):
         context_by_id = {self._activity_context_id(context): context
                          for context in self.activity_contexts}
 
-        try:
+        def count_activity_multi(context_ids):
             with c.activity_service.retrying(attempts=4, budget=0.1) as svc:
-                activity_by_id = svc.count_activity_multi(context_by_id.keys())
+                return svc.count_activity_multi(context_ids)
+
+        try:
+            activity_by_id = g.activity_counts.get(
+                context_by_id.keys(), count_activity_multi)
         except (TApplicationException, TProtocolException, TTransportException):
             return None
 
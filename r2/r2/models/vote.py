@@ -31,11 +31,14 @@ from pylons import app_globals as g
 import pytz
 
 from r2.lib import hooks
+from r2.lib.bloom import BloomFilter
+from r2.lib.cache import MemcachedError
 from r2.lib.db import tdb_cassandra
 from r2.lib.db.tdb_cassandra import (
     ASCII_TYPE,
     UTF8_TYPE,
 )
+from r2.lib.lock import TimeoutExpired
 from r2.lib.utils import Enum, epoch_timestamp, in_chunks
 
 from r2.models import Account
@@ -52,7 +55,7 @@ class Vote(object):
         v: k for k, v in SERIALIZED_DIRECTIONS.iteritems()}
 
     def __init__(self, user, thing, direction, date, data=None, effects=None,
-            get_previous_vote=True, event_data=None):
+            get_previous_vote=True, event_data=None, previous_vote=None):
         if not thing.is_votable:
             raise TypeError("Can't create vote on unvotable thing %s" % thing)
 
@@ -66,14 +69,15 @@ class Vote(object):
         self.data = data
         self.event_data = event_data
 
-        # see if the user has voted on this thing before
-        if get_previous_vote:
-            self.previous_vote = VoteDetailsByThing.get_vote(user, thing)
-            if self.previous_vote:
-                # XXX: why do we keep the old date?
-                self.date = self.previous_vote.date.replace(tzinfo=g.tz)
-        else:
-            self.previous_vote = None
+        # see if the user has voted on this thing before, unless the caller
+        # already looked it up
+        if get_previous_vote and not previous_vote:
+            previous_vote = VoteDetailsByThing.get_vote(user, thing)
+
+        self.previous_vote = previous_vote
+        if self.previous_vote:
+            # XXX: why do we keep the old date?
+            self.date = self.previous_vote.date.replace(tzinfo=g.tz)
 
         self.effects = VoteEffects(self, effects)
 
@@ -144,33 +148,56 @@ class Vote(object):
         
         return self.date - self.thing._date
 
-    def apply_effects(self):
-        """Apply the effects of the vote to the thing that was voted on."""
+    @property
+    def score_changes(self):
+        """A Counter of how much the vote changes each attr on the thing."""
+        changes = collections.Counter()
+
         # remove the old vote
         if self.previous_vote and self.previous_vote.affected_thing_attr:
-            self.thing._incr(self.previous_vote.affected_thing_attr, -1)
+            changes[self.previous_vote.affected_thing_attr] -= 1
 
         # add the new vote
         if self.affected_thing_attr:
-            self.thing._incr(self.affected_thing_attr, 1)
+            changes[self.affected_thing_attr] += 1
 
-        if self.effects.affects_karma:
-            change = self.effects.karma_change
-            if self.previous_vote:
-                change -= self.previous_vote.effects.karma_change
+        return changes
 
-            if change:
-                self.thing.author_slow.incr_karma(
-                    kind=self.thing.affects_karma_type,
-                    sr=self.thing.subreddit_slow,
-                    amt=change,
-                )
+    @property
+    def karma_change(self):
+        """How much the vote changes the karma of the thing's author."""
+        if not self.effects.affects_karma:
+            return 0
+
+        change = self.effects.karma_change
+        if self.previous_vote:
+            change -= self.previous_vote.effects.karma_change
+        return change
+
+    @property
+    def is_noop(self):
+        """Whether the vote is the same as the user's previous one."""
+        return bool(self.previous_vote and self == self.previous_vote)
+
+    def apply_effects(self):
+        """Apply the effects of the vote to the thing that was voted on."""
+        for attr, amount in self.score_changes.iteritems():
+            if amount:
+                self.thing._incr(attr, amount)
+
+        change = self.karma_change
+        if change:
+            self.thing.author_slow.incr_karma(
+                kind=self.thing.affects_karma_type,
+                sr=self.thing.subreddit_slow,
+                amt=change,
+            )
 
         hooks.get_hook("vote.apply_effects").call(vote=self)
 
     def commit(self):
         """Apply the vote's effects and persist it."""
-        if self.previous_vote and self == self.previous_vote:
+        if self.is_noop:
             return
 
         self.apply_effects()
@@ -189,6 +216,110 @@ class Vote(object):
 
         g.stats.simple_event('vote.total')
 
+    @classmethod
+    def commit_batch(cls, votes):
+        """Apply and persist votes as if they were committed one at a time.
+
+        The changes to each thing's score and each author's karma are added
+        up and applied with one increment each, rather than one per vote.
+        The votes must be in the order they were cast, with each vote's
+        previous_vote being the one before it in the batch if there is one.
+
+        """
+
+        votes = [vote for vote in votes if not vote.is_noop]
+        if not votes:
+            return
+
+        # persist the votes before applying any of their effects. if this
+        # fails partway the batch's messages are retried one at a time, and
+        # the votes that were written are then noops, so their effects have
+        # to be applied here and only here.
+        written = []
+        try:
+            for vote in votes:
+                VotesByAccount.write_vote(vote)
+                written.append(vote)
+        finally:
+            cls._apply_effects_batch(written)
+
+        votes_by_thing = collections.OrderedDict()
+        for vote in votes:
+            votes_by_thing.setdefault(vote.thing._fullname, []).append(vote)
+
+        # update the search index if any of the votes would have when
+        # committed by itself (see commit)
+        for thing_votes in votes_by_thing.itervalues():
+            thing = thing_votes[0].thing
+            num_votes_after = cls.num_votes_after_each(thing_votes)
+            if any(num_votes < 20 or num_votes % 10 == 0
+                   for num_votes in num_votes_after):
+                thing.update_search_index(boost_only=True)
+
+        from r2.lib.db.queries import new_votes
+        new_votes(votes)
+
+        with g.events.batch():
+            for vote in votes:
+                if vote.event_data:
+                    g.events.vote_event(vote)
+
+        g.stats.simple_event('vote.total', delta=len(votes))
+
+    @staticmethod
+    def _apply_effects_batch(votes):
+        """Apply the effects of votes with one increment per attr or author."""
+        votes_by_thing = collections.OrderedDict()
+        for vote in votes:
+            votes_by_thing.setdefault(vote.thing._fullname, []).append(vote)
+
+        karma_changes = collections.Counter()
+        thing_by_karma_key = {}
+        for thing_votes in votes_by_thing.itervalues():
+            thing = thing_votes[0].thing
+            score_changes = collections.Counter()
+            for vote in thing_votes:
+                score_changes.update(vote.score_changes)
+
+                karma_key = (thing.author_id, thing.affects_karma_type,
+                             thing.sr_id)
+                karma_changes[karma_key] += vote.karma_change
+                thing_by_karma_key[karma_key] = thing
+
+            for attr, amount in score_changes.iteritems():
+                if amount:
+                    thing._incr(attr, amount)
+
+        for karma_key, change in karma_changes.iteritems():
+            if change:
+                thing = thing_by_karma_key[karma_key]
+                thing.author_slow.incr_karma(
+                    kind=thing.affects_karma_type,
+                    sr=thing.subreddit_slow,
+                    amt=change,
+                )
+
+        for vote in votes:
+            hooks.get_hook("vote.apply_effects").call(vote=vote)
+
+    @staticmethod
+    def num_votes_after_each(votes):
+        """Return the thing's num_votes as it was right after each vote.
+
+        `votes` are all on the same thing and have already been applied to
+        it.
+
+        """
+
+        num_votes = votes[0].thing.num_votes
+        num_votes -= sum(sum(vote.score_changes.itervalues()) for vote in votes)
+
+        num_votes_after = []
+        for vote in votes:
+            num_votes += sum(vote.score_changes.itervalues())
+            num_votes_after.append(num_votes)
+        return num_votes_after
+
 
 class VoteEffects(object):
     """Contains details about how a vote affects the thing voted on."""
@@ -330,6 +461,7 @@ class VotesByAccount(tdb_cassandra.DenormalizedRelation):
     def write_vote(cls, vote):
         rel = cls.rel(vote.thing.__class__)
         rel.create(vote.user, vote.thing, vote=vote)
+        VotedThingFilter.add(vote.user, vote.thing)
 
     @classmethod
     def value_for(cls, thing1, thing2, vote):
@@ -352,6 +484,132 @@ class CommentVotesByAccount(VotesByAccount):
     _write_last_modified = False
 
 
+class VotedThingFilter(object):
+    """A bloom filter, in memcache, of the things a user has voted on.
+
+    Most of the things on a listing haven't been voted on by the user viewing
+    it, and checking the filter first lets us skip looking those up in
+    cassandra. The filter is added to after each vote is written, and deleted
+    if that fails, so it never misses a stored vote. A missing filter is
+    rebuilt from VotesByAccount the next time the user votes.
+
+    It's only used while the voted_filter live config is on, which must not
+    happen until every app adds votes to the filters.
+
+    """
+
+    CACHE_PREFIX = "votedfilter:"
+    CACHE_TTL = 86400
+    ERROR_RATE = 0.01
+    MIN_CAPACITY = 1000
+    # about 120KB at ERROR_RATE, well under memcached's item size limit
+    MAX_CAPACITY = 100000
+    # stored in place of the filter for users with too many votes for one
+    TOO_MANY_VOTES = "too_many"
+
+    @classmethod
+    def _cache_key(cls, user):
+        return cls.CACHE_PREFIX + user._id36
+
+    @classmethod
+    def get(cls, user):
+        """Return the user's filter, or None if they don't have one."""
+        if not g.live_config["voted_filter"]:
+            return None
+
+        data = g.gencache.get(cls._cache_key(user))
+        if data is None or data == cls.TOO_MANY_VOTES:
+            return None
+        return BloomFilter.from_tuple(data)
+
+    @classmethod
+    def add(cls, user, thing):
+        """Add a newly stored vote on thing to the user's filter."""
+        if not g.live_config["voted_filter"]:
+            # a filter left from when it was last turned on would be missing
+            # the vote
+            cls._delete(user)
+            return
+
+        key = cls._cache_key(user)
+        try:
+            with g.make_lock("voted_filter", "lock_" + key):
+                added = cls._add(user, thing)
+        except (MemcachedError, TimeoutExpired):
+            added = False
+
+        if not added:
+            g.stats.simple_event("vote.filter.add_failed")
+            cls._delete(user)
+
+    @classmethod
+    def _add(cls, user, thing):
+        data = g.gencache.get(cls._cache_key(user), allow_local=False)
+        if data == cls.TOO_MANY_VOTES:
+            return True
+
+        # the vote was just written but might not be readable yet, so
+        # it's added explicitly when rebuilding
+        if data is None:
+            return cls._rebuild(user, [thing._fullname])
+
+        voted_filter = BloomFilter.from_tuple(data)
+        if voted_filter.count >= voted_filter.capacity:
+            # it's too full to be accurate anymore, make a bigger one
+            return cls._rebuild(user, [thing._fullname])
+
+        voted_filter.add(thing._fullname)
+        return cls._set(user, voted_filter.to_tuple())
+
+    @classmethod
+    def _set(cls, user, data):
+        ret = g.gencache.set(cls._cache_key(user), data, time=cls.CACHE_TTL)
+        return ret is not False
+
+    @classmethod
+    def _delete(cls, user):
+        try:
+            g.gencache.delete(cls._cache_key(user))
+        except MemcachedError:
+            g.log.warning("Couldn't delete voted filter for %s", user._id36)
+
+    @classmethod
+    def rebuild(cls, user):
+        """Build the user's filter from their votes in VotesByAccount."""
+        key = cls._cache_key(user)
+        with g.make_lock("voted_filter", "lock_" + key):
+            cls._rebuild(user)
+
+    @classmethod
+    def _rebuild(cls, user, fullnames=()):
+        """Build and store the user's filter and return whether it was stored.
+
+        fullnames are added to the filter along with the stored votes.
+
+        """
+
+        from r2.models import Comment, Link
+
+        max_votes = min(g.voted_filter_max_votes, cls.MAX_CAPACITY)
+        fullnames = list(fullnames)
+        for thing_cls in (Link, Comment):
+            rel_cls = VotesByAccount.rel(thing_cls)
+            for id36, unused in rel_cls._cf.xget(user._id36):
+                fullnames.append(thing_cls._fullname_from_id36(id36))
+                if len(fullnames) > max_votes:
+                    g.stats.simple_event("vote.filter.too_many_votes")
+                    return cls._set(user, cls.TOO_MANY_VOTES)
+
+        capacity = max(cls.MIN_CAPACITY, 2 * len(fullnames))
+        capacity = min(capacity, cls.MAX_CAPACITY)
+        voted_filter = BloomFilter.for_capacity(capacity, cls.ERROR_RATE)
+        for fullname in fullnames:
+            voted_filter.add(fullname)
+
+        g.stats.simple_event("vote.filter.rebuilt")
+        return cls._set(user, voted_filter.to_tuple())
+
+
 class VoteDetailsByThing(tdb_cassandra.View):
     _use_db = False
     _fetch_all_columns = True
@@ -450,28 +708,84 @@ class VoteDetailsByThing(tdb_cassandra.View):
 
         details = []
         for voter_id36, json_data in raw_details.iteritems():
-            vote_data = json.loads(json_data)
-            vote_data = cls.convert_old_details(vote_data)
-
-            extra_data = vote_data["data"]
-            extra_data["ip"] = ips.get(voter_id36)
-
-            vote = Vote(
-                user=accounts[voter_id36],
-                thing=thing,
-                direction=Vote.deserialize_direction(vote_data["direction"]),
-                date=datetime.utcfromtimestamp(vote_data["date"]),
-                data=extra_data,
-                effects=vote_data["effects"],
-                get_previous_vote=False,
-            )
-
+            vote = cls._vote_from_details(
+                accounts[voter_id36], thing, json_data, ips.get(voter_id36))
             details.append(vote)
 
         details.sort(key=lambda d: d.date)
 
         return details
 
+    @classmethod
+    def _vote_from_details(cls, user, thing, json_data, ip):
+        vote_data = json.loads(json_data)
+        vote_data = cls.convert_old_details(vote_data)
+
+        extra_data = vote_data["data"]
+        extra_data["ip"] = ip
+
+        return Vote(
+            user=user,
+            thing=thing,
+            direction=Vote.deserialize_direction(vote_data["direction"]),
+            date=datetime.utcfromtimestamp(vote_data["date"]),
+            data=extra_data,
+            effects=vote_data["effects"],
+            get_previous_vote=False,
+        )
+
+    @classmethod
+    def get_votes(cls, users_and_things):
+        """Look up the existing votes for many (user, thing) pairs at once.
+
+        Returns a dict of (user id, thing fullname) -> Vote for the pairs
+        that have a vote. All the things of each type are read in a single
+        request rather than one request per pair.
+
+        """
+
+        from r2.models import Comment, Link
+
+        pairs_by_details_cls = collections.defaultdict(set)
+        for user, thing in users_and_things:
+            if isinstance(thing, Link):
+                details_cls = VoteDetailsByLink
+            elif isinstance(thing, Comment):
+                details_cls = VoteDetailsByComment
+            else:
+                raise ValueError
+            pairs_by_details_cls[details_cls].add((user, thing))
+
+        votes = {}
+        for details_cls, pairs in pairs_by_details_cls.iteritems():
+            users_by_id36 = {user._id36: user for user, thing in pairs}
+            things_by_id36 = {thing._id36: thing for user, thing in pairs}
+            wanted = {(user._id36, thing._id36) for user, thing in pairs}
+            voter_id36s = users_by_id36.keys()
+
+            rows = details_cls._byID(
+                things_by_id36.keys(), properties=voter_id36s)
+            ip_rows = VoterIPByThing._byID(
+                [thing._fullname for thing in things_by_id36.itervalues()],
+                properties=voter_id36s,
+            )
+
+            for thing_id36, row in rows.iteritems():
+                thing = things_by_id36[thing_id36]
+                ip_row = ip_rows.get(thing._fullname)
+                ips = ip_row._values() if ip_row else {}
+
+                for voter_id36, json_data in row._values().iteritems():
+                    if (voter_id36, thing_id36) not in wanted:
+                        continue
+
+                    user = users_by_id36[voter_id36]
+                    vote = cls._vote_from_details(
+                        user, thing, json_data, ips.get(voter_id36))
+                    votes[(user._id, thing._fullname)] = vote
+
+        return votes
+
 
 @tdb_cassandra.view_of(LinkVotesByAccount)
 class VoteDetailsByLink(VoteDetailsByThing):
@@ -37,6 +37,7 @@ import paste.script.appinstall
 from paste.deploy import loadapp
 
 from routes.util import url_for
+from r2.lib.cache import LocalCache
 from r2.lib.utils import query_string
 from r2.lib import eventcollector
 
@@ -147,6 +148,9 @@ class MockEventQueue(object):
             event_as_dict = event.serialize()
         self.queue.append(event_as_dict)
 
+    def flush(self, max_age=None):
+        pass
+
     def assert_item_count(self, count=None):
         """Assert that `count` items have been enqueued.
 
@@ -297,6 +301,19 @@ class NonCache(object):
     def incr(self, *a, **kw):
         return
 
+    def incr_multi(self, *a, **kw):
+        return
+
+
+class DictCache(LocalCache):
+    """A LocalCache that takes the keyword arguments of the real caches."""
+
+    def get(self, key, default=None, **kw):
+        return LocalCache.get(self, key, default)
+
+    def simple_get_multi(self, keys, **kw):
+        return LocalCache.simple_get_multi(self, keys)
+
 
 class RedditControllerTestCase(RedditTestCase):
     CONTROLLER = None
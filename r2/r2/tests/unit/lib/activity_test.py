@@ -0,0 +1,145 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import contextlib
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import activity
+from r2.lib.activity import ActivityBuffer, ActivityCountCache
+
+
+class FakePool(object):
+    def __init__(self):
+        self.fail = False
+        self.opened = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        self.opened += 1
+        if self.fail:
+            raise activity.TTransportException()
+        yield MagicMock()
+
+
+class ActivityBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.
+        self.sent = []
+
+        client = MagicMock()
+        client.record_activity.side_effect = (
+            lambda context_id, visitor_id: self.sent.append(
+                (context_id, visitor_id)))
+
+        patches = [
+            patch.object(activity.time, "time", lambda: self.now),
+            patch.object(activity.ActivityService, "Client",
+                         return_value=client, create=True),
+            patch.object(ActivityBuffer, "_ensure_flusher"),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.pool = FakePool()
+        self.stats = MagicMock()
+        self.buffer = ActivityBuffer(self.pool, self.stats, MagicMock())
+
+    def test_sends_in_one_connection(self):
+        self.buffer.record("t5_1", "a")
+        self.buffer.record("t5_1", "b")
+        self.buffer.record("t5_2", "a")
+        self.buffer.flush()
+
+        self.assertEqual(sorted(self.sent),
+                         [("t5_1", "a"), ("t5_1", "b"), ("t5_2", "a")])
+        self.assertEqual(self.pool.opened, 1)
+
+        self.buffer.flush()
+        self.assertEqual(self.pool.opened, 1)
+
+    def test_dedupes_within_window(self):
+        self.buffer.record("t5_1", "a")
+        self.buffer.record("t5_1", "a")
+        self.buffer.flush()
+        self.assertEqual(self.sent, [("t5_1", "a")])
+
+        self.now += 30
+        self.buffer.record("t5_1", "a")
+        self.buffer.flush()
+        self.assertEqual(self.sent, [("t5_1", "a")])
+
+        self.now += activity.ACTIVITY_DEDUPE_WINDOW
+        self.buffer.record("t5_1", "a")
+        self.buffer.flush()
+        self.assertEqual(self.sent, [("t5_1", "a"), ("t5_1", "a")])
+
+    def test_drops_when_full(self):
+        with patch.object(activity, "MAX_PENDING_ACTIVITY", 2):
+            for visitor_id in "abc":
+                self.buffer.record("t5_1", visitor_id)
+
+        self.stats.simple_event.assert_called_with("activity.dropped")
+        self.buffer.flush()
+        self.assertEqual(len(self.sent), 2)
+
+    def test_failed_send_is_not_deduped(self):
+        self.pool.fail = True
+        self.buffer.record("t5_1", "a")
+        self.buffer.flush()
+        self.assertEqual(self.sent, [])
+
+        self.pool.fail = False
+        self.buffer.record("t5_1", "a")
+        self.buffer.flush()
+        self.assertEqual(self.sent, [("t5_1", "a")])
+
+
+class ActivityCountCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.
+        p = patch.object(activity.time, "time", lambda: self.now)
+        p.start()
+        self.addCleanup(p.stop)
+
+        self.fetched = []
+        self.cache = ActivityCountCache()
+
+    def count_multi(self, context_ids):
+        self.fetched.append(sorted(context_ids))
+        return {context_id: len(context_id) for context_id in context_ids
+                if context_id != "missing"}
+
+    def test_reuses_counts(self):
+        counts = self.cache.get(["t5_1", "missing"], self.count_multi)
+        self.assertEqual(counts, {"t5_1": 4})
+
+        self.now += 1
+        counts = self.cache.get(["t5_1", "missing", "t5_22"], self.count_multi)
+        self.assertEqual(counts, {"t5_1": 4, "t5_22": 5})
+        self.assertEqual(self.fetched, [["missing", "t5_1"], ["t5_22"]])
+
+        self.now += activity.ACTIVITY_COUNT_TTL
+        self.cache.get(["t5_1"], self.count_multi)
+        self.assertEqual(self.fetched[-1], ["t5_1"])
@@ -0,0 +1,62 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import all_sr
+from r2.tests import DictCache
+
+
+class AllHotTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.g = MagicMock(gencache=self.cache, live_config={})
+        patcher = patch.object(all_sr, "g", self.g)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_resort_links_penalizes_repeats(self):
+        self.g.live_config["r_all_penalty"] = 1
+        links = [(10., 1, "t3_a"), (9., 1, "t3_b"), (8.5, 2, "t3_c")]
+        resorted = all_sr.resort_links(links)
+        self.assertEqual([name for hot, sr_id, name in resorted],
+                         ["t3_a", "t3_c", "t3_b"])
+
+    def test_resort_links_disabled(self):
+        self.g.live_config["r_all_penalty"] = 0
+        links = [(10., 1, "t3_a"), (9., 1, "t3_b"), (8.5, 2, "t3_c")]
+        self.assertEqual(all_sr.resort_links(links), links)
+
+    @patch.object(all_sr, "CHUNK_SIZE", 2)
+    @patch.object(all_sr, "NUM_CHUNKS", 3)
+    def test_write_chunks(self):
+        all_sr.write_chunks(["t3_a", "t3_b", "t3_c", "t3_d", "t3_e"])
+        self.assertEqual(all_sr.get_all_hot_ids(),
+                         ["t3_a", "t3_b", "t3_c", "t3_d", "t3_e"])
+
+        with patch.object(self.cache, "set_multi") as set_multi:
+            all_sr.write_chunks(["t3_b", "t3_a", "t3_c", "t3_d"])
+        set_multi.assert_called_once_with(
+            {0: ["t3_b", "t3_a"]}, prefix=all_sr.CHUNK_PREFIX)
+        self.assertFalse(all_sr.CHUNK_PREFIX + "2" in self.cache)
@@ -0,0 +1,199 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import amqp
+
+
+class FakeMessage(object):
+    def __init__(self, delivery_tag, body, redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.body = body
+        self.properties = {}
+        self.delivery_info = {"redelivered": redelivered}
+
+
+class FakeChannel(object):
+    """Delivers a fixed list of messages through basic_consume.
+
+    If `stay_open` is set the consumer isn't cancelled after the last
+    message, so waiting on the channel again means waiting for a delivery
+    that never comes.
+
+    """
+
+    def __init__(self, messages, stay_open=False):
+        self.messages = list(messages)
+        self.stay_open = stay_open
+        self.callbacks = {}
+        self.is_open = True
+        self.delivered = 0
+        self.acked = []
+        self.rejected = []
+        self.requeued = []
+        self.settled_before_idle = None
+
+    def basic_qos(self, **kw):
+        pass
+
+    def basic_consume(self, queue, callback):
+        self.callbacks[queue] = callback
+
+    def ready(self, timeout):
+        if self.messages:
+            return True
+        time.sleep(timeout)
+        return False
+
+    def wait(self):
+        if not self.messages:
+            # a real channel would block here until the next delivery
+            self.settled_before_idle = len(self.acked) + len(self.rejected)
+            self.callbacks.clear()
+            return
+
+        callback = self.callbacks.values()[0]
+        msg = self.messages.pop(0)
+        if not self.messages and not self.stay_open:
+            self.callbacks.clear()
+        self.delivered += 1
+        callback(msg)
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.rejected.append(delivery_tag)
+        if requeue:
+            self.requeued.append(delivery_tag)
+
+    def close(self):
+        self.is_open = False
+
+
+class ConsumeBatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.processed = []
+        self.lock = threading.Lock()
+
+        patches = [
+            patch.object(amqp, "cfg", MagicMock()),
+            patch.object(amqp, "worker", MagicMock()),
+            patch.object(amqp, "_get_thread_objects", return_value=[]),
+            patch.object(amqp, "_wait_for_delivery",
+                         lambda chan, timeout: chan.ready(timeout)),
+            patch("pylons.tmpl_context", MagicMock(), create=True),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def consume(self, chan, callback, **kw):
+        manager = MagicMock()
+        manager.get_channel.return_value = chan
+        with patch.object(amqp, "connection_manager", manager):
+            amqp.consume_batches("test_q", callback, verbose=False, **kw)
+
+    def record(self, msgs):
+        with self.lock:
+            self.processed.extend((msg.body, msg.delivery_tag) for msg in msgs)
+
+    def test_acks_everything(self):
+        chan = FakeChannel(FakeMessage(i, "a") for i in xrange(20))
+        self.consume(chan, self.record, workers=3)
+
+        self.assertEqual(sorted(chan.acked), range(20))
+        self.assertEqual(chan.rejected, [])
+        self.assertEqual(len(self.processed), 20)
+        self.assertFalse(chan.is_open)
+
+    def test_key_order(self):
+        chan = FakeChannel(FakeMessage(i, "k%d" % (i % 3)) for i in xrange(30))
+        self.consume(chan, self.record, workers=4, batch_size=2,
+                     key_fn=lambda msg: msg.body)
+
+        for key in ("k0", "k1", "k2"):
+            tags = [tag for body, tag in self.processed if body == key]
+            self.assertEqual(tags, sorted(tags))
+            self.assertEqual(len(tags), 10)
+
+    def test_rejects_only_failures(self):
+        def callback(msgs):
+            if any(msg.body == "bad" for msg in msgs):
+                raise ValueError
+            self.record(msgs)
+
+        chan = FakeChannel(FakeMessage(i, "bad" if i == 3 else "ok")
+                           for i in xrange(8))
+        self.consume(chan, callback, workers=1, batch_size=8)
+
+        self.assertEqual(chan.rejected, [3])
+        self.assertEqual(chan.requeued, [])
+        self.assertEqual(sorted(chan.acked), [0, 1, 2, 4, 5, 6, 7])
+
+    def test_requeues_failures_once(self):
+        def callback(msgs):
+            if any(msg.body == "bad" for msg in msgs):
+                raise ValueError
+            self.record(msgs)
+
+        chan = FakeChannel([
+            FakeMessage(0, "bad"),
+            FakeMessage(1, "ok"),
+            FakeMessage(2, "bad", redelivered=True),
+        ])
+        self.consume(chan, callback, workers=1, requeue_failed=True)
+
+        self.assertEqual(sorted(chan.rejected), [0, 2])
+        self.assertEqual(chan.requeued, [0])
+        self.assertEqual(chan.acked, [1])
+
+    def test_acks_without_another_delivery(self):
+        def callback(msgs):
+            time.sleep(0.05)
+            self.record(msgs)
+
+        chan = FakeChannel((FakeMessage(i, "a") for i in xrange(5)),
+                           stay_open=True)
+        self.consume(chan, callback, workers=2, batch_size=1)
+
+        self.assertEqual(chan.settled_before_idle, 5)
+
+    def test_prefetch_window(self):
+        chan = FakeChannel(FakeMessage(i, "a") for i in xrange(50))
+        in_flight = []
+
+        def callback(msgs):
+            with self.lock:
+                settled = len(chan.acked) + len(chan.rejected)
+                in_flight.append(chan.delivered - settled)
+            self.record(msgs)
+
+        self.consume(chan, callback, workers=2, prefetch_count=5)
+
+        self.assertEqual(len(self.processed), 50)
+        self.assertTrue(max(in_flight) <= 5)
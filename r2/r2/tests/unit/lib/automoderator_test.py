@@ -0,0 +1,234 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import cPickle as pickle
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import automoderator
+from r2.lib.automoderator import LiteralIndex, Ruleset
+from r2.models import Comment, Link
+from r2.tests import RedditTestCase
+
+
+def make_comment(body):
+    comment = MagicMock(spec=Comment)
+    comment.body = body
+    return comment
+
+
+class LiteralIndexTest(unittest.TestCase):
+    def make_index(self, literals):
+        index = LiteralIndex()
+        ids = {literal: index.add(literal) for literal in literals}
+        index.build()
+        return index, ids
+
+    def test_overlapping(self):
+        index, ids = self.make_index(["he", "she", "his", "hers"])
+        self.assertEqual(index.search("ushers"),
+                         {ids["she"], ids["he"], ids["hers"]})
+        self.assertEqual(index.search("this"), {ids["his"]})
+        self.assertEqual(index.search("nothing"), set())
+
+    def test_same_literal_same_id(self):
+        index = LiteralIndex()
+        self.assertEqual(index.add("abc"), index.add("abc"))
+        self.assertEqual(len(index), 1)
+
+    def test_non_ascii(self):
+        index, ids = self.make_index([u"caf\xe9", u"\xe9t\xe9"])
+        self.assertEqual(index.search(u"un caf\xe9 d'\xe9t\xe9"),
+                         {ids[u"caf\xe9"], ids[u"\xe9t\xe9"]})
+        self.assertEqual(index.search(u"cafe"), set())
+
+
+class RulePrefilterTest(unittest.TestCase):
+    def make_ruleset(self, *rules):
+        yaml_text = "\n---\n".join(
+            "type: comment\naction: remove\n" + rule for rule in rules)
+        return Ruleset(yaml_text)
+
+    def can_match(self, ruleset, body):
+        comment = make_comment(body)
+        data = {"item": comment}
+        found = {}
+        return [ruleset.prefilter.can_match(rule, comment, data, found)
+                for rule in ruleset]
+
+    def test_missing_literal_skipped(self):
+        ruleset = self.make_ruleset("body: [foo, bar]")
+        self.assertEqual(len(ruleset.prefilter), 1)
+        self.assertEqual(self.can_match(ruleset, u"nothing here"), [False])
+        self.assertEqual(self.can_match(ruleset, u"a bar b"), [True])
+
+    def test_case_folded(self):
+        ruleset = self.make_ruleset(
+            "body: [Foo]",
+            "body (case-sensitive): [Foo]",
+        )
+        self.assertEqual(self.can_match(ruleset, u"FOO"), [True, False])
+        self.assertEqual(self.can_match(ruleset, u"Foo"), [True, True])
+
+    def test_non_ascii(self):
+        ruleset = self.make_ruleset(u"body: [caf\xe9]")
+        self.assertEqual(self.can_match(ruleset, u"un caf\xe9"), [True])
+        self.assertEqual(self.can_match(ruleset, u"un cafe"), [False])
+
+        # non-ascii bytestrings aren't searched, so the rule isn't skipped
+        self.assertEqual(self.can_match(ruleset, "caf\xc3\xa8"), [True])
+
+    def test_negated_and_regex_unfiltered(self):
+        ruleset = self.make_ruleset(
+            "~body: [foo]",
+            "body (regex): ['fo+']",
+        )
+        self.assertEqual(len(ruleset.prefilter), 0)
+        self.assertEqual(self.can_match(ruleset, u"bar"), [True, True])
+
+    def test_all_checks_required(self):
+        ruleset = self.make_ruleset("body: [foo]\nbody (includes): [bar]")
+        self.assertEqual(self.can_match(ruleset, u"foo"), [False])
+        self.assertEqual(self.can_match(ruleset, u"foo bar"), [True])
+
+
+class FilterRulesTest(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.object(
+            automoderator.PerformedRulesByThing, "get_already_performed",
+            return_value=set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_type_filter(self):
+        ruleset = Ruleset(
+            "type: comment\nbody: [foo]\naction: remove\n"
+            "---\n"
+            "type: submission\ntitle: [foo]\naction: remove\n"
+        )
+        comment_rule = [rule for rule in ruleset if rule.type == "comment"]
+        link_rule = [rule for rule in ruleset if rule.type == "submission"]
+
+        comment = make_comment(u"foo")
+        self.assertEqual(ruleset.filter_rules(ruleset, comment, "new"),
+                         comment_rule)
+
+        link = MagicMock(spec=Link)
+        self.assertEqual(ruleset.filter_rules(ruleset, link, "new"),
+                         link_rule)
+
+
+class PicklingCache(dict):
+    """A cache that stores pickles like memcached would."""
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return pickle.loads(self[key])
+
+    def set(self, key, value, time=0):
+        self[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class RulesetCacheTest(RedditTestCase):
+    def setUp(self):
+        super(RulesetCacheTest, self).setUp()
+        self.cache = PicklingCache()
+        self.patch_g(gencache=self.cache, stats=MagicMock())
+        self.wp = MagicMock(_id="wp1", revision="rev1",
+                            content="type: comment\nbody: [foo]\naction: remove")
+        self.standards_wp = MagicMock(revision="std1",
+            content="standard: foo\ntype: comment\nbody: [foo]")
+        self.get_wiki_page = self.autopatch(
+            automoderator.WikiPage, "get", return_value=self.standards_wp)
+
+    def test_cache_key(self):
+        key = Ruleset._cache_key(self.wp, self.standards_wp)
+        self.assertIn(str(automoderator.RULESET_CACHE_VERSION), key)
+        self.assertIn("wp1", key)
+        self.assertIn("rev1", key)
+        self.assertIn("std1", key)
+
+        self.wp.revision = "rev2"
+        self.assertNotEqual(Ruleset._cache_key(self.wp, self.standards_wp), key)
+
+    def test_miss_builds_and_caches(self):
+        rules = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(self.cache.keys(),
+                         [Ruleset._cache_key(self.wp, self.standards_wp)])
+
+        # the cached copy is used instead of the content from now on
+        self.wp.content = ""
+        cached = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual([rule.unique_id for rule in cached],
+                         [rule.unique_id for rule in rules])
+        self.assertEqual(len(cached.prefilter), 1)
+
+    def test_new_revision(self):
+        Ruleset.from_wiki_page(self.wp)
+
+        self.wp.revision = "rev2"
+        self.wp.content = "type: comment\nbody: [bar]\naction: remove\n"
+        rules = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual(len(self.cache), 2)
+
+        comment = make_comment(u"bar")
+        data = {"item": comment}
+        self.assertEqual(
+            [rules.prefilter.can_match(rule, comment, data, {})
+             for rule in rules],
+            [True],
+        )
+
+    def test_new_standards_revision(self):
+        self.wp.content = "standard: foo\naction: remove"
+        Ruleset.from_wiki_page(self.wp)
+
+        self.standards_wp.revision = "std2"
+        self.standards_wp.content = (
+            "standard: foo\ntype: comment\nbody: [bar]")
+        rules = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual(len(self.cache), 2)
+
+        comment = make_comment(u"bar")
+        data = {"item": comment}
+        self.assertEqual(
+            [rules.prefilter.can_match(rule, comment, data, {})
+             for rule in rules],
+            [True],
+        )
+
+    def test_missing_standards_not_cached(self):
+        self.wp.content = "standard: foo\naction: remove"
+        self.standards_wp.content = "standard: ["
+
+        rules = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual(len(rules), 0)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_no_revision(self):
+        self.wp.revision = None
+        rules = Ruleset.from_wiki_page(self.wp)
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,56 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.lib.bloom import BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        keys = ["t3_%d" % i for i in xrange(1000)]
+        for key in keys:
+            bloom.add(key)
+
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_error_rate(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        for i in xrange(1000):
+            bloom.add("t3_%d" % i)
+
+        false_positives = sum(1 for i in xrange(10000)
+                              if "t1_%d" % i in bloom)
+        self.assertTrue(false_positives < 200)
+
+    def test_round_trip(self):
+        bloom = BloomFilter.for_capacity(100, 0.01)
+        bloom.add(u"t1_abc")
+        self.assertEqual(bloom.capacity, 100)
+
+        copied = BloomFilter.from_tuple(bloom.to_tuple())
+        self.assertTrue("t1_abc" in copied)
+        self.assertFalse("t1_abd" in copied)
+        self.assertEqual(copied.count, 1)
+        self.assertEqual(copied.capacity, bloom.capacity)
@@ -0,0 +1,96 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import bucketed_set
+from r2.lib.bucketed_set import BucketedSet
+from r2.lib.cache import MemcachedError
+from r2.tests import DictCache
+
+
+class BucketedSetTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.now = 6000.
+        patches = [
+            patch.object(bucketed_set, "g", MagicMock(gencache=self.cache)),
+            patch.object(bucketed_set.time, "time", lambda: self.now),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        self.marked = BucketedSet("test:", 60, 10, num_shards=4)
+
+    def get_all(self):
+        bucket = self.marked.bucket()
+        return self.marked.get(bucket - 10, bucket)
+
+    def test_add_and_get(self):
+        self.marked.add(["a", "b"])
+        self.now += 60
+        self.marked.add(["c", 4])
+
+        self.assertEqual(self.get_all(), ({"a", "b", "c", "4"}, True))
+        bucket = self.marked.bucket()
+        self.assertEqual(self.marked.get(bucket, bucket), ({"c", "4"}, True))
+
+    def test_appends_once_per_bucket(self):
+        with patch.object(self.cache, "append",
+                          wraps=self.cache.append) as append:
+            self.marked.add(["a", "a"])
+            self.marked.add(["a"])
+            self.assertEqual(append.call_count, 1)
+
+            # a new bucket starts over
+            self.now += 60
+            self.marked.add(["a"])
+            self.assertEqual(append.call_count, 2)
+
+    def test_sharded(self):
+        members = [str(i) for i in xrange(100)]
+        self.marked.add(members)
+
+        values = [value for key, value in self.cache.iteritems()
+                  if key.startswith("test:")]
+        self.assertEqual(len(values), 4)
+        self.assertEqual(self.get_all(), (set(members), True))
+
+    def test_failed_append(self):
+        with patch.object(self.cache, "append", return_value=False):
+            self.marked.add(["a"])
+        self.assertEqual(self.get_all(), (set(), False))
+
+        # the member wasn't remembered as added, so it's tried again
+        self.marked.add(["a"])
+        self.assertEqual(self.get_all(), ({"a"}, False))
+
+        self.now += 11 * 60
+        self.assertEqual(self.get_all(), (set(), True))
+
+    def test_cache_error(self):
+        with patch.object(self.cache, "add", side_effect=MemcachedError):
+            self.marked.add(["a"])
+        self.assertEqual(self.get_all(), (set(), False))
@@ -0,0 +1,139 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import cache
+from r2.lib.cache import BoundedLocalCache, LocalCache, LRUCache
+
+
+class BoundedLocalCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        local = BoundedLocalCache(max_size=3)
+        for key in "abc":
+            local.set(key, key)
+
+        local.get("a")
+        local.set("d", "d")
+        self.assertEqual(sorted(local.keys()), ["a", "c", "d"])
+
+        local.simple_get_multi(["c"])
+        local.update({"e": "e"})
+        self.assertEqual(sorted(local.keys()), ["c", "d", "e"])
+
+    def test_is_local_cache(self):
+        # CacheChain treats LocalCaches specially
+        self.assertTrue(isinstance(BoundedLocalCache(), LocalCache))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.
+        patcher = patch.object(cache, "current_time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_max_size(self):
+        lru = LRUCache(max_size=3)
+        lru.stats = MagicMock()
+        for key in "abc":
+            lru.set(key, key)
+
+        self.assertEqual(lru.get("a"), "a")
+        lru.set("d", "d")
+
+        self.assertEqual(sorted(lru.simple_get_multi("abcd")), ["a", "c", "d"])
+        lru.stats.cache_eviction.assert_called_once_with(1)
+
+    def test_max_bytes(self):
+        lru = LRUCache(max_size=100, max_bytes=100)
+        for i in xrange(10):
+            lru.set(str(i), "x" * 30)
+
+        self.assertTrue(lru.size_bytes <= 100)
+        self.assertEqual(lru.get("9"), "x" * 30)
+        self.assertEqual(lru.get("0"), None)
+
+    def test_expiration(self):
+        lru = LRUCache(max_time=10)
+        lru.set("default", 1)
+        lru.set("short", 1, time=5)
+        lru.set("long", 1, time=30)
+
+        self.now += 6
+        self.assertEqual(lru.simple_get_multi(["default", "short", "long"]),
+                         {"default": 1, "long": 1})
+
+        # stale writes ask for longer but are capped at max_time
+        self.now += 5
+        self.assertEqual(lru.simple_get_multi(["default", "long"]), {})
+
+    def test_no_max_time(self):
+        lru = LRUCache()
+        lru.set("forever", 1)
+        lru.set("short", 1, time=5)
+
+        self.now += 1000
+        self.assertEqual(lru.simple_get_multi(["forever", "short"]),
+                         {"forever": 1})
+
+    def test_readers_get_copies(self):
+        lru = LRUCache()
+        lru.set("key", [1])
+        lru.get("key").append(2)
+        self.assertEqual(lru.get("key"), [1])
+
+    def test_unpickled_values(self):
+        class Sized(object):
+            def __sizeof__(self):
+                return 60
+
+        lru = LRUCache(max_bytes=100, pickle_values=False)
+        a, b = Sized(), Sized()
+        lru.set("a", a)
+        self.assertIs(lru.get("a"), a)
+
+        lru.set("b", b)
+        self.assertEqual(lru.simple_get_multi(["a", "b"]), {"b": b})
+        self.assertTrue(lru.size_bytes <= 100)
+
+    def test_stats(self):
+        lru = LRUCache()
+        lru.stats = MagicMock()
+        lru.set("a", 1)
+        lru.simple_get_multi(["a", "b"])
+
+        lru.stats.cache_hit.assert_called_once_with(1)
+        lru.stats.cache_miss.assert_called_once_with(1)
+
+    def test_add_and_modify(self):
+        lru = LRUCache()
+        self.assertTrue(lru.add("a", 1))
+        self.assertFalse(lru.add("a", 2))
+        self.assertEqual(lru.get("a"), 1)
+
+        # in-place modifications just drop the entry
+        lru.incr("a")
+        self.assertEqual(lru.get("a"), None)
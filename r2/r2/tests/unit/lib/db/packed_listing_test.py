@@ -0,0 +1,122 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from r2.lib.db import packed_listing
+from r2.lib.db.packed_listing import PackedListing
+
+
+class PackedListingTest(unittest.TestCase):
+    rows = [
+        ("t3_c", 30.5, 1400000300.0),
+        ("t3_b", 20.25, 1400000200.0),
+        ("t3_a", 10.0, 1400000100.0),
+    ]
+
+    def roundtrip(self, listing):
+        return PackedListing.from_string(listing.to_string())
+
+    def test_roundtrip(self):
+        listing = self.roundtrip(PackedListing.from_rows(self.rows))
+        self.assertEquals(len(listing), 3)
+        self.assertEquals(list(listing), self.rows)
+        self.assertEquals(listing[0], self.rows[0])
+        self.assertEquals(listing[1:], self.rows[1:])
+        self.assertEquals(listing.fullnames(), ["t3_c", "t3_b", "t3_a"])
+        self.assertEquals(listing.fullnames(limit=2), ["t3_c", "t3_b"])
+
+    def test_integer_columns_stay_integers(self):
+        rows = [("t1_zz", 5, 1.5), ("t1_1", 3, 2.5)]
+        listing = self.roundtrip(PackedListing.from_rows(rows))
+        self.assertEquals(list(listing), rows)
+        self.assertTrue(isinstance(listing[0][1], int))
+
+    def test_mixed_prefixes(self):
+        rows = [("t3_c", 3.0), ("t1_b", 2.0), ("t3_a", 1.0)]
+        listing = self.roundtrip(PackedListing.from_rows(rows))
+        self.assertEquals(list(listing), rows)
+
+    def test_insert(self):
+        listing = self.roundtrip(PackedListing.from_rows(self.rows))
+        listing.insert([("t3_d", 25.0, 1400000400.0)], limit=1000)
+        self.assertEquals(listing.fullnames(),
+                          ["t3_c", "t3_d", "t3_b", "t3_a"])
+
+    def test_insert_replaces_existing(self):
+        listing = PackedListing.from_rows(self.rows)
+        listing.insert([("t3_a", 40.0, 1400000100.0)], limit=1000)
+        self.assertEquals(listing.fullnames(), ["t3_a", "t3_c", "t3_b"])
+        self.assertEquals(listing[0], ("t3_a", 40.0, 1400000100.0))
+
+    def test_insert_ties_go_after_existing(self):
+        listing = PackedListing.from_rows([("t3_a", 1.0), ("t3_b", 1.0)])
+        listing.insert([("t3_c", 1.0)], limit=1000)
+        self.assertEquals(listing.fullnames(), ["t3_a", "t3_b", "t3_c"])
+
+    def test_insert_truncates(self):
+        listing = PackedListing.from_rows(self.rows)
+        listing.insert([("t3_d", 1.0, 0.0)], limit=3)
+        self.assertEquals(list(listing), self.rows)
+
+        listing.insert([("t3_d", 50.0, 0.0)], limit=3)
+        self.assertEquals(listing.fullnames(), ["t3_d", "t3_c", "t3_b"])
+
+    def test_insert_into_empty(self):
+        listing = PackedListing()
+        listing.insert(self.rows[::-1], limit=1000)
+        self.assertEquals(list(self.roundtrip(listing)), self.rows)
+
+    def test_unpackable_rows(self):
+        listing = PackedListing.from_rows(self.rows)
+        self.assertRaises(ValueError, listing.insert,
+                          [("t3_d", "hot", 0.0)], 1000)
+        self.assertRaises(ValueError, listing.insert,
+                          [("not a fullname", 1.0, 0.0)], 1000)
+        self.assertEquals(list(listing), self.rows)
+
+    def test_delete(self):
+        listing = self.roundtrip(PackedListing.from_rows(self.rows))
+        listing.delete(["t3_b", "t3_missing", "t1_a"])
+        self.assertEquals(list(listing), [self.rows[0], self.rows[2]])
+
+
+class PackedListingHelpersTest(unittest.TestCase):
+    def test_load_legacy(self):
+        rows = [("t3_a", 1.0)]
+        self.assertEquals(packed_listing.load(rows), rows)
+        self.assertEquals(packed_listing.load(None), [])
+
+    def test_dump_falls_back_to_legacy(self):
+        rows = [("t3_a", "not a number")]
+        self.assertEquals(packed_listing.dump(rows), rows)
+
+        packed = packed_listing.dump([("t3_a", 1.0)])
+        self.assertTrue(packed_listing.is_packed(packed))
+        self.assertEquals(list(packed_listing.load(packed)), [("t3_a", 1.0)])
+
+    def test_columns(self):
+        rows = [("t3_b", 2.0, 20.0), ("t3_a", 1.0, 10.0)]
+        expected = (["t3_b"], [[2.0], [20.0]])
+        for listing in (rows, PackedListing.from_rows(rows)):
+            names, cols = packed_listing.columns(listing, limit=1)
+            self.assertEquals((names, map(list, cols)), expected)
@@ -0,0 +1,89 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import math
+import struct
+import unittest
+from array import array
+
+from r2.lib.db import sorts
+
+
+def bits(values):
+    return [struct.pack("d", value) for value in values]
+
+
+class BatchSortsTest(unittest.TestCase):
+    ups = array("l", [0, 1, 5, 0, 399, 400, 10000, 123456, 7])
+    downs = array("l", [0, 0, 3, 8, 99, 100, 12000, 12, 7])
+    dates = array("d", [1134028003, 1400000000.5, 1450000000.25, 1300000000,
+                        1500000000, 1134028002.99, 1465000000, 1400000123.456,
+                        1000000000])
+
+    def test_hot(self):
+        expected = [sorts._hot(u, d, t)
+                    for u, d, t in zip(self.ups, self.downs, self.dates)]
+        result = sorts.hot_batch(self.ups, self.downs, self.dates)
+        self.assertEquals(bits(result), bits(expected))
+
+    def test_hot_matches_python_round(self):
+        # _hot avoids calling round() in the common case
+        for u, d, t in zip(self.ups, self.downs, self.dates):
+            s = u - d
+            sign = 1 if s > 0 else -1 if s < 0 else 0
+            order = math.log10(max(abs(s), 1))
+            expected = round(sign * order + (t - 1134028003) / 45000, 7)
+            self.assertEquals(bits([sorts._hot(u, d, t)]), bits([expected]))
+
+    def test_controversy(self):
+        expected = [sorts.controversy(u, d)
+                    for u, d in zip(self.ups, self.downs)]
+        result = sorts.controversy_batch(self.ups, self.downs)
+        self.assertEquals(bits(result), bits(expected))
+
+    def test_confidence(self):
+        expected = [sorts.confidence(u, d)
+                    for u, d in zip(self.ups, self.downs)]
+        result = sorts.confidence_batch(self.ups, self.downs)
+        self.assertEquals(bits(result), bits(expected))
+
+    def test_score(self):
+        expected = [sorts.score(u, d) for u, d in zip(self.ups, self.downs)]
+        result = sorts.score_batch(self.ups, self.downs)
+        self.assertEquals(list(result), expected)
+
+    def test_qa(self):
+        question_scores = sorts.confidence_batch(self.ups, self.downs)
+        lengths = array("l", range(1, len(self.ups) + 1))
+        answer_scores = array("d", [0., 0.5] * 4 + [0.25])
+        answer_lengths = array("l", [1, 20] * 4 + [300])
+        expected = [
+            sorts._qa(*args) for args in
+            zip(question_scores, lengths, answer_scores, answer_lengths)
+        ]
+        result = sorts.qa_batch(
+            question_scores, lengths, answer_scores, answer_lengths)
+        self.assertEquals(bits(result), bits(expected))
+
+    def test_mismatched_lengths(self):
+        self.assertRaises(ValueError, sorts.controversy_batch,
+                          self.ups, self.downs[:2])
@@ -0,0 +1,208 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib.db import operators, thing
+from r2.tests import DictCache
+
+
+class Account(object):
+    pass
+
+
+class Link(object):
+    pass
+
+
+class Vote(object):
+    _type1 = Account
+    _type2 = Link
+
+
+class FakeQuery(thing.RelationsPropsOnly):
+    def __init__(self, *rules, **kw):
+        self.rows = []
+        self.runs = 0
+        thing.RelationsPropsOnly.__init__(
+            self, Vote, ["_thing2_id"], *rules, **kw)
+
+    def _get_results(self):
+        self.runs += 1
+        return list(self.rows)
+
+
+class FakeThings(thing.Things):
+    def __init__(self, *rules, **kw):
+        self.rows = []
+        self.runs = 0
+        thing.Things.__init__(self, Link, *rules, **kw)
+
+    def _get_results(self):
+        self.runs += 1
+        return list(self.rows)
+
+    # rows stand in for the things' fullnames
+    def get_from_cache(self, allow_local=True):
+        return self._get_cached(allow_local=allow_local)
+
+    def set_to_cache(self, things, generations=None):
+        self._set_cached(things, generations)
+
+
+class QueryGenerationTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.now = 1000.
+
+        patches = [
+            patch.object(thing, "g", MagicMock(gencache=self.cache)),
+            patch.object(thing.time, "time", lambda: self.now),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def make_query(self, *rules, **kw):
+        kw.setdefault("cache_time", 60)
+        return FakeQuery(*rules, read_cache=True, write_cache=True, **kw)
+
+    def bump_partition(self, column, value):
+        thing._bump_generations(
+            [thing._query_partition_key(Vote, column, value)])
+
+    def test_gen_keys(self):
+        q = self.make_query(operators.eq(None, "_thing1_id", 1),
+                            operators.eq(None, "_t2_sr_id", 2),
+                            sort=operators.desc("_t2__date"))
+
+        self.assertEqual(q._gen_keys(), [
+            "querygen:Link._date",
+            "querygen:Link.sr_id",
+            "querygen:Vote._thing1_id=1",
+        ])
+
+    def test_unversioned_queries(self):
+        # not limited to one thing1 or thing2
+        q = self.make_query(operators.eq(None, "_t2_sr_id", 2))
+        self.assertIsNone(q._gen_keys())
+
+        q = self.make_query(operators.eq(None, "_thing1_id", [1, 2]))
+        self.assertIsNone(q._gen_keys())
+
+        # sorted by votes
+        q = self.make_query(operators.eq(None, "_thing1_id", 1),
+                            sort=operators.desc("_t2__hot"))
+        self.assertIsNone(q._gen_keys())
+
+    def test_time_dependent_queries_have_no_generations(self):
+        q = self.make_query(
+            operators.eq(None, "_thing1_id", 1),
+            operators.gt(None, "_date", operators.timeago("1 day")))
+        self.assertIsNone(q._gen_keys())
+
+        q = self.make_query(operators.eq(None, "_thing1_id", 1),
+                            sort=operators.shuffled("_date"))
+        self.assertIsNone(q._gen_keys())
+
+    def test_kept_until_invalidated(self):
+        q = self.make_query(operators.eq(None, "_thing1_id", 1),
+                            operators.eq(None, "_t2_sr_id", 2))
+        q.rows = [1, 2]
+        self.assertEqual(list(q), [1, 2])
+
+        # past cache_time but nothing it depends on has changed
+        self.now += 3600
+        q.rows = [1, 2, 3]
+        self.assertEqual(list(q), [1, 2])
+        self.assertEqual(q.runs, 1)
+
+        # changes that can't affect it don't invalidate it
+        thing.bump_query_generations(Link, ["title", "_ups"])
+        self.bump_partition("_thing1_id", 2)
+        self.assertEqual(list(q), [1, 2])
+
+        thing.bump_query_generations(Link, ["sr_id"])
+        self.assertEqual(list(q), [1, 2, 3])
+        self.assertEqual(q.runs, 2)
+
+        q.rows = [4]
+        self.now += 3600
+        self.bump_partition("_thing1_id", 1)
+        self.assertEqual(list(q), [4])
+
+    def test_within_cache_time(self):
+        q = self.make_query(operators.eq(None, "_thing1_id", 1))
+        q.rows = [1]
+        self.assertEqual(list(q), [1])
+
+        q.rows = [2]
+        self.bump_partition("_thing1_id", 1)
+        self.now += 30
+        self.assertEqual(list(q), [1])
+
+    def test_unversioned_query_expires(self):
+        q = self.make_query(operators.eq(None, "_t2_sr_id", 2))
+        q.rows = [1]
+        self.assertEqual(list(q), [1])
+
+        q.rows = [2]
+        self.now += 3600
+        self.assertEqual(list(q), [2])
+
+    def make_things_query(self, *rules, **kw):
+        kw.setdefault("cache_time", 60)
+        return FakeThings(*rules, read_cache=True, write_cache=True, **kw)
+
+    def test_things_gen_keys(self):
+        q = self.make_things_query(operators.eq(None, "sr_id", 2),
+                                   sort=operators.desc("_date"))
+        self.assertEqual(q._gen_keys(), [
+            "querygen:Link._date",
+            "querygen:Link.sr_id",
+            "querygen:Link:new",
+        ])
+
+        q = self.make_things_query(operators.eq(None, "sr_id", 2),
+                                   sort=operators.desc("_hot"))
+        self.assertIsNone(q._gen_keys())
+
+    def test_things_kept_until_invalidated(self):
+        q = self.make_things_query(operators.eq(None, "sr_id", 2))
+        q.rows = [1, 2]
+        self.assertEqual(list(q), [1, 2])
+
+        self.now += 3600
+        q.rows = [1, 2, 3]
+        thing.bump_query_generations(Link, ["title"])
+        self.assertEqual(list(q), [1, 2])
+
+        thing._bump_generations([thing._query_insert_key(Link)])
+        self.assertEqual(list(q), [1, 2, 3])
+
+        q.rows = [1]
+        self.now += 3600
+        thing.bump_query_generations(Link, ["sr_id"])
+        self.assertEqual(list(q), [1])
+        self.assertEqual(q.runs, 3)
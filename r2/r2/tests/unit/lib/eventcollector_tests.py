@@ -24,6 +24,7 @@
 
 from collections import defaultdict
 import datetime
+import json
 import unittest
 
 import mock
@@ -34,8 +35,8 @@ from mock import MagicMock, Mock, PropertyMock
 
 from r2.tests import RedditTestCase
 from r2.models import Account, Comment, FakeAccount, Link, Subreddit
-from r2.lib import hooks
-from r2.lib.eventcollector import EventQueue
+from r2.lib import eventcollector, hooks
+from r2.lib.eventcollector import Event, EventBatcher, EventQueue
 from r2.tests import MockEventQueue
 from r2 import models
 
@@ -850,3 +851,73 @@ class TestSearchEngineCrawlEvent(unittest.TestCase):
             mock_context)
 
         self.assertEquals(self.mock_save_event.call_count, 0)
+
+
+class FakeMessageQueue(object):
+    def __init__(self, name, max_messages, max_message_size):
+        self.messages = []
+        self.full = False
+
+    def put(self, message, timeout=None):
+        if self.full:
+            raise eventcollector.TimedOutError
+        self.messages.append(message)
+
+
+class TestEventBatcher(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(
+            eventcollector, "MessageQueue", FakeMessageQueue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats = MagicMock()
+        self.batcher = EventBatcher("test", self.stats, MagicMock())
+
+    def put_events(self, count):
+        for i in xrange(count):
+            self.batcher.put(Event("topic", "type_%d" % i))
+
+    def test_batches_events(self):
+        self.put_events(eventcollector.EVENT_BATCH_SIZE + 1)
+        self.assertEqual(len(self.batcher.queue.messages), 1)
+
+        self.batcher.flush()
+        messages = self.batcher.queue.messages
+        self.assertEqual(len(messages), 2)
+
+        # the publisher wraps the messages in a list
+        events = json.loads("[" + ",".join(messages) + "]")
+        self.assertEqual(len(events), eventcollector.EVENT_BATCH_SIZE + 1)
+        self.assertEqual(events[-1]["event_type"],
+                         "type_%d" % eventcollector.EVENT_BATCH_SIZE)
+
+    def test_flush_max_age(self):
+        self.put_events(1)
+        self.batcher.flush(max_age=60)
+        self.assertEqual(self.batcher.queue.messages, [])
+
+        self.batcher.flush(max_age=0)
+        self.assertEqual(len(self.batcher.queue.messages), 1)
+
+    def test_retries_when_full(self):
+        self.batcher.queue.full = True
+        self.put_events(1)
+        self.batcher.flush()
+        self.stats.simple_event.assert_called_with("eventcollector.queue_full")
+
+        self.batcher.queue.full = False
+        self.batcher.flush()
+        self.assertEqual(len(self.batcher.queue.messages), 1)
+
+    @mock.patch.object(eventcollector, "MAX_PENDING_EVENTS", 2)
+    def test_drops_oldest_pending(self):
+        self.batcher.queue.full = True
+        for i in xrange(3):
+            self.put_events(1)
+            self.batcher.flush()
+
+        self.batcher.queue.full = False
+        self.batcher.flush()
+        self.assertEqual(len(self.batcher.queue.messages), 2)
+        self.stats.simple_event.assert_any_call(
+            "eventcollector.pending_dropped", delta=1)
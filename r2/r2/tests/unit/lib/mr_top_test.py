@@ -21,6 +21,10 @@
 ###############################################################################
 from StringIO import StringIO
 from mock import MagicMock
+import json
+import os
+import shutil
+import tempfile
 import time
 
 from r2.tests import RedditTestCase
@@ -210,3 +214,148 @@ class MrTopTests(RedditTestCase):
         # the limit should be reflected in the call to _replace
         MrTop.write_permacache(fd=stdin, out=stdout, num=1)
         self.assertEqual(len(query._replace.call_args[0][0]), 1)
+
+    def _sorted_dump(self, fields, *links):
+        lines = []
+        for link in links:
+            lines.extend(make_pg_dump(fields, link).splitlines())
+        lines.sort()
+        return StringIO("\n".join(lines) + "\n")
+
+    def test_batch_scores(self):
+        votes = ((1, 0), (5, 3), (0, 8), (1000, 999))
+        things = [make_link(thing_id=i, ups=ups, downs=downs)
+                  for i, (ups, downs) in enumerate(votes)]
+
+        scores = MrTop("link").batch_scores(things)
+
+        self.assertEqual(list(scores["top"]),
+                         [mr_top.top_score(thing) for thing in things])
+        self.assertEqual(list(scores["controversial"]),
+                         [mr_top.controversy_score(thing) for thing in things])
+
+    def test_listing_heaps(self):
+        now = int(time.time())
+        links = [
+            make_link(thing_id=i, ups=i, timestamp=now, author_id=2, url="",
+                      sr_id=10)
+            for i in xrange(1, 6)
+        ]
+        fd = self._sorted_dump(["author_id", "sr_id", "url"], *links)
+
+        top = MrTop("link", err=StringIO())
+        heaps = top.listing_heaps(["hour"], fd, num=3)
+
+        self.assertEqual(sorted(heaps), [
+            "sr/link/controversial/hour/10",
+            "sr/link/top/hour/10",
+            "user/link/controversial/hour/2",
+            "user/link/top/hour/2",
+        ])
+        top = sorted(heaps["sr/link/top/hour/10"], reverse=True)
+        self.assertEqual(
+            [fname for value, timestamp, fname in top],
+            ["t3_5", "t3_4", "t3_3"],
+        )
+
+    def test_listing_heaps_sharded(self):
+        now = int(time.time())
+        links = [
+            make_link(thing_id=i, timestamp=now, author_id=i,
+                      url="http://foo.com/", sr_id=10)
+            for i in xrange(1, 6)
+        ]
+        fields = ["author_id", "sr_id", "url"]
+
+        top = MrTop("link", err=StringIO())
+        everything = top.listing_heaps(
+            ["hour"], self._sorted_dump(fields, *links))
+        shards = [
+            top.listing_heaps(["hour"], self._sorted_dump(fields, *links),
+                                 shard=shard, num_shards=2)
+            for shard in xrange(2)
+        ]
+
+        self.assertEqual(set(shards[0]) & set(shards[1]), set())
+        self.assertEqual(set(shards[0]) | set(shards[1]), set(everything))
+
+    def test_store_listings(self):
+        g = self.autopatch(mr_top, "g")
+        query = self.queries._get_links.return_value = MagicMock()
+
+        MrTop.store_listings([
+            ("sr/link/top/hour/1", [(1., 100., "t3_1"), (2., 50., "t3_2")]),
+            ("sr/link/top/all/1", [(1., 100., "t3_1")]),
+        ])
+
+        # the time-based listing is written in bulk without locking
+        query._dump.assert_called_once_with(
+            [("t3_2", 2., 50.), ("t3_1", 1., 100.)])
+        g.permacache.pessimistically_set_multi.assert_called_once_with(
+            {query.iden: query._dump.return_value})
+        query._replace.assert_called_once_with(
+            [("t3_1", 1., 100.)], lock=True)
+
+    def make_dump(self, contents="dump"):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dump = os.path.join(tmpdir, "sorted.dump")
+        with open(dump, "w") as f:
+            f.write(contents)
+        return dump, os.path.join(tmpdir, "checkpoint")
+
+    def test_write_listings_resume(self):
+        store_listings = self.autopatch(MrTop, "store_listings")
+        dump, checkpoint = self.make_dump()
+
+        top = MrTop("link", err=StringIO())
+        state = top._checkpoint_state(["hour"], 0, 1, dump)
+        with open(checkpoint, "w") as f:
+            json.dump(dict(state, last_key="sr/link/top/hour/1"), f)
+
+        heaps = {
+            "sr/link/top/hour/1": [(1., 100., "t3_1")],
+            "sr/link/top/hour/2": [(1., 100., "t3_2")],
+        }
+        top.write_listings(heaps, checkpoint=checkpoint, state=state)
+
+        store_listings.assert_called_once_with(
+            [("sr/link/top/hour/2", [(1., 100., "t3_2")])])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_write_listings_ignores_other_checkpoints(self):
+        store_listings = self.autopatch(MrTop, "store_listings")
+        dump, checkpoint = self.make_dump()
+
+        top = MrTop("link", err=StringIO())
+        state = top._checkpoint_state(["hour"], 0, 1, dump)
+        other_state = top._checkpoint_state(["week"], 0, 1, dump)
+        with open(checkpoint, "w") as f:
+            json.dump(dict(other_state, last_key="sr/link/top/hour/1"), f)
+
+        heaps = {"sr/link/top/hour/1": [(1., 100., "t3_1")]}
+        top.write_listings(heaps, checkpoint=checkpoint, state=state)
+
+        store_listings.assert_called_once_with(
+            [("sr/link/top/hour/1", [(1., 100., "t3_1")])])
+
+    def test_write_listings_ignores_checkpoint_of_old_dump(self):
+        store_listings = self.autopatch(MrTop, "store_listings")
+        dump, checkpoint = self.make_dump()
+
+        top = MrTop("link", err=StringIO())
+        old_state = top._checkpoint_state(["hour"], 0, 1, dump)
+        with open(checkpoint, "w") as f:
+            json.dump(dict(old_state, last_key="sr/link/top/hour/1"), f)
+
+        # the same path exported again with new data
+        with open(dump, "w") as f:
+            f.write("a new dump")
+        state = top._checkpoint_state(["hour"], 0, 1, dump)
+
+        heaps = {"sr/link/top/hour/1": [(1., 100., "t3_1")]}
+        top.write_listings(heaps, checkpoint=checkpoint, state=state)
+
+        store_listings.assert_called_once_with(
+            [("sr/link/top/hour/1", [(1., 100., "t3_1")])])
+        self.assertFalse(os.path.exists(checkpoint))
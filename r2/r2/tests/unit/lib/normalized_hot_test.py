@@ -0,0 +1,137 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import itertools
+import unittest
+from datetime import datetime
+
+import pytz
+from mock import MagicMock, patch
+
+from r2.lib import normalized_hot
+from r2.lib.db.sorts import epoch_seconds
+from r2.lib.normalized_hot import NormalizedHotListing
+from r2.tests import DictCache
+
+
+class NormalizedHotTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.g = MagicMock(gencache=self.cache, tz=pytz.UTC, HOT_PAGE_AGE=1)
+        self.now = epoch_seconds(datetime.now(pytz.UTC))
+
+        patches = [
+            patch.object(normalized_hot, "g", self.g),
+            patch.object(normalized_hot, "feature", MagicMock()),
+            patch.object(normalized_hot, "CachedResults", MagicMock()),
+            patch.object(normalized_hot, "_get_links",
+                         side_effect=self.get_links),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+        # subreddit id -> [(fullname, hot, timestamp)]
+        self.listings = {
+            1: [("t3_a", 100., self.now), ("t3_b", 50., self.now)],
+            2: [("t3_c", 10., self.now), ("t3_d", 8., self.now),
+                ("t3_e", 2., self.now)],
+        }
+
+    def get_links(self, sr_id, sort, time):
+        return MagicMock(data=self.listings[sr_id])
+
+    def test_merge_order(self):
+        # each subreddit's hot is scaled by its top link so small subreddits
+        # are mixed in with the big ones
+        self.assertEqual(normalized_hot.normalized_hot([1, 2]),
+                         ["t3_a", "t3_c", "t3_d", "t3_b", "t3_e"])
+
+    def test_age_limit(self):
+        self.listings[2][1] = ("t3_d", 8., self.now - 2 * 86400)
+
+        self.assertEqual(normalized_hot.normalized_hot([1, 2]),
+                         ["t3_a", "t3_c", "t3_b", "t3_e"])
+        self.assertEqual(
+            normalized_hot.normalized_hot([1, 2], obey_age_limit=False),
+            ["t3_a", "t3_c", "t3_d", "t3_b", "t3_e"])
+
+    @patch.object(normalized_hot, "MERGE_CHUNK_SIZE", 2)
+    def test_merges_lazily(self):
+        consumed = []
+
+        def get_hot_tuples(sr_ids, ageweight=None):
+            def tuples(sr_id):
+                top_hot = self.listings[sr_id][0][1]
+                for name, hot, timestamp in self.listings[sr_id]:
+                    consumed.append(name)
+                    yield (-hot / top_hot, -hot, name, timestamp)
+            return {sr_id: tuples(sr_id) for sr_id in sr_ids}
+
+        with patch.object(normalized_hot, "get_hot_tuples",
+                          side_effect=get_hot_tuples):
+            listing = NormalizedHotListing([1, 2])
+            names = list(itertools.islice(listing, 2))
+
+        self.assertEqual(names, ["t3_a", "t3_c"])
+        self.assertFalse("t3_e" in consumed)
+
+    @patch.object(normalized_hot, "MERGE_CHUNK_SIZE", 2)
+    def test_cached_merge(self):
+        first = list(itertools.islice(NormalizedHotListing([2, 1]), 2))
+        self.assertEqual(first, ["t3_a", "t3_c"])
+
+        # the start of the listing comes from the cache and the merge picks
+        # up after it
+        with patch.object(normalized_hot, "get_hot_tuples",
+                          wraps=normalized_hot.get_hot_tuples) as get_tuples:
+            self.assertEqual(
+                list(itertools.islice(NormalizedHotListing([1, 2]), 2)),
+                ["t3_a", "t3_c"])
+            self.assertFalse(get_tuples.called)
+
+            self.assertEqual(list(NormalizedHotListing([1, 2])),
+                             ["t3_a", "t3_c", "t3_d", "t3_b", "t3_e"])
+            self.assertEqual(get_tuples.call_count, 1)
+
+            # now the whole listing is cached
+            self.assertEqual(list(NormalizedHotListing([1, 2])),
+                             ["t3_a", "t3_c", "t3_d", "t3_b", "t3_e"])
+            self.assertEqual(get_tuples.call_count, 1)
+
+    @patch.object(normalized_hot, "MERGE_CHUNK_SIZE", 2)
+    def test_cached_merge_after_reorder(self):
+        first = list(itertools.islice(NormalizedHotListing([1, 2]), 2))
+        self.assertEqual(first, ["t3_a", "t3_c"])
+
+        # t3_d moves above t3_c after the start of the listing was cached
+        self.listings[2] = [("t3_d", 10., self.now), ("t3_c", 9., self.now),
+                            ("t3_e", 2., self.now)]
+        self.assertEqual(list(NormalizedHotListing([1, 2])),
+                         ["t3_a", "t3_c", "t3_d", "t3_b", "t3_e"])
+
+    def test_cache_key(self):
+        self.assertEqual(NormalizedHotListing([1, 2]).cache_key,
+                         NormalizedHotListing([2, 1, 2]).cache_key)
+        self.assertNotEqual(
+            NormalizedHotListing([1, 2]).cache_key,
+            NormalizedHotListing([1, 2], obey_age_limit=False).cache_key)
@@ -0,0 +1,77 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import time
+import unittest
+from collections import Counter
+
+from r2.lib.profiler import SamplingProfiler, collapse_samples, sample_category
+
+
+class SampleCategoryTest(unittest.TestCase):
+    def test_innermost_frame_wins(self):
+        stack = (
+            ("r2.controllers.listingcontroller", "GET_listing"),
+            ("r2.models.builder", "get_items"),
+            ("r2.lib.cache", "get_multi"),
+            ("socket", "recv"),
+        )
+        self.assertEqual(sample_category(stack), "cache")
+        self.assertEqual(sample_category(stack[:2]), "builder")
+
+    def test_other(self):
+        self.assertEqual(sample_category((("json", "dumps"),)), "other")
+
+
+class CollapseSamplesTest(unittest.TestCase):
+    def test_format(self):
+        samples = Counter({
+            (("r2.controllers.front", "GET_comments"),
+             ("r2.lib.db.thing", "_byID")): 3,
+        })
+        self.assertEqual(
+            collapse_samples(samples, root="front.GET_comments"),
+            ["front.GET_comments;db;r2.controllers.front:GET_comments;"
+             "r2.lib.db.thing:_byID 3"],
+        )
+
+
+def busy_loop(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class SamplingProfilerTest(unittest.TestCase):
+    def test_samples_calling_thread(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        busy_loop(0.05)
+        samples = profiler.stop()
+
+        self.assertTrue(samples)
+        self.assertTrue(any(
+            (__name__, "busy_loop") in stack for stack in samples))
+
+    def test_stop_without_start(self):
+        profiler = SamplingProfiler()
+        self.assertEqual(profiler.stop(), Counter())
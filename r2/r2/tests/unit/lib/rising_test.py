@@ -0,0 +1,119 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib import bucketed_set, rising
+from r2.lib.bucketed_set import BucketedSet
+from r2.tests import DictCache
+
+
+class FakeLink(object):
+    def __init__(self, fullname, ups, sr_id):
+        self._fullname = fullname
+        self._ups = ups
+        self.sr_id = sr_id
+
+
+class RisingTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.links = {}
+        self.fetched = []
+        self.now = 6000.
+
+        def by_fullname(names, **kw):
+            self.fetched.append(sorted(names))
+            return {name: self.links[name] for name in names}
+
+        g = MagicMock(gencache=self.cache, rising_links_per_subreddit=2)
+        changed_links = BucketedSet(
+            "rising:changed:", rising.CHANGED_BUCKET_SECONDS,
+            rising.CHANGED_BUCKETS, num_shards=rising.CHANGED_SHARDS)
+        patches = [
+            patch.object(rising, "g", g),
+            patch.object(bucketed_set, "g", g),
+            patch.object(rising, "changed_links", changed_links),
+            patch.object(rising.count, "get_link_counts",
+                         lambda: {name: (1, link.sr_id)
+                                  for name, link in self.links.iteritems()}),
+            patch.object(rising.Link, "_by_fullname", side_effect=by_fullname),
+            patch.object(bucketed_set.time, "time", lambda: self.now),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def add_link(self, fullname, ups, sr_id):
+        self.links[fullname] = FakeLink(fullname, ups, sr_id)
+        rising.mark_changed(self.links[fullname])
+
+    def test_fetches_only_changed_links(self):
+        self.add_link("t3_a", 5, 1)
+        self.add_link("t3_b", 1, 1)
+        rising.set_rising()
+        self.assertEqual(self.fetched, [["t3_a", "t3_b"]])
+
+        self.now += 120
+        self.add_link("t3_c", 3, 2)
+        self.links["t3_b"]._ups = 8
+        rising.mark_changed(self.links["t3_b"])
+        del self.links["t3_a"]
+        rising.set_rising()
+
+        self.assertEqual(self.fetched[-1], ["t3_b", "t3_c"])
+        self.assertEqual(rising.get_all_rising(),
+                         [("t3_b", 8., 1), ("t3_c", 3., 2)])
+
+    def test_full_fetch_when_too_far_behind(self):
+        self.add_link("t3_a", 5, 1)
+        rising.set_rising()
+
+        self.now += rising.CHANGED_BUCKETS * rising.CHANGED_BUCKET_SECONDS
+        rising.set_rising()
+        self.assertEqual(self.fetched, [["t3_a"], ["t3_a"]])
+
+    def test_full_fetch_when_changes_incomplete(self):
+        self.add_link("t3_a", 5, 1)
+        rising.set_rising()
+
+        self.now += 60
+        with patch.object(self.cache, "append", return_value=False):
+            self.add_link("t3_b", 3, 1)
+        rising.set_rising()
+        self.assertEqual(self.fetched, [["t3_a"], ["t3_a", "t3_b"]])
+
+    def test_normalized_rising(self):
+        for name, ups, sr_id in (("t3_a", 10, 1), ("t3_b", 5, 1),
+                                 ("t3_c", 4, 1), ("t3_d", 6, 2),
+                                 ("t3_e", 2, 3)):
+            self.add_link(name, ups, sr_id)
+        rising.set_rising()
+
+        self.assertEqual(rising.normalized_rising([1, 2]),
+                         ["t3_a", "t3_d", "t3_b"])
+
+        del self.links["t3_e"]
+        rising.set_rising()
+        self.assertEqual(rising.normalized_rising([3]), [])
@@ -0,0 +1,137 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import threading
+import unittest
+
+from mock import patch, MagicMock
+
+from r2.lib.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        p = patch("r2.lib.singleflight.g")
+        self.g = p.start()
+        self.addCleanup(p.stop)
+        self.flight = SingleFlight("test")
+
+        # set once a caller has started waiting on another's call
+        self.coalesced = threading.Event()
+        count = self.flight._count
+
+        def _count(executed=0, coalesced=0):
+            count(executed=executed, coalesced=coalesced)
+            if coalesced:
+                self.coalesced.set()
+        self.flight._count = _count
+
+    def start_leader(self, fn):
+        """Run fn as the leader for key "a" in another thread.
+
+        Returns a function that lets the leader finish and waits for it.
+
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocking_fn():
+            started.set()
+            release.wait()
+            return fn()
+
+        thread = threading.Thread(
+            target=lambda: self.flight.do("a", blocking_fn))
+        thread.start()
+        started.wait()
+
+        def finish():
+            release.set()
+            thread.join()
+        return finish
+
+    def test_do(self):
+        fn = MagicMock(return_value=3)
+        self.assertEquals(self.flight.do("a", fn, 1, b=2), 3)
+        fn.assert_called_once_with(1, b=2)
+        self.assertEquals(self.flight.calls, {})
+
+    def test_concurrent_calls_coalesce(self):
+        finish = self.start_leader(lambda: [1, 2])
+        results = []
+        follower = threading.Thread(
+            target=lambda: results.append(self.flight.do("a", MagicMock())))
+        follower.start()
+        self.coalesced.wait()
+        finish()
+        follower.join()
+        self.assertEquals(results, [[1, 2]])
+
+        counter = self.g.stats.get_counter.return_value
+        counter.increment.assert_any_call("executed", delta=1)
+        counter.increment.assert_any_call("coalesced", delta=1)
+
+    def test_errors_propagate_to_waiters(self):
+        def fail():
+            raise ValueError
+
+        finish = self.start_leader(fail)
+        errors = []
+
+        def follow():
+            try:
+                self.flight.do("a", MagicMock())
+            except ValueError as e:
+                errors.append(e)
+
+        follower = threading.Thread(target=follow)
+        follower.start()
+        self.coalesced.wait()
+        finish()
+        follower.join()
+        self.assertEquals(len(errors), 1)
+
+    def test_recursive_call_does_not_deadlock(self):
+        def outer():
+            return self.flight.do("a", lambda: 1) + 1
+        self.assertEquals(self.flight.do("a", outer), 2)
+
+    def test_do_multi(self):
+        fn = MagicMock(return_value={1: "one", 3: "three"})
+        ret = self.flight.do_multi([1, 2, 3], fn)
+        fn.assert_called_once_with([1, 2, 3])
+        self.assertEquals(ret, {1: "one", 3: "three"})
+
+    def test_do_multi_waits_for_keys_in_flight(self):
+        finish = self.start_leader(lambda: "from leader")
+        fn = MagicMock(return_value={"b": "from follower"})
+        results = []
+        follower = threading.Thread(
+            target=lambda: results.append(self.flight.do_multi(["a", "b"], fn)))
+        follower.start()
+        self.coalesced.wait()
+        finish()
+        follower.join()
+        fn.assert_called_once_with(["b"])
+        self.assertEquals(results,
+                          [{"a": "from leader", "b": "from follower"}])
@@ -493,6 +493,32 @@ class TestTruncString(RedditTestCase):
         self.assertEqual(truncated, 'ThisIsA...')
 
 
+class TestMergeSorted(RedditTestCase):
+    def test_merge(self):
+        merged = utils.merge_sorted([[1, 4, 7], [2, 5], [3, 6, 8, 9]])
+        self.assertEqual(list(merged), range(1, 10))
+
+    def test_empty(self):
+        self.assertEqual(list(utils.merge_sorted([])), [])
+        self.assertEqual(list(utils.merge_sorted([[], [1], []])), [1])
+
+    def test_cmp_is_stable(self):
+        a = [(3, "a"), (1, "a")]
+        b = [(3, "b"), (2, "b"), (1, "b")]
+        descending = lambda x, y: cmp(y[0], x[0])
+        merged = list(utils.merge_sorted([a, b], cmp=descending))
+        self.assertEqual(merged, sorted(a + b, cmp=descending))
+
+    def test_lazy(self):
+        def numbers():
+            yield 1
+            yield 2
+            raise AssertionError("read too far")
+
+        merged = utils.merge_sorted([numbers(), [3]])
+        self.assertEqual(next(merged), 1)
+
+
 class TestOutboundLinks(RedditTestCase):
     def setUp(self):
         from r2.models import Link
@@ -0,0 +1,210 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+from mock import MagicMock, patch
+
+from r2.lib import wrapped
+from r2.lib.wrapped import (
+    CachedVariable,
+    CacheStub,
+    StringTemplate,
+    Templated,
+    _StubSplicer,
+)
+from r2.tests import RedditTestCase
+
+
+def stub(name):
+    return StringTemplate.start_delim + name + StringTemplate.end_delim
+
+
+def template(text, **kw):
+    return (text.replace("{", StringTemplate.start_delim)
+                .replace("}", StringTemplate.end_delim), kw)
+
+
+def iterative_render(rounds, res, kwargs):
+    """Splice the way Templated.render did before _StubSplicer.
+
+    `rounds` is a list of {stub name: (cache key, template, kw)}, one per
+    round of rendering. Return the output and the values to be cached.
+
+    """
+
+    updates = {}
+    for current in rounds:
+        replacements = {}
+        new_updates = {}
+        for key, (cache_key, r, kw) in current.iteritems():
+            replacements[key] = r.finalize(kw)
+            new_updates[key] = (cache_key, (r, kw))
+
+        for k in updates.keys():
+            cache_key, (value, kw) = updates[k]
+            value = value.update(replacements)
+            updates[k] = cache_key, (value, kw)
+
+        updates.update(new_updates)
+
+    to_cache = {k: v.template for k, (v, kw) in updates.values()}
+
+    if isinstance(res, CacheStub):
+        res = updates[res.name][1][0]
+
+    updates = {k: v.finalize(kw) for k, (_, (v, kw)) in updates.iteritems()}
+
+    while True:
+        r = res
+        res = res.update(kwargs).update(updates)
+        semi_final = res.finalize()
+        if r.finalize() == res.finalize():
+            res = semi_final
+            break
+
+    return res, to_cache
+
+
+def splicer_render(rounds, res, kwargs):
+    """Splice the way Templated.render does now."""
+    rendered = {}
+    for current in rounds:
+        rendered.update(current)
+
+    splicer = _StubSplicer(rendered, StringTemplate.pattern2)
+    to_cache = {cache_key: splicer.expansion(key)
+                for key, (cache_key, r, kw) in rendered.iteritems()}
+
+    if isinstance(res, CacheStub):
+        res = StringTemplate(splicer.expansion(res.name))
+
+    return splicer.splice(res.template, kwargs), to_cache
+
+
+class StubSplicerTest(RedditTestCase):
+    def make_rounds(self, *rounds):
+        made = []
+        for current in rounds:
+            made.append({
+                name: ("key_" + name, StringTemplate(text), kw)
+                for name, (text, kw) in current.iteritems()
+            })
+        return made
+
+    def assert_same_output(self, rounds, res, kwargs):
+        rounds = self.make_rounds(*rounds)
+        expected = iterative_render(rounds, res, kwargs)
+        self.assertEqual(splicer_render(rounds, res, kwargs), expected)
+        return expected
+
+    def test_nested(self):
+        output, to_cache = self.assert_same_output(
+            [
+                {"a": template(u"A[{b}] {title}", title=u"t\xeftle")},
+                {"b": template(u"B[{c}, {c}] {child}", child=u"kid")},
+                {"c": template(u"C")},
+            ],
+            StringTemplate(template(u"<{a}>{missing}")[0]),
+            {},
+        )
+        self.assertEqual(output, u"<A[B[C, C] kid] t\xeftle>" + stub("missing"))
+        # cached versions keep their own kw args as stubs
+        self.assertEqual(to_cache["key_a"], u"A[B[C, C] kid] " + stub("title"))
+
+    def test_kw_values_with_stubs(self):
+        output, to_cache = self.assert_same_output(
+            [
+                {
+                    "a": template(u"A[{child}]", child=stub("b")),
+                    "d": template(u"D"),
+                },
+                {"b": template(u"B[{x}]")},
+            ],
+            StringTemplate(template(u"{header} {a}")[0]),
+            {"header": u"H[%s]" % stub("d"), "x": u"from primary"},
+        )
+        self.assertEqual(output, u"H[D] A[B[from primary]]")
+
+    def test_none_kw_value(self):
+        self.assert_same_output(
+            [{"a": template(u"A[{child}]", child=None)}],
+            StringTemplate(template(u"{a}{b}")[0]),
+            {"b": None},
+        )
+
+    def test_cachable_primary(self):
+        output, to_cache = self.assert_same_output(
+            [
+                {"p": template(u"P[{a}] {own}", own=u"ignored")},
+                {"a": template(u"A[{x}]", x=u"x")},
+            ],
+            CachedVariable("p"),
+            {"own": u"own"},
+        )
+        self.assertEqual(output, u"P[A[x]] own")
+
+
+class DictCache(dict):
+    def set_multi(self, keys, time=0):
+        self.update(keys)
+
+    def get_multi(self, keys):
+        return {key: self[key] for key in keys if key in self}
+
+
+class RenderCacheTest(RedditTestCase):
+    def setUp(self):
+        super(RenderCacheTest, self).setUp()
+        self.cache = DictCache()
+        self.stats = MagicMock()
+        self.patch_g(rendercache=self.cache, stats=self.stats)
+
+    def test_round_trip(self):
+        templated = Templated()
+        values = {
+            "short": u"caf\xe9 " + stub("child"),
+            "long": u"\u2603" * wrapped.RENDERCACHE_COMPRESS_MIN_BYTES,
+        }
+        templated._write_cache(values)
+
+        stored = {val[:1] for val in self.cache.itervalues()}
+        self.assertEqual(stored, {"u", "z"})
+
+        read = templated._read_cache(values.keys() + ["missing"])
+        self.assertEqual({k: v.template for k, v in read.iteritems()}, values)
+
+    def test_bad_values_ignored(self):
+        templated = Templated()
+        templated._write_cache({"a": u"a", "b": u"b"})
+        self.cache[templated._cache_key("a")] = "zjunk"
+        self.cache[templated._cache_key("b")] = "xold format"
+
+        self.assertEqual(templated._read_cache(["a", "b"]), {})
+
+    def test_total_counts_sampled(self):
+        templated = Templated()
+        with patch.object(wrapped.random, "random", return_value=0.5):
+            templated._read_cache(["a"])
+        self.assertFalse(self.stats.simple_event.called)
+
+        with patch.object(wrapped.random, "random", return_value=0.):
+            templated._read_cache(["a"])
+        self.stats.simple_event.assert_any_call("render-cache.total.miss", 1)
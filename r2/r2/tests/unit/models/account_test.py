@@ -0,0 +1,208 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+import unittest
+
+from mock import MagicMock, patch
+
+from r2.lib.lock import TimeoutExpired
+from r2.models import account
+from r2.models.account import Account, AccountKarma
+from r2.tests import DictCache
+
+
+class AccountKarmaTest(unittest.TestCase):
+    def setUp(self):
+        self.account = Account(id=1)
+        self.karma = {}
+        self.autopatch(AccountKarma, "get", side_effect=self.get_karma)
+        self.incr = self.autopatch(AccountKarma, "incr")
+        self.incr_multi = self.autopatch(AccountKarma, "incr_multi")
+        self.del_props = self.autopatch(
+            Account, "_del_data_props", side_effect=self.del_data_props)
+        self.autopatch(Account, "get_read_modify_write_lock")
+        self.autopatch(Account, "update_from_cache")
+        self.commit = self.autopatch(Account, "_commit")
+
+    def autopatch(self, obj, attr, **kw):
+        p = patch.object(obj, attr, **kw)
+        self.addCleanup(p.stop)
+        return p.start()
+
+    def get_karma(self, account):
+        totals = {}
+        for (sr_name, kind), value in self.karma.iteritems():
+            totals[kind] = totals.get(kind, 0) + value
+        return self.karma, totals
+
+    def del_data_props(self, props):
+        return {prop: self.account._t.pop(prop) for prop in props}
+
+    def sr(self, name):
+        sr = MagicMock()
+        sr.name = name
+        return sr
+
+    def test_karma_reads_both_layouts(self):
+        self.karma = {("pics", "link"): 10, ("pics", "comment"): 3}
+        self.account._t.update(pics_self_karma=2, funny_comment_karma=5)
+
+        self.assertEqual(self.account.karma("link"), 12)
+        self.assertEqual(self.account.karma("comment"), 8)
+        self.assertEqual(self.account.karma("link", self.sr("pics")), 12)
+        self.assertEqual(self.account.karma("comment", self.sr("funny")), 5)
+
+        all_karmas = self.account.all_karmas(include_old=False)
+        self.assertEqual(all_karmas.keys(), ["pics", "funny"])
+        self.assertEqual(all_karmas["pics"], (12, 3))
+        self.assertEqual(all_karmas["funny"], (0, 5))
+
+    def test_incr_karma_migrates_legacy_props(self):
+        self.account._t.update(pics_link_karma=10, my_sr_comment_karma=4)
+
+        self.account.incr_karma("link", self.sr("pics"), 1)
+
+        self.incr_multi.assert_called_once_with(
+            self.account, {("pics", "link"): 10, ("my_sr", "comment"): 4})
+        self.assertFalse("pics_link_karma" in self.account._t)
+        self.assertFalse("my_sr_comment_karma" in self.account._t)
+        self.assertTrue(self.account.karma_migrated)
+        self.assertTrue(self.commit.called)
+
+    def test_migrate_karma_increments_before_removing(self):
+        self.account._t.update(pics_link_karma=10)
+        self.incr_multi.side_effect = Exception
+
+        with self.assertRaises(Exception):
+            self.account.migrate_karma()
+
+        self.assertEqual(self.account._t["pics_link_karma"], 10)
+        self.assertFalse(self.account.karma_migrated)
+        self.assertFalse(self.del_props.called)
+
+    def test_migrate_karma_after_marked(self):
+        # died after marking the account but before removing the props
+        self.karma = {("pics", "link"): 10}
+        self.account._t.update(pics_link_karma=10, karma_migrated=True)
+        self.assertEqual(self.account.karma("link"), 10)
+
+        self.account.migrate_karma()
+
+        self.assertFalse(self.incr_multi.called)
+        self.assertFalse("pics_link_karma" in self.account._t)
+        self.assertEqual(self.account.karma("link"), 10)
+
+    def test_incr_karma_existing_sr(self):
+        self.karma = {("pics", "link"): 10}
+
+        self.account.incr_karma("link", self.sr("pics"), -1)
+
+        self.incr.assert_called_once_with(self.account, "pics", "link", -1)
+        self.assertFalse(self.del_props.called)
+
+    def test_incr_karma_new_sr_starts_from_default(self):
+        self.karma = {("pics", "link"): 10}
+
+        with patch("r2.models.account.g") as g:
+            g.MIN_UP_KARMA = 1
+            self.account.incr_karma("link", self.sr("funny"), 1)
+
+        self.incr.assert_called_once_with(self.account, "funny", "link", 2)
+
+    def test_disable_karma(self):
+        self.account.disable_karma = True
+
+        self.account.incr_karma("link", self.sr("pics"), 1)
+
+        self.assertFalse(self.incr.called)
+
+
+class AccountKarmaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.account = Account(id=1)
+        self.cache = DictCache()
+        self.counters = {"pics_link": 10, "pics_comment": 3}
+        self.lock = MagicMock()
+
+        self.autopatch(account, "g", new=MagicMock(
+            gencache=self.cache, make_lock=self.lock))
+        self.cf = self.autopatch(AccountKarma, "_cf")
+        self.cf.xget.side_effect = lambda key: self.counters.items()
+        self.autopatch(AccountKarma, "_incr_multi",
+                       side_effect=self.incr_multi)
+
+    def autopatch(self, obj, attr, **kw):
+        p = patch.object(obj, attr, **kw)
+        self.addCleanup(p.stop)
+        return p.start()
+
+    def incr_multi(self, key, data):
+        for column, amt in data.iteritems():
+            self.counters[column] = self.counters.get(column, 0) + amt
+
+    def test_get_fills_cache(self):
+        karma = ({("pics", "link"): 10, ("pics", "comment"): 3},
+                 {"link": 10, "comment": 3})
+        self.assertEqual(AccountKarma.get(self.account), karma)
+        self.assertEqual(AccountKarma.get(self.account), karma)
+        self.assertEqual(self.cf.xget.call_count, 1)
+
+    def test_incr_updates_cache(self):
+        AccountKarma.get(self.account)
+
+        AccountKarma.incr(self.account, "pics", "link", 2)
+        AccountKarma.incr_multi(
+            self.account, {("pics", "link"): -1, ("funny", "comment"): 5})
+
+        karma = ({("pics", "link"): 11, ("pics", "comment"): 3,
+                  ("funny", "comment"): 5},
+                 {"link": 11, "comment": 8})
+        self.assertEqual(AccountKarma.get(self.account), karma)
+        self.assertEqual(self.cf.xget.call_count, 1)
+        self.assertEqual(AccountKarma._get_from_db(self.account), karma)
+
+    def test_incr_without_cache(self):
+        AccountKarma.incr(self.account, "pics", "link", 2)
+        self.assertEqual(dict(self.cache), {})
+        self.assertEqual(AccountKarma.get(self.account)[1]["link"], 12)
+
+    def test_get_multi(self):
+        other = Account(id=2)
+        AccountKarma.get(self.account)
+        self.cf.xget.reset_mock()
+
+        karmas = AccountKarma.get_multi([self.account, other])
+
+        self.assertEqual(karmas[1], AccountKarma.get(self.account))
+        self.assertEqual(karmas[2], AccountKarma.get(other))
+        self.cf.xget.assert_called_once_with(other._id36)
+
+    def test_lock_timeout(self):
+        AccountKarma.get(self.account)
+        self.lock.side_effect = TimeoutExpired
+
+        AccountKarma.incr(self.account, "pics", "link", 2)
+        self.assertEqual(self.counters["pics_link"], 12)
+        self.assertEqual(dict(self.cache), {})
+
+        self.assertEqual(AccountKarma.get(self.account)[1]["link"], 12)
+        self.assertEqual(dict(self.cache), {})
@@ -0,0 +1,259 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+from mock import MagicMock, patch
+from pylons import app_globals as g, tmpl_context as c
+
+from r2.controllers.listingcontroller import NewController, UserController
+from r2.lib.db import queries
+from r2.models import Account, Subreddit
+from r2.models.builder import IDBuilder, WrapContext
+from r2.tests import RedditTestCase
+
+
+class FakeThing(object):
+    def __init__(self, name, keep=True, keep_unwrapped=True):
+        self._fullname = name
+        self.keep = keep
+        self.unwrapped = keep_unwrapped
+        self.promoted = None
+
+    def keep_unwrapped(self):
+        return self.unwrapped
+
+    def keep_item(self, item):
+        return self.keep
+
+
+class FakeCachedResults(list):
+    iden = "fakeiden"
+
+
+class FakeLazyListing(object):
+    lazy_listing = True
+
+    def __init__(self, names):
+        self.names = names
+        self.consumed = 0
+
+    def __iter__(self):
+        for name in self.names:
+            self.consumed += 1
+            yield name
+
+
+class AdaptiveBuilderTest(RedditTestCase):
+    def setUp(self):
+        super(AdaptiveBuilderTest, self).setUp()
+        self.cache = {}
+        self.autopatch(c, "user_is_loggedin", False, create=True)
+        self.autopatch(g, "gencache", MagicMock(
+            get=lambda key, **kw: self.cache.get(key),
+            set=lambda key, val, **kw: self.cache.__setitem__(key, val),
+        ))
+        self.autopatch(g, "stats", MagicMock())
+
+        self.things = {}
+        self.lookups = []
+        self.autopatch(IDBuilder, "thing_lookup", side_effect=self.lookup)
+
+    def lookup(self, names):
+        self.lookups.append(len(names))
+        return [self.things[name] for name in names]
+
+    def make_builder(self, things, **kw):
+        names = FakeCachedResults()
+        for thing in things:
+            self.things[thing._fullname] = thing
+            names.append(thing._fullname)
+        return IDBuilder(names, skip=True, num=10, wrap=None, **kw)
+
+    def test_remembers_keep_ratio(self):
+        # only one in four are kept
+        things = [FakeThing("t3_%d" % i, keep=(i % 4 == 0))
+                  for i in xrange(200)]
+
+        items = self.make_builder(things).get_items()[0]
+        self.assertEqual(len(items), 10)
+        self.assertTrue(len(self.lookups) > 1)
+
+        # the next build over-fetches enough to fill the page in one round
+        self.lookups = []
+        items = self.make_builder(things).get_items()[0]
+        self.assertEqual(len(items), 10)
+        self.assertEqual(len(self.lookups), 1)
+
+    def test_skips_before_wrapping(self):
+        things = [FakeThing("t3_%d" % i, keep_unwrapped=(i % 2 == 0))
+                  for i in xrange(40)]
+        b = self.make_builder(things)
+        b.convert_items = MagicMock(side_effect=lambda items: list(items))
+
+        items = b.get_items()[0]
+        self.assertEqual([item._fullname for item in items],
+                         ["t3_%d" % i for i in xrange(0, 20, 2)])
+        for call in b.convert_items.call_args_list:
+            self.assertTrue(all(item.unwrapped for item in call[0][0]))
+
+    def test_skips_before_wrapping_with_controller_keep_fn(self):
+        things = [FakeThing("t3_%d" % i, keep_unwrapped=(i % 2 == 0))
+                  for i in xrange(40)]
+        controller = NewController.__new__(NewController)
+        b = self.make_builder(things, keep_fn=controller.keep_fn(),
+                              prefilter=controller.prefilter)
+        b.convert_items = MagicMock(side_effect=lambda items: list(items))
+
+        items = b.get_items()[0]
+        self.assertEqual([item._fullname for item in items],
+                         ["t3_%d" % i for i in xrange(0, 20, 2)])
+        for call in b.convert_items.call_args_list:
+            self.assertTrue(all(item.unwrapped for item in call[0][0]))
+
+    def test_no_prefilter(self):
+        things = [FakeThing("t3_%d" % i, keep_unwrapped=False)
+                  for i in xrange(5)]
+        b = self.make_builder(things, keep_fn=lambda item: True,
+                              prefilter=UserController.prefilter)
+        b.convert_items = MagicMock(side_effect=lambda items: list(items))
+
+        self.assertEqual(len(b.get_items()[0]), 5)
+
+    def test_fetch_size(self):
+        b = self.make_builder([])
+        self.assertEqual(b.fetch_size(10), 15)
+
+        b.keep_ratio = 0.5
+        self.assertEqual(b.fetch_size(10), 30)
+
+        b.keep_ratio = 0.
+        self.assertEqual(b.fetch_size(10), 75)
+
+
+class LazyIDBuilderTest(RedditTestCase):
+    def setUp(self):
+        super(LazyIDBuilderTest, self).setUp()
+        self.autopatch(c, "user_is_loggedin", False, create=True)
+        self.autopatch(g, "stats", MagicMock())
+
+        self.things = {"t3_%d" % i: FakeThing("t3_%d" % i)
+                       for i in xrange(100)}
+        self.autopatch(IDBuilder, "thing_lookup", side_effect=(
+            lambda names: [self.things[name] for name in names]))
+        self.listing = FakeLazyListing(["t3_%d" % i for i in xrange(100)])
+
+    def get_names(self, **kw):
+        b = IDBuilder(self.listing, num=10, wrap=None, **kw)
+        return [item._fullname for item in b.get_items()[0]]
+
+    def test_consumes_only_the_page(self):
+        self.assertEqual(self.get_names(),
+                         ["t3_%d" % i for i in xrange(10)])
+        self.assertLess(self.listing.consumed, 20)
+
+    def test_after(self):
+        after = self.things["t3_40"]
+        self.assertEqual(self.get_names(after=after),
+                         ["t3_%d" % i for i in xrange(41, 51)])
+        self.assertLess(self.listing.consumed, 61)
+
+    def test_after_missing(self):
+        self.assertEqual(self.get_names(after=FakeThing("t3_zzz")), [])
+
+    def test_reverse_reads_everything(self):
+        after = self.things["t3_40"]
+        self.assertEqual(self.get_names(after=after, reverse=True),
+                         ["t3_%d" % i for i in xrange(30, 40)])
+        self.assertEqual(self.listing.consumed, 100)
+
+
+class FakeLink(object):
+    def __init__(self, _id, author_id, sr_id):
+        self._fullname = "t3_%d" % _id
+        self.author_id = author_id
+        self.sr_id = sr_id
+
+
+class WrapContextTest(RedditTestCase):
+    def setUp(self):
+        super(WrapContextTest, self).setUp()
+        self.user = MagicMock(name="user", gold=False)
+        self.autopatch(c, "user", self.user, create=True)
+        self.autopatch(c, "user_is_loggedin", True, create=True)
+        self.autopatch(c, "wrap_contexts", None, create=True)
+        self.patch_g(running_as_script=False)
+
+        self.accounts = self.autopatch(Account, "_byID", side_effect=(
+            lambda ids, **kw: {_id: MagicMock(_id=_id) for _id in ids}))
+        self.load_subreddits = self.autopatch(
+            Subreddit, "load_subreddits", side_effect=(
+                lambda items, **kw: {item.sr_id: MagicMock() for item in items}))
+        self.get_likes = self.autopatch(queries, "get_likes", side_effect=(
+            lambda user, items: {(user, item): True for item in items}))
+
+    def test_shared_across_builders(self):
+        first = [FakeLink(1, 10, 100), FakeLink(2, 11, 100)]
+        second = [FakeLink(2, 11, 100), FakeLink(3, 12, 101)]
+
+        context = WrapContext.current(stale=True)
+        context.load(first)
+        self.assertIs(WrapContext.current(stale=True), context)
+
+        context.load(second)
+
+        self.assertEqual(
+            [set(call[0][0]) for call in self.accounts.call_args_list],
+            [{10, 11}, {12}],
+        )
+        self.assertEqual(
+            [[item.sr_id for item in call[0][0]]
+             for call in self.load_subreddits.call_args_list],
+            [[100, 100], [101]],
+        )
+        self.assertEqual(
+            [sorted(item._fullname for item in call[0][1])
+             for call in self.get_likes.call_args_list],
+            [["t3_1", "t3_2"], ["t3_3"]],
+        )
+        self.assertEqual(sorted(context.likes), ["t3_1", "t3_2", "t3_3"])
+        self.assertEqual(context.can_ban_sr_ids, {100, 101})
+
+    def test_separate_for_staleness(self):
+        self.assertIsNot(WrapContext.current(stale=True),
+                         WrapContext.current(stale=False))
+
+    def test_separate_for_users(self):
+        context = WrapContext.current(stale=True)
+        self.assertIs(context.user, self.user)
+
+        other = MagicMock(name="other", gold=False)
+        with patch.object(c, "user", other):
+            other_context = WrapContext.current(stale=True)
+        self.assertIsNot(other_context, context)
+        self.assertIs(other_context.user, other)
+
+        self.assertIs(WrapContext.current(stale=True), context)
+
+    def test_not_shared_in_scripts(self):
+        self.patch_g(running_as_script=True)
+        self.assertIsNot(WrapContext.current(stale=True),
+                         WrapContext.current(stale=True))
+        self.assertIsNone(c.wrap_contexts)
@@ -0,0 +1,200 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+from _pylibmc import NotFound as CacheKeyNotFound
+from mock import MagicMock
+
+from r2.lib.utils import to36
+from r2.models.comment_tree import (
+    CommentTreeDeltaPermacache,
+    CommentTreeDeltas,
+    CommentTreePermacache,
+)
+from r2.tests import RedditTestCase
+
+
+class FakePermacache(dict):
+    def set(self, key, val):
+        self[key] = val
+
+
+def make_comment(comment_id, parent_id=None):
+    comment = MagicMock()
+    comment._id = comment_id
+    comment._id36 = to36(comment_id)
+    comment.parent_id = parent_id
+    return comment
+
+
+class CommentTreeDeltasTest(RedditTestCase):
+    def setUp(self):
+        super(CommentTreeDeltasTest, self).setUp()
+        self.link = MagicMock(_id36="1")
+        self.cf = self.autopatch(CommentTreeDeltas, "_cf")
+
+    def test_get_parents(self):
+        self.cf.xget.return_value = iter([("b", "a"), ("c", "")])
+
+        self.assertEqual(CommentTreeDeltas.get_parents(self.link),
+                         {11: 10, 12: None})
+
+    def test_incr_count_counts_row_once(self):
+        self.cf.get_count.return_value = 3
+        cache = MagicMock()
+        cache.incr.side_effect = [CacheKeyNotFound(), 5]
+        self.patch_g(gencache=cache)
+
+        self.assertEqual(CommentTreeDeltas.incr_count(self.link, 2), (0, 3))
+        cache.add.assert_called_once_with(
+            CommentTreeDeltas._count_key(self.link), 3)
+        self.assertEqual(CommentTreeDeltas.incr_count(self.link, 2), (3, 5))
+        self.assertEqual(self.cf.get_count.call_count, 1)
+
+
+class CommentTreeDeltaPermacacheTest(RedditTestCase):
+    def setUp(self):
+        super(CommentTreeDeltaPermacacheTest, self).setUp()
+        self.link = MagicMock(_id=1, _id36="1")
+        self.permacache = FakePermacache()
+        self.patch_g(permacache=self.permacache)
+        self.autopatch(CommentTreePermacache, "_mutation_context")
+
+        # keep the deltas row and its count in memory
+        self.deltas = {}
+        self.count = 0
+        self.autopatch(CommentTreeDeltas, "add_comments",
+                       side_effect=self.add_deltas)
+        self.autopatch(CommentTreeDeltas, "get_parents",
+                       side_effect=lambda link: dict(self.deltas))
+        self.autopatch(CommentTreeDeltas, "remove_comments",
+                       side_effect=self.remove_deltas)
+        self.autopatch(CommentTreeDeltas, "incr_count",
+                       side_effect=self.incr_count)
+        self.autopatch(CommentTreeDeltas, "reset_count",
+                       side_effect=self.reset_count)
+
+    def add_deltas(self, link, comments):
+        for comment in comments:
+            self.deltas[comment._id] = comment.parent_id
+
+    def remove_deltas(self, link, comment_ids):
+        for comment_id in comment_ids:
+            self.deltas.pop(comment_id, None)
+
+    def incr_count(self, link, delta):
+        self.count += delta
+        return self.count - delta, self.count
+
+    def reset_count(self, link):
+        self.count = len(self.deltas)
+
+    def snapshot(self):
+        return self.permacache.get(
+            CommentTreePermacache._permacache_key(self.link), {})
+
+    def test_load_tree_merges_deltas(self):
+        self.permacache.set(CommentTreePermacache._permacache_key(self.link),
+                            {None: [1], 1: [2]})
+        self.deltas = {2: 1, 3: 1, 4: None}
+
+        tree = CommentTreeDeltaPermacache._load_tree(self.link)
+
+        self.assertEqual(tree, {None: [1, 4], 1: [2, 3]})
+
+    def test_add_comments_writes_deltas_only(self):
+        CommentTreeDeltaPermacache.add_comments(
+            self.link, [make_comment(1), make_comment(2, 1)])
+
+        self.assertEqual(self.deltas, {1: None, 2: 1})
+        self.assertEqual(self.snapshot(), {})
+
+    def test_compaction(self):
+        self.autopatch(CommentTreeDeltaPermacache, "COMPACTION_THRESHOLD", 3)
+
+        CommentTreeDeltaPermacache.add_comments(
+            self.link, [make_comment(1), make_comment(2, 1)])
+        self.assertEqual(self.snapshot(), {})
+
+        CommentTreeDeltaPermacache.add_comments(
+            self.link, [make_comment(3), make_comment(4, 2)])
+        self.assertEqual(self.snapshot(), {None: [1, 3], 1: [2], 2: [4]})
+        self.assertEqual(self.deltas, {})
+        self.assertEqual(self.count, 0)
+
+    def test_compaction_only_by_writer_crossing_threshold(self):
+        self.autopatch(CommentTreeDeltaPermacache, "COMPACTION_THRESHOLD", 2)
+        compact = self.autopatch(CommentTreeDeltaPermacache, "compact")
+
+        for comment_id in xrange(1, 5):
+            CommentTreeDeltaPermacache.add_comments(
+                self.link, [make_comment(comment_id)])
+
+        self.assertEqual(compact.call_count, 1)
+
+    def test_round_trip(self):
+        self.autopatch(CommentTreeDeltaPermacache, "COMPACTION_THRESHOLD", 4)
+        comments = [
+            make_comment(1),
+            make_comment(2, 1),
+            make_comment(3),
+            make_comment(4, 2),
+            make_comment(5, 1),
+            make_comment(6, 3),
+            make_comment(7),
+        ]
+
+        for comment in comments:
+            CommentTreeDeltaPermacache.add_comments(self.link, [comment])
+        # a duplicate delivery doesn't add the comment twice
+        CommentTreeDeltaPermacache.add_comments(self.link, [comments[-1]])
+        tree = CommentTreeDeltaPermacache._load_tree(self.link)
+
+        CommentTreePermacache.rebuild(self.link, comments)
+        self.assertEqual(tree, self.snapshot())
+
+    def test_rebuild_keeps_newer_deltas(self):
+        self.deltas = {1: None, 2: 1, 5: None}
+
+        CommentTreeDeltaPermacache.rebuild(
+            self.link, [make_comment(1), make_comment(2, 1)])
+
+        self.assertEqual(self.snapshot(), {None: [1], 1: [2]})
+        self.assertEqual(self.deltas, {5: None})
+        self.assertEqual(
+            CommentTreeDeltaPermacache._load_tree(self.link),
+            {None: [1, 5], 1: [2]})
+
+    def test_writes_change_version(self):
+        get_version = CommentTreeDeltaPermacache.get_version
+        versions = [get_version(self.link)]
+        self.assertEqual(get_version(self.link), versions[-1])
+
+        CommentTreeDeltaPermacache.add_comments(self.link, [make_comment(1)])
+        versions.append(get_version(self.link))
+
+        CommentTreeDeltaPermacache.compact(self.link)
+        versions.append(get_version(self.link))
+
+        CommentTreeDeltaPermacache.rebuild(self.link, [make_comment(1)])
+        versions.append(get_version(self.link))
+
+        self.assertEqual(len(set(versions)), len(versions))
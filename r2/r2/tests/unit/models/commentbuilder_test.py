@@ -22,14 +22,17 @@
 ###############################################################################
 
 from collections import namedtuple, defaultdict
+import sys
+
 from mock import MagicMock
 
+from r2.lib.cache import LRUCache
 from r2.lib.utils.comment_tree_utils import get_tree_details, calc_num_children
 from r2.lib.db import operators
 from r2.models import builder
 from r2.models import Comment
 from r2.models.builder import CommentBuilder
-from r2.models.comment_tree import CommentTree
+from r2.models.comment_tree import CommentTree, CommentTreeIndex
 from r2.tests import RedditTestCase
 
 
@@ -337,3 +340,71 @@ class CommentOrderTest(RedditTestCase):
             [100, 102, 104, 105, 106, 103, 107, 108, 109])
         self.assertEqual(builder.missing_root_comments, set())
         self.assertEqual(builder.missing_root_count, 0)
+
+
+class CommentTreeIndexTest(RedditTestCase):
+    def setUp(self):
+        self.comment_tree = make_comment_tree(None)
+        self.index = CommentTreeIndex(self.comment_tree.tree)
+
+    def test_matches_tree_details(self):
+        comment_tree = self.comment_tree
+        self.assertEqual(sorted(self.index), sorted(comment_tree.cids))
+        for comment_id in comment_tree.cids:
+            self.assertEqual(self.index.depth(comment_id),
+                             comment_tree.depth[comment_id])
+            self.assertEqual(self.index.parent(comment_id),
+                             comment_tree.parents[comment_id])
+            self.assertEqual(self.index.num_children(comment_id),
+                             comment_tree.num_children[comment_id])
+
+    def test_subtrees_are_contiguous(self):
+        position = self.index.position(102)
+        size = self.index.sizes[position]
+        self.assertEqual(list(self.index.ids[position:position + size]),
+                         [102, 104, 105, 106])
+        self.assertTrue(self.index.is_descendant(105, 100))
+        self.assertFalse(self.index.is_descendant(110, 100))
+        self.assertFalse(self.index.is_descendant(100, 100))
+
+    def test_missing_comment(self):
+        self.assertFalse(999 in self.index)
+        self.assertRaises(KeyError, self.index.position, 999)
+        self.assertRaises(KeyError, self.index.path, 999, 8)
+
+    def test_path(self):
+        self.assertEqual(self.index.path(104, 8), [100, 102, 104])
+        self.assertEqual(self.index.path(104, 1), [102, 104])
+        self.assertEqual(self.index.path(100, 8), [100])
+
+    def test_missing_parent(self):
+        tree = {None: [1], 1: [2], 5: [6], 6: [7]}
+        index = CommentTreeIndex(tree)
+        self.assertEqual(index.depth(7), 1)
+        self.assertEqual(index.parent(6), 5)
+        self.assertEqual(index.num_children(6), 1)
+        self.assertEqual(index.path(7, 1), [6, 7])
+        self.assertRaises(KeyError, index.path, 7, 2)
+
+    def test_for_link_cached_by_version(self):
+        cache = {}
+        self.patch_g(comment_tree_index_cache=MagicMock(
+            get=cache.get, set=cache.__setitem__))
+        link = MagicMock(_id=1)
+
+        index = CommentTreeIndex.for_link(link, self.comment_tree.tree, "a")
+        self.assertIs(CommentTreeIndex.for_link(link, {}, "a"), index)
+
+        # a tree with the same shape but a new version is indexed again
+        index = CommentTreeIndex.for_link(link, {None: [1, 2]}, "b")
+        self.assertEqual(list(index), [1, 2])
+        index = CommentTreeIndex.for_link(link, {None: [2, 1]}, "c")
+        self.assertEqual(list(index), [2, 1])
+
+    def test_for_link_not_pickled(self):
+        self.patch_g(comment_tree_index_cache=LRUCache(pickle_values=False))
+        link = MagicMock(_id=1)
+
+        index = CommentTreeIndex.for_link(link, self.comment_tree.tree, "a")
+        self.assertIs(CommentTreeIndex.for_link(link, {}, "a"), index)
+        self.assertTrue(sys.getsizeof(index) > index.ids.itemsize * len(index))
@@ -29,6 +29,7 @@ from r2.lib.db.thing import (
     NotFound,
     tdb,
     Thing,
+    ThingPrefetcher,
 )
 from r2.lib.lock import TimeoutExpired
 from r2.tests import RedditTestCase
@@ -199,6 +200,68 @@ class TestThingReadCaching(RedditTestCase):
         self.assertEqual(ret, "one")
 
 
+class OtherThing(Thing):
+    _nodb = True
+    _type_name = "otherthing"
+    _type_id = 101
+    _cache = SimpleThing._cache
+
+
+class TestThingPrefetcher(RedditTestCase):
+    def setUp(self):
+        SimpleThing._cache.reset_mock()
+        self.simple_get_multi = SimpleThing._cache.simple_get_multi
+        self.get_things_from_db = self.autopatch(Thing, "get_things_from_db")
+        self.write_things_to_cache = self.autopatch(
+            Thing, "write_things_to_cache")
+
+    def test_one_get_multi(self):
+        self.simple_get_multi.return_value = {
+            "SimpleThing_1": "simple one",
+            "OtherThing_2": "other two",
+        }
+        self.get_things_from_db.return_value = {3: "other three"}
+
+        prefetcher = ThingPrefetcher()
+        prefetcher.want(SimpleThing, [1])
+        prefetcher.want(OtherThing, [2, 3, None])
+        prefetcher.load()
+
+        self.assertEqual(self.simple_get_multi.call_count, 1)
+        keys = self.simple_get_multi.call_args[0][0]
+        self.assertEqual(
+            set(keys), {"SimpleThing_1", "OtherThing_2", "OtherThing_3"})
+        self.get_things_from_db.assert_called_once_with([3])
+
+        with prefetcher:
+            self.assertEqual(SimpleThing._byID(1), "simple one")
+            self.assertEqual(OtherThing._byID([2, 3]),
+                             {2: "other two", 3: "other three"})
+        self.assertEqual(self.simple_get_multi.call_count, 1)
+
+    def test_pending_loaded_with_lookup(self):
+        self.simple_get_multi.return_value = {
+            "SimpleThing_1": "simple one",
+            "OtherThing_2": "other two",
+        }
+
+        with ThingPrefetcher() as prefetcher:
+            prefetcher.want(OtherThing, [2])
+            self.assertEqual(SimpleThing._byID(1), "simple one")
+            self.assertEqual(OtherThing._byID(2), "other two")
+
+        self.assertEqual(self.simple_get_multi.call_count, 1)
+
+    def test_stale(self):
+        SimpleThing._cache.get_multi.return_value = {1: "fresh one"}
+
+        with ThingPrefetcher(stale=True) as prefetcher:
+            prefetcher.want(SimpleThing, [1])
+            self.assertEqual(SimpleThing._byID(1, stale=False), "fresh one")
+
+        self.simple_get_multi.assert_not_called()
+
+
 class FakeLock(object):
     def __init__(self):
         self.have_lock = True
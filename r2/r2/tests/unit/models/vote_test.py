@@ -4,12 +4,19 @@ from datetime import datetime
 import pytz
 
 from r2.lib import hooks
+from r2.lib.bloom import BloomFilter
+from r2.lib.cache import MemcachedError
+from r2.lib.db import queries
 from r2.lib.utils import tup
-from r2.models.vote import Vote
-from r2.tests import RedditTestCase
+from r2.models import Comment, Link
+from r2.models.vote import Vote, VotedThingFilter, VotesByAccount
+from r2.tests import DictCache, RedditTestCase
 
 
 class NullHook(object):
+    def call(self, **kwargs):
+        return
+
     def call_until_return(self, **kwargs):
         return
 
@@ -64,3 +71,228 @@ class TestVoteValidator(RedditTestCase):
         self.assertTrue(vote.is_downvote)
         self.assertFalse(vote.is_self_vote)
         self.assert_vote_effects(vote, affected_thing_attr="_downs")
+
+
+class TestCommitBatch(RedditTestCase):
+    def setUp(self):
+        self.autopatch(hooks, "get_hook", return_value=NullHook())
+        self.write_vote = self.autopatch(VotesByAccount, "write_vote")
+        self.new_votes = self.autopatch(queries, "new_votes")
+        self.thing = MagicMock(name="thing")
+        self.thing._fullname = "t3_1"
+        self.thing.num_votes = 30
+        super(TestCommitBatch, self).setUp()
+
+    def make_vote(self, user, direction, previous_vote=None):
+        return Vote(
+            user=user,
+            thing=self.thing,
+            direction=direction,
+            date=datetime.now(pytz.UTC),
+            data={},
+            get_previous_vote=False,
+            previous_vote=previous_vote,
+        )
+
+    def test_adds_up_effects(self):
+        votes = [
+            self.make_vote(MagicMock(name="a"), Vote.DIRECTIONS.up),
+            self.make_vote(MagicMock(name="b"), Vote.DIRECTIONS.up),
+            self.make_vote(MagicMock(name="c"), Vote.DIRECTIONS.down),
+            self.make_vote(MagicMock(name="d"), Vote.DIRECTIONS.up),
+        ]
+        Vote.commit_batch(votes)
+
+        self.assertEqual(
+            sorted(call[0] for call in self.thing._incr.call_args_list),
+            [("_downs", 1), ("_ups", 3)],
+        )
+        self.thing.author_slow.incr_karma.assert_called_once_with(
+            kind=self.thing.affects_karma_type,
+            sr=self.thing.subreddit_slow,
+            amt=2,
+        )
+        self.assertEqual(self.write_vote.call_count, 4)
+        self.new_votes.assert_called_once_with(votes)
+
+    def test_write_failure(self):
+        votes = [
+            self.make_vote(MagicMock(name="a"), Vote.DIRECTIONS.up),
+            self.make_vote(MagicMock(name="b"), Vote.DIRECTIONS.up),
+            self.make_vote(MagicMock(name="c"), Vote.DIRECTIONS.down),
+            self.make_vote(MagicMock(name="d"), Vote.DIRECTIONS.up),
+        ]
+        self.write_vote.side_effect = [None, None, ValueError, None]
+        self.assertRaises(ValueError, Vote.commit_batch, votes)
+
+        # only the votes that were written have been applied
+        self.thing._incr.assert_called_once_with("_ups", 2)
+        self.thing.author_slow.incr_karma.assert_called_once_with(
+            kind=self.thing.affects_karma_type,
+            sr=self.thing.subreddit_slow,
+            amt=2,
+        )
+        self.assertFalse(self.new_votes.called)
+
+        # the messages are retried one at a time, and the written votes are
+        # found as the users' previous votes
+        self.thing._incr.reset_mock()
+        self.write_vote.side_effect = None
+        for i, vote in enumerate(votes):
+            previous_vote = vote if i < 2 else None
+            Vote.commit_batch([self.make_vote(
+                vote.user, vote.direction, previous_vote=previous_vote)])
+
+        self.assertEqual(
+            sorted(call[0] for call in self.thing._incr.call_args_list),
+            [("_downs", 1), ("_ups", 1)],
+        )
+
+    def test_changed_vote_in_batch(self):
+        user = MagicMock(name="user")
+        upvote = self.make_vote(user, Vote.DIRECTIONS.up)
+        unvote = self.make_vote(
+            user, Vote.DIRECTIONS.unvote, previous_vote=upvote)
+        Vote.commit_batch([upvote, unvote])
+
+        self.assertFalse(self.thing._incr.called)
+        self.assertFalse(self.thing.author_slow.incr_karma.called)
+        self.assertEqual(self.write_vote.call_count, 2)
+
+    def test_skips_repeated_vote(self):
+        user = MagicMock(name="user")
+        upvote = self.make_vote(user, Vote.DIRECTIONS.up)
+        repeat = self.make_vote(user, Vote.DIRECTIONS.up, previous_vote=upvote)
+        Vote.commit_batch([repeat])
+
+        self.assertFalse(self.thing._incr.called)
+        self.assertFalse(self.write_vote.called)
+        self.assertFalse(self.new_votes.called)
+
+    def test_num_votes_after_each(self):
+        votes = [
+            self.make_vote(MagicMock(name="a"), Vote.DIRECTIONS.up),
+            self.make_vote(MagicMock(name="b"), Vote.DIRECTIONS.unvote),
+            self.make_vote(MagicMock(name="c"), Vote.DIRECTIONS.down),
+        ]
+        self.assertEqual(Vote.num_votes_after_each(votes), [29, 29, 30])
+
+
+class TestVotedThingFilter(RedditTestCase):
+    def setUp(self):
+        self.cache = DictCache()
+        self.patch_g(gencache=self.cache, make_lock=MagicMock(),
+                     voted_filter_max_votes=50)
+        self.patch_liveconfig("voted_filter", True)
+
+        self.stored = {Link: ["1"], Comment: ["2", "3"]}
+        def rel(thing_cls):
+            rel_cls = MagicMock(name="rel")
+            rel_cls._cf.xget.return_value = [
+                (id36, "1") for id36 in self.stored[thing_cls]]
+            return rel_cls
+        self.autopatch(VotesByAccount, "rel", side_effect=rel)
+
+        self.user = MagicMock(name="user")
+        self.user._id36 = "u1"
+        super(TestVotedThingFilter, self).setUp()
+
+    def voted(self, fullname):
+        thing = MagicMock(name=fullname)
+        thing._fullname = fullname
+        return thing
+
+    def test_add_rebuilds_missing_filter(self):
+        VotedThingFilter.add(self.user, self.voted("t3_5"))
+
+        voted_filter = VotedThingFilter.get(self.user)
+        for fullname in ("t3_5", "t3_1", "t1_2", "t1_3"):
+            self.assertIn(fullname, voted_filter)
+        self.assertNotIn("t3_2", voted_filter)
+
+    def test_add_to_filter(self):
+        VotedThingFilter.rebuild(self.user)
+        self.assertNotIn("t3_5", VotedThingFilter.get(self.user))
+
+        self.stored = {Link: [], Comment: []}
+        VotedThingFilter.add(self.user, self.voted("t3_5"))
+        voted_filter = VotedThingFilter.get(self.user)
+        self.assertIn("t3_5", voted_filter)
+        self.assertIn("t3_1", voted_filter)
+
+    def test_failed_add_deletes_filter(self):
+        VotedThingFilter.rebuild(self.user)
+        with patch.object(self.cache, "set", return_value=False):
+            VotedThingFilter.add(self.user, self.voted("t3_5"))
+        self.assertIsNone(VotedThingFilter.get(self.user))
+
+        VotedThingFilter.rebuild(self.user)
+        with patch.object(self.cache, "get", side_effect=MemcachedError):
+            VotedThingFilter.add(self.user, self.voted("t3_5"))
+        self.assertIsNone(VotedThingFilter.get(self.user))
+
+    def test_disabled(self):
+        VotedThingFilter.rebuild(self.user)
+        self.patch_liveconfig("voted_filter", False)
+        self.assertIsNone(VotedThingFilter.get(self.user))
+
+        VotedThingFilter.add(self.user, self.voted("t3_5"))
+        self.assertEqual(dict(self.cache), {})
+
+    def test_rebuild_too_many_votes(self):
+        self.stored = {Link: [str(i) for i in xrange(51)], Comment: []}
+        VotedThingFilter.rebuild(self.user)
+        self.assertIsNone(VotedThingFilter.get(self.user))
+
+        # they stay without a filter as they keep voting
+        VotedThingFilter.add(self.user, self.voted("t3_5"))
+        self.assertEqual(self.cache.values(), [VotedThingFilter.TOO_MANY_VOTES])
+
+    def test_rebuild_capped(self):
+        self.autopatch(VotedThingFilter, "MAX_CAPACITY", 1500)
+        self.patch_g(voted_filter_max_votes=5000)
+        self.stored = {Link: [str(i) for i in xrange(1000)], Comment: []}
+        VotedThingFilter.rebuild(self.user)
+        self.assertEqual(VotedThingFilter.get(self.user).capacity, 1500)
+
+        self.stored[Comment] = [str(i) for i in xrange(501)]
+        VotedThingFilter.rebuild(self.user)
+        self.assertIsNone(VotedThingFilter.get(self.user))
+
+
+class FakeLink(object):
+    is_votable = True
+
+    def __init__(self, fullname):
+        self._fullname = fullname
+
+
+class TestGetStoredVotes(RedditTestCase):
+    def setUp(self):
+        self.user = MagicMock(name="user")
+        self.rel_cls = MagicMock(name="rel")
+        self.autopatch(VotesByAccount, "rel", return_value=self.rel_cls)
+        self.get_filter = self.autopatch(VotedThingFilter, "get")
+        super(TestGetStoredVotes, self).setUp()
+
+    def test_skips_things_not_in_filter(self):
+        voted = FakeLink("t3_1")
+        not_voted = FakeLink("t3_2")
+        voted_filter = BloomFilter.for_capacity(100, 0.01)
+        voted_filter.add("t3_1")
+        self.get_filter.return_value = voted_filter
+        self.rel_cls.fast_query.return_value = {(self.user, voted): "1"}
+
+        votes = queries.get_stored_votes(self.user, [voted, not_voted])
+
+        self.rel_cls.fast_query.assert_called_once_with(self.user, [voted])
+        self.assertEqual(votes, {(self.user, voted): Vote.DIRECTIONS.up})
+
+    def test_no_filter(self):
+        things = [FakeLink("t3_1"), FakeLink("t3_2")]
+        self.get_filter.return_value = None
+        self.rel_cls.fast_query.return_value = {}
+
+        queries.get_stored_votes(self.user, things)
+
+        self.rel_cls.fast_query.assert_called_once_with(self.user, things)
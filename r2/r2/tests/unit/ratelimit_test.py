@@ -153,6 +153,118 @@ class RateLimitStandaloneFunctionsTest(unittest.TestCase):
         self.assertEquals(1, ratelimit.get_usage('a', ts))
 
 
+class CountingCache(LocalCache):
+    """A LocalCache whose incr returns the new value like memcached's."""
+
+    def incr(self, key, delta=1, time=0):
+        LocalCache.incr(self, key, delta, time)
+        return self.get(key)
+
+
+class LocalUsageTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 24 * 3600 + 5
+        self.patch('ratelimit.time.time', lambda: self.now)
+
+        self.cache = CountingCache()
+        self.patch('ratelimit.g.ratelimitcache', self.cache)
+        self.patch('ratelimit.g.ratelimit_flush_interval_ms', 250, create=True)
+        self.patch('ratelimit.g.ratelimit_local_overshoot', 3, create=True)
+        self.patch('ratelimit.local_usage', ratelimit.LocalUsage())
+
+    def patch(self, *a, **kw):
+        p = patch(*a,  **kw)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_flushes_at_overshoot(self):
+        ts = ratelimit.get_timeslice(3600)
+
+        # the first use is recorded right away
+        self.assertEquals(1, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(1, self.cache['rl:a-000000'])
+
+        self.assertEquals(2, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(3, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(1, self.cache['rl:a-000000'])
+        self.assertEquals(3, ratelimit.get_usage('a', ts))
+
+        self.assertEquals(4, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(4, self.cache['rl:a-000000'])
+        self.assertEquals(4, ratelimit.get_usage('a', ts))
+
+    def test_flushes_after_interval(self):
+        ts = ratelimit.get_timeslice(3600)
+        ratelimit.record_usage('a', ts, exact=False)
+        ratelimit.record_usage('b', ts, exact=False)
+        ratelimit.record_usage('a', ts, exact=False)
+        ratelimit.record_usage('b', ts, exact=False)
+        self.assertEquals(1, self.cache['rl:a-000000'])
+
+        self.now += 1
+        self.assertEquals(3, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(3, self.cache['rl:a-000000'])
+        self.assertEquals(2, self.cache['rl:b-000000'])
+
+    def test_sees_other_processes(self):
+        ts = ratelimit.get_timeslice(3600)
+        ratelimit.record_usage('a', ts, exact=False)
+        self.cache['rl:a-000000'] += 10
+
+        self.assertEquals(2, ratelimit.record_usage('a', ts, exact=False))
+        self.now += 1
+        self.assertEquals(13, ratelimit.record_usage('a', ts, exact=False))
+
+    def test_exact(self):
+        ts = ratelimit.get_timeslice(3600)
+        ratelimit.record_usage('a', ts)
+        ratelimit.record_usage('a', ts)
+        self.assertEquals(2, self.cache['rl:a-000000'])
+
+    def test_record_multi(self):
+        tsa = ratelimit.get_timeslice(3600)
+        tsb = ratelimit.get_timeslice(700)
+        prefix_slices = [('a', tsa), ('b', tsb)]
+
+        # the first uses are recorded right away, the others counted here
+        ratelimit.record_usage_multi(prefix_slices, exact=False)
+        self.assertEquals(1, self.cache['rl:a-000000'])
+        self.assertEquals(1, self.cache['rl:b-235500'])
+
+        ratelimit.record_usage_multi(prefix_slices, exact=False)
+        self.assertEquals(1, self.cache['rl:a-000000'])
+        self.assertEquals([2, 2], ratelimit.get_usage_multi(prefix_slices))
+
+        self.now += 1
+        ratelimit.record_usage_multi(prefix_slices, exact=False)
+        self.assertEquals(3, self.cache['rl:a-000000'])
+        self.assertEquals(3, self.cache['rl:b-235500'])
+
+    def test_failed_flush_keeps_usage(self):
+        ts = ratelimit.get_timeslice(3600)
+        ratelimit.record_usage('a', ts, exact=False)
+        ratelimit.record_usage('a', ts, exact=False)
+
+        self.now += 1
+        with patch.object(self.cache, 'incr_multi',
+                          side_effect=pylibmc.Error):
+            self.assertRaises(ratelimit.RatelimitError,
+                              ratelimit.record_usage, 'a', ts, exact=False)
+        self.assertEquals(1, self.cache['rl:a-000000'])
+        self.assertEquals(3, ratelimit.get_usage('a', ts))
+
+        self.now += 1
+        self.assertEquals(4, ratelimit.record_usage('a', ts, exact=False))
+        self.assertEquals(4, self.cache['rl:a-000000'])
+
+    def test_disabled(self):
+        self.patch('ratelimit.g.ratelimit_flush_interval_ms', 0)
+        ts = ratelimit.get_timeslice(3600)
+        ratelimit.record_usage('a', ts, exact=False)
+        ratelimit.record_usage('a', ts, exact=False)
+        self.assertEquals(2, self.cache['rl:a-000000'])
+
+
 class RateLimitTest(unittest.TestCase):
     class TestRateLimit(ratelimit.RateLimit):
         event_name = 'TestRateLimit'
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2015 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+"""Compare the scalar and batch versions of the sorts in r2.lib.db.sorts.
+
+Checks that the batch versions give bit-identical results and reports how
+long each takes. Run with:
+
+    paster run run.ini ../scripts/benchmark_sorts.py -c "benchmark()"
+
+"""
+
+import random
+import struct
+import time
+from array import array
+from itertools import izip
+
+from r2.lib.db import sorts
+
+
+def _random_votes(n):
+    # mostly small vote counts, like most things, with some big ones mixed in
+    # to get past the precomputed confidence table
+    return array("l", [
+        random.randint(0, 50) if random.random() < 0.8
+        else random.randint(0, 100000)
+        for i in xrange(n)
+    ])
+
+
+def _timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def _check_identical(name, scalar_results, batch_results):
+    pack = struct.Struct("d").pack
+    for i, (a, b) in enumerate(izip(scalar_results, batch_results)):
+        if pack(a) != pack(b):
+            raise AssertionError("%s differs at %d: %r != %r" % (name, i, a, b))
+
+
+def benchmark(n=100000, seed=None):
+    random.seed(seed)
+    ups = _random_votes(n)
+    downs = _random_votes(n)
+    dates = array("d", [
+        1400000000 + random.random() * 100000000 for i in xrange(n)])
+    lengths = array("l", [random.randint(1, 10000) for i in xrange(n)])
+    answer_scores = array("d", [random.random() for i in xrange(n)])
+    answer_lengths = array("l", [random.randint(1, 10000) for i in xrange(n)])
+
+    cases = [
+        ("hot", sorts._hot, sorts.hot_batch, (ups, downs, dates)),
+        ("controversy", sorts.controversy, sorts.controversy_batch,
+            (ups, downs)),
+        ("confidence", sorts.confidence, sorts.confidence_batch, (ups, downs)),
+        ("score", sorts.score, sorts.score_batch, (ups, downs)),
+    ]
+
+    question_scores = sorts.confidence_batch(ups, downs)
+    cases.append(("qa", sorts._qa, sorts.qa_batch,
+        (question_scores, lengths, answer_scores, answer_lengths)))
+
+    print "%-12s %10s %10s %8s" % ("sort", "scalar", "batch", "speedup")
+    for name, scalar_fn, batch_fn, args in cases:
+        scalar_results, scalar_time = _timed(
+            lambda: [scalar_fn(*row) for row in izip(*args)])
+        batch_results, batch_time = _timed(batch_fn, *args)
+        _check_identical(name, scalar_results, batch_results)
+        print "%-12s %9.1fms %9.1fms %7.1fx" % (
+            name, scalar_time * 1000, batch_time * 1000,
+            scalar_time / batch_time)